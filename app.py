@@ -1,13 +1,21 @@
+import calendar
+import json
+import threading
+from collections import OrderedDict, defaultdict
+
 import streamlit as st
-from modules.pdf_processor import extract_text_and_images
+from modules.ingestion import (MAX_INGESTION_JOBS, IngestionCache, ProgressiveIngestion,
+                               compute_document_hash)
+from modules.corpus import load_corpus
+from modules.asset_store import load_image
+from modules.embeddings import warm_up_query_encoders
 from modules.ocr import extract_text_from_image
-from modules.embeddings import get_text_embeddings, get_image_embeddings, clip_model, clip_processor
-from modules.vector_db import VectorDB
-from modules.llm import generate_response
-from modules.image_processor import process_images
-import os
-import gc
-import tempfile
+from modules.orchestrator import QueryOrchestrator
+from modules.llm import MODEL, TEMPERATURE, context_budget, enhance_query
+from modules.context import CONTEXT_CANDIDATES, build_context
+from modules.response_cache import ResponseCache, make_cache_key, make_scope
+from modules.tracing import (DEBUG_PANEL, METRICS_PORT, cache_hit_rates, otel_json, prometheus_text,
+                             start_metrics_server, trace)
 
 # Initialize session state for chat history
 if 'chat_history' not in st.session_state:
@@ -144,53 +152,166 @@ st.markdown('''
 </div>
 ''', unsafe_allow_html=True)
 
-uploaded_file = st.file_uploader("", type="pdf")
-if uploaded_file is not None:
-    # Create a temporary file that will be automatically cleaned up
-    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
-        temp_pdf.write(uploaded_file.getbuffer())
-        temp_path = temp_pdf.name
-
-    try:
-        # Extract text and images
-        text_data, image_data = extract_text_and_images(temp_path)
-    finally:
-        # Clean up the temporary PDF file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-    # Show processing success message
-    st.success("✅ Document processed successfully! You can now ask questions about it.")
-
-    # Generate embeddings
-    text_embeddings = get_text_embeddings([chunk["text"] for chunk in text_data])
-    image_embeddings = get_image_embeddings([img["path"] for img in image_data])
-
-    # Initialize vector DBs with their respective dimensions
-    text_dim = text_embeddings.shape[1]
-    image_dim = image_embeddings.shape[1]
-    
-    # Store data in session state to prevent recreation on each rerun
-    if 'text_db' not in st.session_state:
-        st.session_state.text_db = VectorDB(text_dim)
-    if 'image_db' not in st.session_state:
-        st.session_state.image_db = VectorDB(image_dim)
-    if 'image_data' not in st.session_state:
-        st.session_state.image_data = []
-    
-    # Clear existing data and add new embeddings
-    st.session_state.text_db.reset()
-    st.session_state.text_db.add(text_embeddings)
-    st.session_state.image_db.reset()
-    st.session_state.image_db.add(image_embeddings)
-    
-    # Store image data in session state
-    st.session_state.image_data = image_data
-    
-    # Clean up large numpy arrays we don't need anymore
-    del text_embeddings
-    del image_embeddings
-    gc.collect()
+@st.cache_resource
+def get_ingestion_cache():
+    """Share one ingestion cache across all sessions of this process."""
+    return IngestionCache()
+
+@st.cache_resource
+def get_response_cache():
+    """Share one answer cache across all sessions of this process."""
+    return ResponseCache()
+
+@st.cache_resource
+def get_ingestion_jobs():
+    """
+    Ingestion jobs by document hash, shared so each upload is processed
+    once, with the lock guarding them and per-hash locks held while a job
+    is created.
+    """
+    return OrderedDict(), threading.Lock(), defaultdict(threading.Lock)
+
+def get_ingestion_job(pdf_bytes, name=None, retry=False):
+    """
+    Return the running, finished or failed ingestion job for these bytes,
+    starting one if needed. A failed job is only restarted with `retry`.
+    """
+    jobs, lock, creating = get_ingestion_jobs()
+    doc_hash = compute_document_hash(pdf_bytes)
+
+    def needs_start(job):
+        return job is None or (retry and job.error is not None)
+
+    with lock:
+        job = jobs.get(doc_hash)
+        create_lock = creating[doc_hash] if needs_start(job) else None
+    if create_lock is not None:
+        # Creating a job loads the cached document or counts the PDF's pages,
+        # so only sessions uploading the same bytes wait for it
+        with create_lock:
+            with lock:
+                job = jobs.get(doc_hash)
+            try:
+                if needs_start(job):
+                    job = ProgressiveIngestion(pdf_bytes, get_ingestion_cache(), name=name)
+                    with lock:
+                        jobs[doc_hash] = job
+            finally:
+                with lock:
+                    creating.pop(doc_hash, None)
+    with lock:
+        # Put back if dropped meanwhile, unless a retry has replaced it
+        job = jobs.setdefault(doc_hash, job)
+        jobs.move_to_end(doc_hash)
+        # Drop the least recently used finished jobs; running ones stay until they finish
+        finished = [key for key, other in jobs.items() if other.done or other.error is not None]
+        for key in finished[:max(0, len(jobs) - MAX_INGESTION_JOBS)]:
+            jobs.pop(key)
+    return job
+
+@st.fragment(run_every=1)
+def show_ingestion_progress(jobs):
+    """Refresh the progress bars on their own until every document is fully indexed."""
+    if all(job.done or job.error is not None for job in jobs):
+        st.rerun()
+    for job in jobs:
+        if not job.done and job.error is None:
+            st.progress(job.progress, text=f"⏳ {job.name}: indexed {job.pages_done} of {job.page_count} "
+                                           "pages. You can already ask about the indexed pages.")
+
+@st.cache_resource
+def get_corpus():
+    """Load the pre-built corpus (see modules/batch_ingest.py) once per process, if there is one."""
+    return load_corpus()
+
+@st.cache_resource
+def get_metrics_server():
+    """Expose the process metrics for scraping when OMNIQUERY_METRICS_PORT is set."""
+    return start_metrics_server() if METRICS_PORT else None
+
+def show_debug_panel(query_trace):
+    """Timing breakdown of the last question, with token usage, cache hit rates and metric exports."""
+    with st.sidebar.expander("🔧 Last query breakdown", expanded=True):
+        st.caption(f"Total {query_trace['duration_ms']:.0f} ms")
+        st.dataframe([{'span': span['name'], 'start ms': round(span['start'], 1),
+                       'duration ms': round(span['duration'], 1), 'items': span['items'],
+                       'thread': span['thread'], 'error': span['error']}
+                      for span in query_trace['spans']], hide_index=True)
+        if query_trace['usage']:
+            st.caption(f"Tokens: {query_trace['usage']['prompt_tokens']} prompt, "
+                       f"{query_trace['usage']['completion_tokens']} completion")
+        rates = cache_hit_rates()
+        if rates:
+            st.caption("Cache hit rates: " + ", ".join(f"{cache} {rate:.0%}" for cache, rate in sorted(rates.items())))
+        st.download_button("Prometheus metrics", prometheus_text(), file_name='metrics.txt')
+        st.download_button("OpenTelemetry JSON", json.dumps(otel_json()), file_name='metrics.json')
+
+@st.cache_resource
+def get_encoder_warm_up():
+    """Start loading the query encoders in the background, once per process, without holding up the page."""
+    thread = threading.Thread(target=warm_up_query_encoders, daemon=True, name='encoder-warm-up')
+    thread.start()
+    return thread
+
+get_metrics_server()
+encoder_warm_up = get_encoder_warm_up()
+
+uploaded_files = st.file_uploader("", type="pdf", accept_multiple_files=True)
+corpus = get_corpus()
+if corpus is not None and len(corpus):
+    st.caption(f"📚 Searching {len(corpus)} library documents alongside your uploads; "
+               "narrow the search with the sidebar filters.")
+
+# Parse and embed uploads in the background, or reuse cached results for
+# their bytes; the indexes grow as pages are processed
+uploads = {}
+for uploaded_file in uploaded_files or []:
+    pdf_bytes = uploaded_file.getvalue()
+    uploads[compute_document_hash(pdf_bytes)] = (pdf_bytes, uploaded_file.name)
+documents = [get_ingestion_job(pdf_bytes, name) for pdf_bytes, name in uploads.values()]
+# Documents ingested offline are all searched, without uploading them
+documents += list(corpus.shards.values()) if corpus is not None else []
+# The same bytes uploaded twice, or also present in the library, are searched
+# once; a fixed order keeps the chunk ids in cached answers stable
+documents = sorted({document.hash: document for document in documents}.values(),
+                   key=lambda document: document.hash)
+
+if documents:
+    # Answers are cached per set of documents searched
+    st.session_state.doc_hash = (documents[0].hash if len(documents) == 1 else compute_document_hash(
+        ''.join(sorted(document.hash for document in documents)).encode()))
+
+    pending = [document for document in documents if not document.done and document.error is None]
+    for document in documents:
+        if document.error is not None:
+            st.error(f"Processing {document.name} failed: {document.error}")
+            # Failed uploads stay failed until the user asks to process them again
+            if document.hash in uploads and st.button(f"🔄 Retry {document.name}", key=f"retry-{document.hash}"):
+                get_ingestion_job(*uploads[document.hash], retry=True)
+                st.rerun()
+    if pending:
+        show_ingestion_progress(pending)
+    elif all(document.done for document in documents):
+        st.success("✅ Documents processed successfully! You can now ask questions about them."
+                   if len(documents) > 1 else
+                   "✅ Document processed successfully! You can now ask questions about it.")
+
+    # Optional filters, applied before any index is searched
+    with st.sidebar:
+        st.markdown("### 🔎 Search filters")
+        searched = st.multiselect("Documents", [document.hash for document in documents],
+                                  format_func=lambda doc_hash: next(
+                                      document.name for document in documents if document.hash == doc_hash))
+        first_page = st.number_input("From page", min_value=1, value=None, step=1)
+        last_page = st.number_input("To page", min_value=1, value=None, step=1)
+        date_range = st.date_input("Document date", value=())
+    doc_hashes = set(searched) or None
+    pages = (first_page, last_page) if first_page is not None or last_page is not None else None
+    dates = None
+    if len(date_range) == 2:
+        # Whole days, in UTC like the PDF dates
+        dates = (calendar.timegm(date_range[0].timetuple()),
+                 calendar.timegm(date_range[1].timetuple()) + 86399)
 
     # Chat interface section
     st.markdown('''
@@ -209,95 +330,100 @@ if uploaded_file is not None:
     # Query input with custom placeholder
     query = st.chat_input("💭 Ask any question about your document...")
     if query:
-        # Get text embeddings for the query
-        query_text_emb = get_text_embeddings([query])[0]
-        
-        # Search text content
-        text_indices = st.session_state.text_db.search(query_text_emb)
-        
-        # Get CLIP text embeddings for image search
-        clip_text_emb = clip_model.get_text_features(**clip_processor(text=[query], return_tensors="pt", padding=True)).detach().numpy()
-        
-        # Search images using CLIP embeddings
-        image_indices = st.session_state.image_db.search(clip_text_emb[0])
-        
-        # Clean up query embedding after search
-        del query_text_emb
-        gc.collect()
+        # Models still loading would eat into the encode stages' timeouts
+        if encoder_warm_up.is_alive():
+            with st.spinner("Loading the search models..."):
+                encoder_warm_up.join()
+        with trace('query') as query_trace:
+            # Encode the query with MiniLM and CLIP, search BM25, dense text and
+            # image indexes of every document and describe the images
+            # concurrently, each stage under its own timeout
+            orchestrator = QueryOrchestrator(documents)
+            results = orchestrator.retrieve_sync(query, k=CONTEXT_CANDIDATES, doc_hashes=doc_hashes,
+                                                 pages=pages, dates=dates)
+            text_indices = results['text_ids']
+            image_indices = results['image_ids']
+            query_text_emb = results['query_embedding']
+            chunk_store = results['chunks']
+            relevant_images = results['images']
+            processed_images = results['image_descriptions']
         
-        # Add user query to chat history
-        st.session_state.chat_history.append({"role": "user", "content": query})
-        with st.chat_message("user"):
-            st.write(query)
-
-        # Get relevant text chunks and sort by page number
-        relevant_chunks = [text_data[idx] for idx in text_indices]
-        relevant_chunks.sort(key=lambda x: (x['page'], x['bbox'][1]))  # Sort by page and vertical position
-        
-        # Combine nearby chunks from the same page
-        combined_chunks = []
-        current_page = -1
-        current_text = []
-        
-        for chunk in relevant_chunks:
-            if chunk['page'] != current_page:
-                if current_text:  # Save accumulated text from previous page
-                    combined_chunks.append({
-                        'page': current_page,
-                        'text': ' '.join(current_text)
-                    })
-                current_page = chunk['page']
-                current_text = [chunk['text']]
-            else:
-                current_text.append(chunk['text'])
-        
-        # Add the last chunk
-        if current_text:
-            combined_chunks.append({
-                'page': current_page,
-                'text': ' '.join(current_text)
-            })
-        
-        # Format text for display and context
-        relevant_text = []
-        for chunk in combined_chunks:
-            formatted_text = f"Page {chunk['page']}: {chunk['text']}"
-            relevant_text.append(formatted_text)
+            # Add user query to chat history
+            st.session_state.chat_history.append({"role": "user", "content": query})
+            with st.chat_message("user"):
+                st.write(query)
+
+            # Pack the best-ranked chunks into the prompt's token budget left
+            # after the image descriptions; the context lists them by page in
+            # reading order
+            candidate_chunks = []
+            for idx in text_indices:
+                document = documents[chunk_store.doc[idx]]
+                candidate_chunks.append(dict(document.text_data[chunk_store.local[idx]], doc=document.name))
+            relevant_text, used = build_context(candidate_chunks, context_budget(query, processed_images),
+                                                show_doc=len(documents) > 1)
+            text_indices = text_indices[used]
         
-        # Display source text in a styled expander
-        with st.expander("📍 View Source Text"):
-            if relevant_text:
-                for chunk in relevant_text:
-                    page, content = chunk.split(':', 1)
-                    st.markdown(f'''
-                    <div class="source-text">
-                        <div class="page">{page}</div>
-                        <div class="content">{content}</div>
-                    </div>''', unsafe_allow_html=True)
-            else:
-                st.warning("No relevant text found in the document.")
+            # Display source text in a styled expander
+            with st.expander("📍 View Source Text"):
+                if relevant_text:
+                    for chunk in relevant_text:
+                        page, content = chunk.split(':', 1)
+                        st.markdown(f'''
+                        <div class="source-text">
+                            <div class="page">{page}</div>
+                            <div class="content">{content}</div>
+                        </div>''', unsafe_allow_html=True)
+                else:
+                    st.warning("No relevant text found in the document.")
                 
-        # Get relevant images
-        relevant_images = [st.session_state.image_data[idx] for idx in image_indices]
-        processed_images = process_images([img["path"] for img in relevant_images])
+            # Generate context for LLM
+            context = "\n".join(relevant_text)
         
-        # Generate context for LLM
-        context = "\n".join(relevant_text)
-        
-        # Generate and display response with loading indicator
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                response = generate_response(query, context, processed_images)
-                
-                # Display response text
-                st.markdown(response)
-                
+            # Reuse a cached answer for the same question and context if we have one
+            # (only once the documents are complete; earlier answers saw part of them)
+            response_cache = get_response_cache() if all(document.done for document in documents) else None
+            response = None
+            if response_cache is not None:
+                cache_key = make_cache_key(st.session_state.doc_hash, text_indices, enhance_query(query),
+                                           MODEL, TEMPERATURE, image_ids=image_indices)
+                # Similar questions only share answers under the same filters and model settings
+                cache_scope = make_scope(st.session_state.doc_hash, MODEL, TEMPERATURE, doc_hashes, pages, dates)
+                response = response_cache.lookup(cache_key, cache_scope, query_text_emb)
+
+            with st.chat_message("assistant"):
+                if response is not None:
+                    st.markdown(response)
+                    st.caption("⚡ Answered from cache")
+                else:
+                    # Stream the response as it is generated
+                    generation_stats = {}
+                    response = st.write_stream(orchestrator.stream_answer(query, context, processed_images,
+                                                                          stats=generation_stats))
+                    # Answers missing a stage are not worth reusing
+                    if response_cache is not None and not orchestrator.degraded:
+                        response_cache.put(cache_key, cache_scope, response, query_text_emb)
+
+                    # Show generation timings
+                    st.caption(f"⏱️ Retrieval in {orchestrator.timings['retrieval']:.2f}s, "
+                               f"first token after {generation_stats.get('time_to_first_token', 0):.2f}s, "
+                               f"full answer in {generation_stats.get('total_time', 0):.2f}s")
+                    for notice in orchestrator.notices():
+                        st.caption(f"⚠️ {notice}")
+
                 # Display relevant images
                 if relevant_images:
                     st.markdown("### Related Images")
                     cols = st.columns(min(3, len(relevant_images)))
                     for idx, (img, col) in enumerate(zip(relevant_images, cols)):
                         with col:
-                            st.image(img["path"], caption=f"Image {idx + 1}", use_container_width=True)
-                
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
\ No newline at end of file
+                            # Served decoded from the asset store's memory cache
+                            image = load_image(img)
+                            if image is not None:
+                                st.image(image, caption=f"Image {idx + 1} (p. {img['page']})", use_container_width=True)
+
+                st.session_state.chat_history.append({"role": "assistant", "content": response})
+        st.session_state.last_trace = query_trace.summary()
+
+    if DEBUG_PANEL and 'last_trace' in st.session_state:
+        show_debug_panel(st.session_state.last_trace)
@@ -0,0 +1,195 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from modules.models import get_model
+from modules.tracing import record_cache
+
+ASSET_DIR = os.getenv('OMNIQUERY_ASSET_DIR', os.path.join('.cache', 'assets'))
+# Disk space the store may use before the least recently used assets are
+# deleted; 0 means unbounded
+ASSET_MAX_MB = float(os.getenv('OMNIQUERY_ASSET_MAX_MB', '2048'))
+# Memory for decoded images kept ready for st.image, CLIP and OCR
+ASSET_MEMORY_MB = float(os.getenv('OMNIQUERY_ASSET_MEMORY_MB', '256'))
+ASSET_SUFFIX = '.png'
+
+
+def asset_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class AssetStore:
+    """
+    Content-addressed store of image bytes on disk, with decoded copies of
+    the hottest images in memory.
+
+    Assets are named by the SHA-256 of their bytes and written atomically,
+    so sessions and processes storing the same image share one file and
+    never overwrite each other's. Once the files exceed `max_bytes`, the
+    least recently used ones are deleted. Up to `memory_bytes` of decoded
+    images are kept in an LRU; they are shared between callers and must not
+    be modified or closed.
+    """
+
+    def __init__(self, root=ASSET_DIR, max_bytes=ASSET_MAX_MB * 2 ** 20,
+                 memory_bytes=ASSET_MEMORY_MB * 2 ** 20):
+        self.root = root
+        self.max_bytes = max_bytes or None
+        self.memory_bytes = memory_bytes
+        self._files = None
+        self._disk_bytes = 0
+        self._decoded = OrderedDict()
+        self._decoded_bytes = 0
+        self._lock = threading.Lock()
+
+    def path(self, asset_hash):
+        return os.path.join(self.root, asset_hash[:2], asset_hash + ASSET_SUFFIX)
+
+    def _index(self):
+        """Sizes of the files on disk in least recently used order, scanned on first use."""
+        if self._files is None:
+            entries = []
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    if name.endswith(ASSET_SUFFIX):
+                        stat = os.stat(os.path.join(directory, name))
+                        entries.append((stat.st_mtime, name[:-len(ASSET_SUFFIX)], stat.st_size))
+            self._files = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self._disk_bytes = sum(self._files.values())
+        return self._files
+
+    def _touch(self, asset_hash, path):
+        # The modification time keeps the LRU order across restarts
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if self.max_bytes is not None:
+            with self._lock:
+                if asset_hash in self._index():
+                    self._files.move_to_end(asset_hash)
+
+    def put(self, data):
+        """Store image bytes and return their hash; storing the same bytes again is free."""
+        key = asset_hash(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            self._touch(key, path)
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        if self.max_bytes is not None:
+            with self._lock:
+                files = self._index()
+                if key not in files:
+                    files[key] = len(data)
+                    self._disk_bytes += len(data)
+                self._evict(keep=key)
+        return key
+
+    def _evict(self, keep):
+        while self._disk_bytes > self.max_bytes and len(self._files) > 1:
+            victim, size = next(iter(self._files.items()))
+            if victim == keep:
+                self._files.move_to_end(victim)
+                continue
+            del self._files[victim]
+            self._disk_bytes -= size
+            try:
+                os.remove(self.path(victim))
+            except FileNotFoundError:
+                pass
+
+    def get(self, asset_hash):
+        """Return the bytes of an asset, or None if it is not (or no longer) stored."""
+        path = self.path(asset_hash)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._touch(asset_hash, path)
+        return data
+
+    def __contains__(self, asset_hash):
+        return os.path.exists(self.path(asset_hash))
+
+    def image(self, asset_hash, load=None):
+        """
+        Return the decoded image of an asset from memory, decoding it on a
+        miss. `load` supplies the bytes if they are not in this store (e.g.
+        a corpus shard); returns None if neither has them.
+        """
+        with self._lock:
+            image = self._decoded.get(asset_hash)
+            if image is not None:
+                self._decoded.move_to_end(asset_hash)
+        if image is not None:
+            record_cache('decoded_images', 'hit')
+            return image
+        record_cache('decoded_images', 'miss')
+
+        data = load() if load is not None else self.get(asset_hash)
+        if data is None:
+            return None
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        size = image.width * image.height * len(image.getbands())
+        with self._lock:
+            if asset_hash not in self._decoded:
+                self._decoded[asset_hash] = image
+                self._decoded_bytes += size
+            while self._decoded_bytes > self.memory_bytes and len(self._decoded) > 1:
+                _, evicted = self._decoded.popitem(last=False)
+                self._decoded_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+        return image
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files) if self._files is not None else None,
+                    'disk_bytes': self._disk_bytes if self._files is not None else None,
+                    'decoded': len(self._decoded), 'decoded_bytes': self._decoded_bytes}
+
+
+def get_asset_store():
+    return get_model('asset_store')
+
+
+def image_bytes(image):
+    """
+    Return the PNG bytes of an image record: its `data` while it still
+    carries them, else the file at `path` (corpus shards), else the asset
+    store. Returns None if the asset is gone.
+    """
+    if image.get('data') is not None:
+        return image['data']
+    if image.get('path'):
+        try:
+            with open(image['path'], 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    return get_asset_store().get(image['hash'])
+
+
+def load_image(image):
+    """Return the decoded image of a record, shared through the in-memory LRU; do not modify it."""
+    return get_asset_store().image(image['hash'], lambda: image_bytes(image))
+
+
+def store_images(images, store=None):
+    """Move the bytes of image records into the store, keeping only their `hash`."""
+    store = store or get_asset_store()
+    for image in images:
+        data = image.pop('data', None)
+        if data is not None:
+            image['hash'] = store.put(data)
+    return images
@@ -0,0 +1,194 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from modules.corpus import (CORPUS_DIR, CORPUS_MANIFEST, read_manifest, read_shard_info,
+                            write_json, write_shard)
+
+# Documents ingested in parallel, one worker process each
+BATCH_WORKERS = int(os.getenv('OMNIQUERY_BATCH_WORKERS', str(max(1, (os.cpu_count() or 1) // 2))))
+# Workers are spawned, not forked: the isolation threads below (and any
+# model registry lock) would otherwise be copied mid-use into the children
+_MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def find_pdfs(root):
+    """Return the paths of all PDFs below `root`, sorted."""
+    paths = []
+    for directory, _, files in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in files if name.lower().endswith('.pdf'))
+    return sorted(paths)
+
+
+def _init_worker(threads):
+    # Split the cores between worker processes instead of letting every
+    # torch instance use all of them
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def ingest_file(pdf_path, corpus_dir):
+    """
+    Worker entry point: ingest one PDF into a shard of `corpus_dir`.
+
+    Page extraction and OCR run sequentially inside the worker, since the
+    parallelism is across documents. Returns the shard summary, or a dict
+    with `path` and `error` if the document could not be ingested.
+    """
+    from modules.ingestion import compute_document_hash, ingest_path
+    from modules.pdf_processor import count_pages, document_date
+
+    start = time.time()
+    try:
+        with open(pdf_path, 'rb') as f:
+            doc_hash = compute_document_hash(f.read())
+        # Identical content under another name is ingested only once
+        info = read_shard_info(corpus_dir, doc_hash)
+        if info is None:
+            document = ingest_path(pdf_path, doc_hash, pdf_workers=1, ocr_workers=1)
+            info = write_shard(corpus_dir, document, {
+                'path': os.path.abspath(pdf_path),
+                'pages': count_pages(pdf_path),
+                'date': document_date(pdf_path) or os.path.getmtime(pdf_path),
+                'ingested_at': time.time(),
+                'seconds': round(time.time() - start, 3),
+            })
+        return dict(info, path=os.path.abspath(pdf_path))
+    except Exception as e:
+        return {'path': os.path.abspath(pdf_path), 'error': f"{type(e).__name__}: {e}"}
+
+
+def _ingest_isolated(pdf_path, corpus_dir, threads):
+    """Ingest one PDF in a worker process of its own, so a crash is pinned on this file."""
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=_MP_CONTEXT,
+                                 initializer=_init_worker, initargs=(threads,)) as pool:
+            return pool.submit(ingest_file, pdf_path, corpus_dir).result()
+    except BrokenProcessPool:
+        return {'path': pdf_path, 'error': 'BrokenProcessPool: the worker process died (crash or out of memory)'}
+
+
+def _ingest_all(paths, corpus_dir, workers, threads):
+    """
+    Yield the result of ingesting each of `paths` as it completes.
+
+    If a worker process dies, e.g. on a segfault in the PDF library or out
+    of memory, the whole pool breaks and the document that caused it cannot
+    be told apart from the others in flight. The files that had not
+    finished are then ingested again, each in a worker process of its own.
+    """
+    unfinished = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT,
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        futures = {pool.submit(ingest_file, path, corpus_dir): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                unfinished.append(futures[future])
+    if not unfinished:
+        return
+    print(f"A worker process died; ingesting the {len(unfinished)} unfinished PDFs in separate processes")
+    with ThreadPoolExecutor(max_workers=workers) as isolated:
+        futures = [isolated.submit(_ingest_isolated, path, corpus_dir, threads) for path in unfinished]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {'size': None, 'mtime': None}
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _unchanged(entry, state):
+    return (entry['size'], entry['mtime']) == (state['size'], state['mtime'])
+
+
+def _drop_orphan(manifest, doc_hash):
+    """Forget a document that no source file has any more, e.g. after an edit."""
+    if all(entry['hash'] != doc_hash for entry in manifest['files'].values()):
+        manifest['documents'].pop(doc_hash, None)
+
+
+def ingest_directory(root, corpus_dir=CORPUS_DIR, workers=BATCH_WORKERS, retry_failed=False):
+    """
+    Ingest every PDF below `root` into the corpus in `corpus_dir`.
+
+    Files whose path, size and modification time match a finished entry of
+    the corpus manifest are skipped, so an interrupted run resumes where it
+    stopped. Files that failed are retried once their size or modification
+    time changes, or always with `retry_failed`; a file whose worker
+    process crashes counts as failed. The manifest is rewritten after every
+    document. Returns counts of ingested, skipped and failed
+    files.
+    """
+    manifest = read_manifest(corpus_dir)
+    pending = []
+    skipped = 0
+    for path in find_pdfs(root):
+        path = os.path.abspath(path)
+        known = manifest['files'].get(path)
+        failed = manifest['failed'].get(path)
+        state = _file_state(path)
+        if known is not None and known['hash'] in manifest['documents'] and _unchanged(known, state):
+            skipped += 1
+        elif failed is not None and _unchanged(failed, state) and not retry_failed:
+            skipped += 1
+        else:
+            pending.append(path)
+
+    print(f"{len(pending)} PDFs to ingest, {skipped} skipped")
+    counts = {'ingested': 0, 'skipped': skipped, 'failed': 0}
+    if not pending:
+        return counts
+
+    workers = max(1, min(workers, len(pending)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    manifest_path = os.path.join(corpus_dir, CORPUS_MANIFEST)
+    for done, result in enumerate(_ingest_all(pending, corpus_dir, workers, threads), 1):
+        path = result['path']
+        if 'error' in result:
+            # Remember the file as it was, so an edited version is retried
+            manifest['failed'][path] = dict(_file_state(path), error=result['error'])
+            counts['failed'] += 1
+            print(f"[{done}/{len(pending)}] FAILED {path}: {result['error']}")
+        else:
+            manifest['failed'].pop(path, None)
+            manifest['documents'].setdefault(result['hash'], result)
+            previous = manifest['files'].get(path)
+            manifest['files'][path] = dict(_file_state(path), hash=result['hash'])
+            if previous is not None and previous['hash'] != result['hash']:
+                _drop_orphan(manifest, previous['hash'])
+            counts['ingested'] += 1
+            print(f"[{done}/{len(pending)}] {path}: {result['pages']} pages, "
+                  f"{result['chunks']} chunks, {result['images']} images")
+        write_json(manifest_path, manifest)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest a directory of PDFs into a corpus the app can load.')
+    parser.add_argument('directory', help='directory searched recursively for PDFs')
+    parser.add_argument('--corpus-dir', default=CORPUS_DIR)
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS,
+                        help='documents ingested in parallel; each worker loads its own models')
+    parser.add_argument('--retry-failed', action='store_true', help='retry files that failed in earlier runs even if they are unchanged')
+    args = parser.parse_args(argv)
+
+    counts = ingest_directory(args.directory, args.corpus_dir, args.workers, args.retry_failed)
+    print(f"Ingested {counts['ingested']}, skipped {counts['skipped']}, failed {counts['failed']}")
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# A batch is run once it holds this many items or its first item has waited this long
+QUERY_BATCH_SIZE = int(os.getenv('OMNIQUERY_QUERY_BATCH_SIZE', '32'))
+QUERY_BATCH_WAIT_MS = float(os.getenv('OMNIQUERY_QUERY_BATCH_WAIT_MS', '5'))
+# Number of recent batches kept for the percentile metrics
+METRICS_WINDOW = 1000
+# Queued by `shutdown` to stop the batching thread
+_STOP = None
+
+class MicroBatcher:
+    """
+    Collects single items submitted from any thread into batches for `func`.
+
+    A background thread takes the first waiting item, keeps collecting until
+    `max_batch` items are queued or `max_wait` seconds have passed, calls
+    `func` once with the whole list and resolves each item's Future with its
+    row of the result. `stats()` reports batch sizes and queue waits.
+    """
+
+    def __init__(self, func, max_batch=QUERY_BATCH_SIZE, max_wait=QUERY_BATCH_WAIT_MS / 1000, name='batcher'):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._batches = 0
+        self._items = 0
+        self._sizes = deque(maxlen=METRICS_WINDOW)
+        self._waits = deque(maxlen=METRICS_WINDOW)
+        self._run_times = deque(maxlen=METRICS_WINDOW)
+
+    def submit(self, item):
+        """Queue one item and return a Future of its result."""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"{self.name} has been shut down")
+            self._queue.put((item, future, time.perf_counter()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+                self._thread.start()
+        return future
+
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout)
+
+    def shutdown(self, wait=False):
+        """Stop the batching thread once the items queued so far have run."""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            if wait:
+                thread.join()
+
+    def _collect(self):
+        """Return the next batch, and whether `shutdown` was reached while collecting it."""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            # Futures cancelled by callers that gave up are skipped
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                results = self.func([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(f"{self.name} returned {len(results)} results for {len(batch)} items")
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            with self._lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._sizes.append(len(batch))
+                self._waits.extend(start - submitted for _, _, submitted in batch)
+                self._run_times.append(time.perf_counter() - start)
+
+    def stats(self):
+        """Batch size, queue wait and run time metrics (times in milliseconds)."""
+        with self._lock:
+            sizes = np.array(self._sizes, dtype=np.float64)
+            waits = np.array(self._waits, dtype=np.float64) * 1000
+            run_times = np.array(self._run_times, dtype=np.float64) * 1000
+            stats = {'batches': self._batches, 'items': self._items, 'queued': self._queue.qsize()}
+        for name, values in (('batch_size', sizes), ('queue_wait_ms', waits), ('run_ms', run_times)):
+            if len(values):
+                stats[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                               'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+        return stats
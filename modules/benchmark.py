@@ -0,0 +1,451 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Syllables the synthetic words are made of
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tos', 'vu', 'sel', 'dra', 'po', 'nix', 'ter', 'ga',
+             'bel', 'quo', 'fin', 'sha', 'mor', 'lu', 'zen', 'tri']
+
+
+def make_vocabulary(size=2000, seed=0):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def _synthetic_png(rng, size):
+    from PIL import Image, ImageDraw
+    # Noise keeps every image distinct for the deduplicator; the label gives OCR some text
+    pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    ImageDraw.Draw(image).rectangle((10, size // 2 - 12, size - 10, size // 2 + 12), fill='white')
+    ImageDraw.Draw(image).text((14, size // 2 - 6), f"Figure {rng.integers(1_000_000)}", fill='black')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_pdf(path, pages=20, words_per_page=400, images_per_page=1, image_size=256, seed=0,
+             vocabulary=None):
+    """
+    Write a synthetic PDF of `pages` pages to `path`.
+
+    Each page holds about `words_per_page` words of seeded pseudo-text in
+    paragraphs and `images_per_page` distinct images. The same arguments
+    always produce the same document.
+    """
+    import fitz
+    vocabulary = vocabulary or make_vocabulary()
+    words = random.Random(seed)
+    pixels = np.random.default_rng(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        width, height = page.rect.width, page.rect.height
+        image_height = 0
+        if images_per_page:
+            # Images share a band at the bottom of the page
+            image_height = min(height / 3, (width - 72) / images_per_page)
+            for i in range(images_per_page):
+                rect = fitz.Rect(36 + i * image_height, height - 36 - image_height,
+                                 36 + (i + 1) * image_height, height - 36)
+                page.insert_image(rect, stream=_synthetic_png(pixels, image_size))
+        paragraphs = []
+        remaining = words_per_page
+        while remaining > 0:
+            count = min(remaining, words.randint(40, 90))
+            sentence = ' '.join(words.choice(vocabulary) for _ in range(count))
+            paragraphs.append(sentence.capitalize() + '.')
+            remaining -= count
+        page.insert_textbox(fitz.Rect(36, 36, width - 36, height - 48 - image_height),
+                            '\n\n'.join(paragraphs), fontsize=8)
+    doc.set_metadata({'creationDate': 'D:20240101000000'})
+    doc.save(path)
+    doc.close()
+
+
+def make_queries(count, vocabulary, seed=0):
+    rng = random.Random(seed + 1)
+    return [f"What does the document say about {' '.join(rng.sample(vocabulary, rng.randint(1, 3)))}?"
+            for _ in range(count)]
+
+
+class FakeLLMServer:
+    """
+    Local stand-in for the OpenAI chat completions API.
+
+    Answers `POST /v1/chat/completions`, streamed or not, after
+    `first_token_ms` and then one token every `token_ms`, so the query path
+    can be measured without an API key or network. Use as a context manager;
+    `base_url` is what the OpenAI client should be pointed at.
+    """
+
+    def __init__(self, first_token_ms=300, token_ms=10, tokens=200, host='127.0.0.1', port=0):
+        self.first_token_ms = first_token_ms
+        self.token_ms = token_ms
+        self.tokens = tokens
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                server.requests += 1
+                if body.get('stream'):
+                    server._stream(self, body)
+                else:
+                    server._complete(self, body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _tokens(self, body):
+        return min(self.tokens, body.get('max_tokens') or self.tokens)
+
+    def _chunk(self, body, delta, finish_reason=None):
+        return {'id': 'chatcmpl-benchmark', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+    def _complete(self, handler, body):
+        tokens = self._tokens(body)
+        time.sleep((self.first_token_ms + self.token_ms * tokens) / 1000)
+        payload = json.dumps({
+            'id': 'chatcmpl-benchmark', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': ' word' * tokens}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': tokens, 'total_tokens': tokens},
+        }).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _stream(self, handler, body):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+
+        def send(data):
+            event = f"data: {data}\n\n".encode()
+            handler.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            handler.wfile.flush()
+
+        time.sleep(self.first_token_ms / 1000)
+        send(json.dumps(self._chunk(body, {'role': 'assistant', 'content': ''})))
+        for i in range(self._tokens(body)):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            send(json.dumps(self._chunk(body, {'content': ' word'})))
+        send(json.dumps(self._chunk(body, {}, 'stop')))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            tokens = self._tokens(body)
+            send(json.dumps(dict(self._chunk(body, {}), choices=[], usage={
+                'prompt_tokens': 0, 'completion_tokens': tokens, 'total_tokens': tokens})))
+        send('[DONE]')
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='fake-llm')
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def use_fake_llm(server):
+    """Point the shared OpenAI clients of the model registry at `server`."""
+    from modules.models import register
+
+    def load_client():
+        from openai import OpenAI
+        return OpenAI(api_key='benchmark', base_url=server.base_url)
+
+    def load_async_client():
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key='benchmark', base_url=server.base_url)
+
+    register('openai', load_client)
+    register('openai_async', load_async_client)
+
+
+def summarize(seconds):
+    """Latency percentiles in milliseconds of a list of durations in seconds."""
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(values):
+        return {'count': 0}
+    return {
+        'count': int(len(values)),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished child processes."""
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KiB elsewhere
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20,
+    }
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _stage(seconds, items, unit):
+    return {'seconds': seconds, 'items': items, 'unit': unit,
+            'per_second': items / seconds if seconds > 0 else None}
+
+
+def bench_ingestion(paths, scratch_dir):
+    """
+    Ingest each PDF stage by stage (extraction, OCR, embeddings, indexing)
+    and then through the progressive pipeline the app uses. Both start from
+    an empty OCR cache below `scratch_dir`, so OCR is measured rather than
+    cache reads. Returns the results and the ProgressiveIngestion jobs for
+    the query benchmark.
+    """
+    from modules import ocr
+    from modules.bm25 import BM25Index
+    from modules.embeddings import get_image_embeddings, get_text_embeddings
+    from modules.ingestion import ProgressiveIngestion
+    from modules.pdf_processor import count_pages, extract_text_and_images
+    from modules.vector_db import VectorDB
+
+    totals = {}
+
+    def add(name, seconds, items, unit):
+        total = totals.setdefault(name, {'seconds': 0.0, 'items': 0, 'unit': unit})
+        total['seconds'] += seconds
+        total['items'] += items
+
+    jobs = []
+    documents = []
+    ocr_cache_dir = ocr.OCR_CACHE_DIR
+    for i, path in enumerate(paths):
+        pages = count_pages(path)
+        ocr.OCR_CACHE_DIR = os.path.join(scratch_dir, f"ocr-stages-{i}")
+        (text_data, image_data), seconds = _timed(extract_text_and_images, path)
+        add('extract', seconds, pages, 'pages')
+        _, seconds = _timed(ocr.ocr_images, image_data)
+        add('ocr', seconds, len(image_data), 'images')
+        texts = [chunk['text'] for chunk in text_data]
+        text_embeddings, seconds = _timed(get_text_embeddings, texts)
+        add('text_embeddings', seconds, len(texts), 'chunks')
+        (image_embeddings, image_ids), seconds = _timed(get_image_embeddings, image_data)
+        add('image_embeddings', seconds, len(image_data), 'images')
+
+        start = time.perf_counter()
+        text_db = VectorDB(text_embeddings.shape[1])
+        text_db.add(text_embeddings)
+        if len(image_embeddings):
+            VectorDB(image_embeddings.shape[1]).add(image_embeddings, image_ids)
+        BM25Index().add(texts)
+        add('indexing', time.perf_counter() - start, len(texts) + len(image_data), 'vectors')
+
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        ocr.OCR_CACHE_DIR = os.path.join(scratch_dir, f"ocr-pipeline-{i}")
+        start = time.perf_counter()
+        job = ProgressiveIngestion(pdf_bytes, name=os.path.basename(path))
+        job.wait()
+        seconds = time.perf_counter() - start
+        if job.error:
+            raise RuntimeError(f"Ingestion of {path} failed: {job.error}")
+        add('pipeline', seconds, pages, 'pages')
+        jobs.append(job)
+        documents.append({'path': os.path.basename(path), 'pages': pages, 'chunks': len(text_data),
+                          'images': len(image_data), 'pipeline_seconds': seconds})
+    ocr.OCR_CACHE_DIR = ocr_cache_dir
+
+    stages = {name: _stage(total['seconds'], total['items'], total['unit']) for name, total in totals.items()}
+    return {'documents': documents, 'stages': stages, 'peak_rss_mb': peak_rss_mb()}, jobs
+
+
+def bench_queries(jobs, queries, concurrency=1):
+    """
+    Run each query through retrieval, context packing and the streamed
+    answer, as the app does, from `concurrency` threads at once.
+    """
+    from modules.context import CONTEXT_CANDIDATES, build_context
+    from modules.embeddings import query_batching_stats
+    from modules.llm import context_budget
+    from modules.orchestrator import QueryOrchestrator
+
+    def ask(query):
+        orchestrator = QueryOrchestrator(jobs)
+        start = time.perf_counter()
+        found = orchestrator.retrieve_sync(query, k=CONTEXT_CANDIDATES)
+        retrieved = time.perf_counter()
+        images = [{'page': image['page'], 'description': description}
+                  for image, description in zip(found['images'], found['image_descriptions'])]
+        chunks = found['chunks']
+        candidates = [{'text': jobs[chunks.doc[idx]].text_data[chunks.local[idx]]['text'],
+                       'page': int(chunks.page[idx]), 'bbox': tuple(chunks.bbox[idx])}
+                      for idx in found['text_ids']]
+        lines, _ = build_context(candidates, context_budget(query, images))
+        packed = time.perf_counter()
+        stats = {}
+        answer = ''.join(orchestrator.stream_answer(query, '\n'.join(lines), images, stats))
+        end = time.perf_counter()
+        return {
+            'stages': dict(orchestrator.timings, context=packed - retrieved),
+            'retrieval': retrieved - start,
+            'first_token': stats.get('time_to_first_token'),
+            'answer': stats.get('total_time'),
+            'total': end - start,
+            'answer_chars': len(answer),
+            'degraded': sorted(orchestrator.degraded),
+        }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='benchmark-query') as pool:
+        results = list(pool.map(ask, queries))
+    seconds = time.perf_counter() - start
+
+    stages = {}
+    for result in results:
+        for name, value in result['stages'].items():
+            stages.setdefault(name, []).append(value)
+    degraded = {}
+    for result in results:
+        for name in result['degraded']:
+            degraded[name] = degraded.get(name, 0) + 1
+    return {
+        'queries': len(results),
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'queries_per_second': len(results) / seconds if seconds > 0 else None,
+        'latency': {name: summarize([r[name] for r in results if r[name] is not None])
+                    for name in ('retrieval', 'first_token', 'answer', 'total')},
+        'stages': {name: summarize(values) for name, values in stages.items()},
+        'degraded': degraded,
+        'batching': query_batching_stats(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(documents=1, pages=20, words_per_page=400, images_per_page=1, queries=20,
+                  concurrency=1, first_token_ms=300, token_ms=10, response_tokens=200, seed=0,
+                  work_dir=None):
+    """
+    Generate synthetic PDFs, ingest them and run queries against a fake LLM.
+
+    Returns a JSON-serializable dict with the configuration, the machine,
+    and per-stage throughput, latency percentiles and peak RSS for
+    ingestion and querying.
+    """
+    config = {key: value for key, value in locals().items() if key != 'work_dir'}
+    settings = {key: value for key, value in sorted(os.environ.items()) if key.startswith('OMNIQUERY_')}
+    temp_dir = tempfile.TemporaryDirectory(prefix='omniquery-bench-')
+    work_dir = work_dir or temp_dir.name
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        vocabulary = make_vocabulary(seed=seed)
+        paths = []
+        for i in range(documents):
+            path = os.path.join(work_dir, f"synthetic-{i}.pdf")
+            make_pdf(path, pages, words_per_page, images_per_page, seed=seed + i, vocabulary=vocabulary)
+            paths.append(path)
+
+        # Keep the generated images out of the app's asset store
+        from modules.asset_store import AssetStore
+        from modules.models import register
+        register('asset_store', lambda: AssetStore(os.path.join(temp_dir.name, 'assets')))
+        ingestion, jobs = bench_ingestion(paths, temp_dir.name)
+        with FakeLLMServer(first_token_ms, token_ms, response_tokens) as server:
+            use_fake_llm(server)
+            querying = bench_queries(jobs, make_queries(queries, vocabulary, seed), concurrency)
+    finally:
+        temp_dir.cleanup()
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': time.time(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'settings': settings,
+        'config': config,
+        'ingestion': ingestion,
+        'querying': querying,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ingestion and querying on synthetic PDFs '
+                                                 'with a local stand-in for the LLM.')
+    parser.add_argument('--documents', type=int, default=1)
+    parser.add_argument('--pages', type=int, default=20, help='pages per document')
+    parser.add_argument('--words-per-page', type=int, default=400)
+    parser.add_argument('--images-per-page', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1, help='queries in flight at once')
+    parser.add_argument('--first-token-ms', type=float, default=300, help='fake LLM latency to the first token')
+    parser.add_argument('--token-ms', type=float, default=10, help='fake LLM latency between tokens')
+    parser.add_argument('--response-tokens', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='keep the generated PDFs here instead of a temporary directory')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.documents, args.pages, args.words_per_page, args.images_per_page,
+                            args.queries, args.concurrency, args.first_token_ms, args.token_ms,
+                            args.response_tokens, args.seed, args.work_dir)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+        print(f"Results written to {args.output}")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
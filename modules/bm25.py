@@ -0,0 +1,122 @@
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+# Words, plus compounds such as part numbers and error codes ("AB-1234", "E.102")
+_TOKEN_RE = re.compile(r'\w+(?:[-./:]\w+)*')
+_SPLIT_RE = re.compile(r'[-./:]')
+
+def tokenize(text):
+    """
+    Lower-case word tokens of `text`.
+
+    Compound tokens are kept whole and also split into their parts, so
+    "AB-1234" matches both "AB-1234" and "1234".
+    """
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        parts = _SPLIT_RE.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+class BM25Index:
+    """
+    In-memory inverted index with Okapi BM25 scoring.
+
+    Documents can be added incrementally while the index is being queried;
+    each document is identified by an integer id (by default its insertion
+    position, matching the ids used by VectorDB).
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(lambda: ([], []))  # term -> (doc ids, term frequencies)
+        self._doc_ids = []
+        self._doc_lengths = []
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def add(self, texts, ids=None):
+        """Index a batch of texts, optionally under explicit ids."""
+        with self._lock:
+            if ids is None:
+                start = self._doc_ids[-1] + 1 if self._doc_ids else 0
+                ids = range(start, start + len(texts))
+            for doc_id, text in zip(ids, texts):
+                position = len(self._doc_ids)
+                tokens = tokenize(text)
+                counts = defaultdict(int)
+                for token in tokens:
+                    counts[token] += 1
+                for token, count in counts.items():
+                    postings = self._postings[token]
+                    postings[0].append(position)
+                    postings[1].append(count)
+                self._doc_ids.append(int(doc_id))
+                self._doc_lengths.append(len(tokens))
+                self._total_length += len(tokens)
+
+    def save(self, path):
+        """Write the index statistics to the .npz file `path`."""
+        with self._lock:
+            terms = list(self._postings)
+            sizes = [len(self._postings[term][0]) for term in terms]
+            np.savez(path,
+                     terms=np.array(terms, dtype=str),
+                     offsets=np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]),
+                     positions=np.array([p for term in terms for p in self._postings[term][0]], dtype=np.int64),
+                     frequencies=np.array([f for term in terms for f in self._postings[term][1]], dtype=np.int64),
+                     doc_ids=np.array(self._doc_ids, dtype=np.int64),
+                     doc_lengths=np.array(self._doc_lengths, dtype=np.int64),
+                     params=np.array([self.k1, self.b]))
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by `save`, without re-tokenizing any text."""
+        with np.load(path) as data:
+            k1, b = data['params']
+            index = cls(float(k1), float(b))
+            offsets = data['offsets']
+            positions = data['positions'].tolist()
+            frequencies = data['frequencies'].tolist()
+            for term, start, stop in zip(data['terms'].tolist(), offsets[:-1], offsets[1:]):
+                index._postings[term] = (positions[start:stop], frequencies[start:stop])
+            index._doc_ids = data['doc_ids'].tolist()
+            index._doc_lengths = data['doc_lengths'].tolist()
+        index._total_length = sum(index._doc_lengths)
+        return index
+
+    def search(self, query, k=5):
+        """Return `(ids, scores)` of the k best-scoring documents for `query`."""
+        with self._lock:
+            n_docs = len(self._doc_ids)
+            if n_docs == 0:
+                return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+            doc_lengths = np.asarray(self._doc_lengths, dtype=np.float32)
+            avg_length = self._total_length / n_docs
+            terms = [(token, self._postings[token]) for token in set(tokenize(query))
+                     if token in self._postings]
+            terms = [(np.asarray(postings[0]), np.asarray(postings[1], dtype=np.float32))
+                     for token, postings in terms]
+            doc_ids = np.asarray(self._doc_ids, dtype=np.int64)
+
+        scores = np.zeros(n_docs, dtype=np.float32)
+        for positions, tf in terms:
+            df = len(positions)
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_lengths[positions] / avg_length)
+            scores[positions] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        top = matched[np.argsort(-scores[matched], kind='stable')[:k]]
+        return doc_ids[top], scores[top]
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Values of the `type` column: page text, OCR text from an image, an image
+CHUNK_TYPES = ('text', 'ocr', 'image')
+
+
+class ChunkStore:
+    """
+    Metadata of the chunks (or images) of one or more documents, held in
+    columnar arrays instead of lists of dicts.
+
+    Row i describes global id i: the position of its document (`doc`), its
+    id within that document (`local`), its `page`, `bbox` and a `type` code
+    indexing CHUNK_TYPES. `offsets[d]` is the first row of document d, so
+    `offsets[d] + local` is a global id.
+    """
+
+    def __init__(self, doc, local, page, bbox, type, offsets):
+        self.doc = doc
+        self.local = local
+        self.page = page
+        self.bbox = bbox
+        self.type = type
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.doc)
+
+    @classmethod
+    def from_records(cls, records, default_type='text'):
+        """Build the store of a single document from its chunk or image dicts."""
+        n = len(records)
+        ocr, default = CHUNK_TYPES.index('ocr'), CHUNK_TYPES.index(default_type)
+        return cls(
+            doc=np.zeros(n, dtype=np.int32),
+            local=np.arange(n, dtype=np.int32),
+            page=np.fromiter((record['page'] for record in records), dtype=np.int32, count=n),
+            bbox=np.array([record['bbox'] for record in records], dtype=np.float32).reshape(n, 4),
+            type=np.fromiter((ocr if record.get('source') == 'image' else default for record in records),
+                             dtype=np.int8, count=n),
+            offsets=np.array([0, n], dtype=np.int64),
+        )
+
+    @classmethod
+    def concat(cls, stores):
+        """Stack single-document stores; document d of the result is `stores[d]`."""
+        stores = list(stores)
+        if not stores:
+            return cls.from_records([])
+        sizes = np.array([len(store) for store in stores], dtype=np.int64)
+        return cls(
+            doc=np.repeat(np.arange(len(stores), dtype=np.int32), sizes),
+            local=np.concatenate([store.local for store in stores]),
+            page=np.concatenate([store.page for store in stores]),
+            bbox=np.concatenate([store.bbox for store in stores]),
+            type=np.concatenate([store.type for store in stores]),
+            offsets=np.concatenate([[0], np.cumsum(sizes)]),
+        )
+
+    def extend(self, records, default_type='text'):
+        """Return a single-document store with `records` appended to this one's rows."""
+        added = ChunkStore.from_records(records, default_type)
+        n = len(self) + len(added)
+        return ChunkStore(
+            doc=np.zeros(n, dtype=np.int32),
+            local=np.arange(n, dtype=np.int32),
+            page=np.concatenate([self.page, added.page]),
+            bbox=np.concatenate([self.bbox, added.bbox]),
+            type=np.concatenate([self.type, added.type]),
+            offsets=np.array([0, n], dtype=np.int64),
+        )
+
+    def rows(self, doc):
+        """Slice of the rows of document `doc`."""
+        return slice(int(self.offsets[doc]), int(self.offsets[doc + 1]))
+
+    def page_mask(self, first=None, last=None):
+        """Boolean mask of the rows on pages `first`..`last` (inclusive, 1-based)."""
+        mask = np.ones(len(self), dtype=bool)
+        if first is not None:
+            mask &= self.page >= first
+        if last is not None:
+            mask &= self.page <= last
+        return mask
+
+    def reading_order(self, ids):
+        """Sort global ids by document, page and vertical position."""
+        ids = np.asarray(ids, dtype=np.int64)
+        return ids[np.lexsort((self.bbox[ids, 1], self.page[ids], self.doc[ids]))]
+
+    def save(self, path):
+        np.savez(path, page=self.page, bbox=self.bbox, type=self.type)
+
+    @classmethod
+    def load(cls, path):
+        """Load a single-document store written by `save`."""
+        with np.load(path) as data:
+            n = len(data['page'])
+            return cls(np.zeros(n, dtype=np.int32), np.arange(n, dtype=np.int32),
+                       data['page'], data['bbox'], data['type'], np.array([0, n], dtype=np.int64))
@@ -0,0 +1,104 @@
+import os
+
+from modules.tokens import get_tokenizer
+
+# Target size of a chunk in the tokens of modules.tokens (cl100k), the unit
+# the prompt budget is counted in. MiniLM reads at most 256 of its own word
+# pieces, usually a few more per text than cl100k tokens, so the end of a
+# full chunk may miss its embedding; the overlap repeats it in the next one
+CHUNK_TOKENS = int(os.getenv('OMNIQUERY_CHUNK_TOKENS', '200'))
+# Tokens repeated at the start of a window that continues the previous one
+CHUNK_OVERLAP = int(os.getenv('OMNIQUERY_CHUNK_OVERLAP', '40'))
+# Sections smaller than this (headings, captions, stray lines) are merged
+# into the section that follows them
+MIN_CHUNK_TOKENS = int(os.getenv('OMNIQUERY_MIN_CHUNK_TOKENS', '40'))
+# A vertical gap larger than this many times the smaller of the two block
+# heights starts a new section
+SECTION_GAP = float(os.getenv('OMNIQUERY_SECTION_GAP', '1.5'))
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def _starts_section(previous, block):
+    """Whether the layout puts `block` in a different section from `previous`."""
+    px0, py0, px1, py1 = previous['bbox']
+    x0, y0, x1, y1 = block['bbox']
+    # No horizontal overlap: another column (or a side note)
+    if x1 < px0 or x0 > px1:
+        return True
+    # Above the previous block: the reading order jumped, e.g. to a new column
+    if y0 < py0:
+        return True
+    line_height = max(1.0, min(py1 - py0, y1 - y0))
+    return y0 - py1 > SECTION_GAP * line_height
+
+def _sections(blocks, tokenizer, min_tokens):
+    """Group consecutive blocks into sections by layout, merging tiny sections forward."""
+    sections = []
+    for block in blocks:
+        # The leading space separates blocks once their tokens are joined
+        tokens = tokenizer.encode(' ' + block['text'])
+        if not tokens:
+            continue
+        if sections and not _starts_section(sections[-1]['blocks'][-1], block):
+            sections[-1]['blocks'].append(block)
+            sections[-1]['tokens'].append(tokens)
+        else:
+            sections.append({'blocks': [block], 'tokens': [tokens]})
+
+    merged = []
+    carry = None
+    for section in sections:
+        if carry is not None:
+            section = {'blocks': carry['blocks'] + section['blocks'],
+                       'tokens': carry['tokens'] + section['tokens']}
+            carry = None
+        if sum(map(len, section['tokens'])) < min_tokens:
+            carry = section
+        else:
+            merged.append(section)
+    if carry is not None:
+        if merged:
+            merged[-1]['blocks'] += carry['blocks']
+            merged[-1]['tokens'] += carry['tokens']
+        else:
+            merged.append(carry)
+    return merged
+
+def chunk_page(blocks, page, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP,
+               min_tokens=MIN_CHUNK_TOKENS):
+    """
+    Turn the text blocks of one page into chunks of at most `max_tokens`.
+
+    `blocks` are dicts with `text` and `bbox`, in reading order. Blocks are
+    grouped into sections by layout (column and vertical gaps); each section
+    is cut into windows of `max_tokens` that overlap by `overlap` tokens.
+    Each chunk has `text`, `page`, `bbox` (the union of the blocks it draws
+    from) and `tokens`.
+    """
+    tokenizer = get_tokenizer()
+    stride = max(1, max_tokens - overlap)
+    chunks = []
+    for section in _sections(blocks, tokenizer, min_tokens):
+        tokens = []
+        owners = []
+        for block, block_tokens in zip(section['blocks'], section['tokens']):
+            tokens.extend(block_tokens)
+            owners.extend([block['bbox']] * len(block_tokens))
+
+        start = 0
+        while True:
+            stop = min(start + max_tokens, len(tokens))
+            text = tokenizer.decode(tokens[start:stop]).strip()
+            if text:
+                chunks.append({
+                    'text': ' '.join(text.split()),
+                    'page': page,
+                    'bbox': _union(dict.fromkeys(owners[start:stop])),
+                    'tokens': stop - start,
+                })
+            if stop == len(tokens):
+                break
+            start += stride
+    return chunks
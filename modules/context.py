@@ -0,0 +1,51 @@
+import os
+
+from modules.tokens import count_tokens
+
+# Upper bound on the tokens of retrieved text sent to the LLM
+CONTEXT_TOKENS = int(os.getenv('OMNIQUERY_CONTEXT_TOKENS', '3000'))
+# Chunks retrieved per question and offered to the context builder
+CONTEXT_CANDIDATES = int(os.getenv('OMNIQUERY_CONTEXT_CANDIDATES', '20'))
+
+def _source(chunk, show_doc):
+    if show_doc and chunk.get('doc'):
+        return f"{chunk['doc']}, page {chunk['page']}"
+    return f"Page {chunk['page']}"
+
+def format_context(chunks, show_doc=False):
+    """
+    Format chunks as one "Page N: text" line per page, in reading order.
+
+    Chunks are sorted by document, page and vertical position, and chunks
+    of the same page are joined. Returns the list of lines.
+    """
+    chunks = sorted(chunks, key=lambda chunk: (chunk.get('doc') or '', chunk['page'], chunk['bbox'][1]))
+    lines = []
+    current = None
+    for chunk in chunks:
+        key = (chunk.get('doc'), chunk['page'])
+        if key != current:
+            lines.append([_source(chunk, show_doc), []])
+            current = key
+        lines[-1][1].append(chunk['text'])
+    return [f"{source}: {' '.join(texts)}" for source, texts in lines]
+
+def build_context(chunks, budget=CONTEXT_TOKENS, show_doc=False):
+    """
+    Pack the best chunks into `budget` tokens of context.
+
+    `chunks` are ordered best first. They are taken in that order while
+    they fit; a chunk that does not fit is skipped so that smaller ones
+    further down can still use the space. Each chunk is charged for its
+    text plus its own page label, which bounds the formatted size since
+    chunks on the same page share a label. Returns `(lines, used)`: the
+    formatted context lines and the positions of the packed chunks.
+    """
+    used = []
+    remaining = budget
+    for position, chunk in enumerate(chunks):
+        cost = count_tokens(f"{_source(chunk, show_doc)}: {chunk['text']}\n")
+        if cost <= remaining:
+            used.append(position)
+            remaining -= cost
+    return format_context([chunks[position] for position in used], show_doc), used
@@ -0,0 +1,206 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from functools import cached_property
+
+import numpy as np
+
+from modules.asset_store import AssetStore
+from modules.ingestion import IngestionCache
+from modules.vector_db import VectorDB
+from modules.bm25 import BM25Index
+from modules.chunk_store import ChunkStore
+
+# Directory written by `python -m modules.batch_ingest` and loaded by the app
+CORPUS_DIR = os.getenv('OMNIQUERY_CORPUS_DIR', 'corpus')
+CORPUS_MANIFEST = 'corpus.json'
+SHARDS_DIR = 'shards'
+# Images of all shards, stored once per content hash and never evicted
+ASSETS_DIR = 'assets'
+# Written last into a shard, so its presence means the shard is complete
+SHARD_FILE = 'shard.json'
+TEXT_INDEX_DIR = 'text_index'
+IMAGE_INDEX_DIR = 'image_index'
+TEXT_CHUNKS_FILE = 'text_chunks.npz'
+IMAGE_CHUNKS_FILE = 'image_chunks.npz'
+BM25_FILE = 'bm25.npz'
+
+
+def shard_path(corpus_dir, doc_hash):
+    return os.path.join(corpus_dir, SHARDS_DIR, doc_hash)
+
+
+def corpus_assets(corpus_dir):
+    return AssetStore(os.path.join(corpus_dir, ASSETS_DIR), max_bytes=None)
+
+
+def read_shard_info(corpus_dir, doc_hash):
+    """Return the summary of a complete shard, or None if it was never finished."""
+    try:
+        with open(os.path.join(shard_path(corpus_dir, doc_hash), SHARD_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_json(path, data):
+    """Write JSON atomically so readers never see a partial file."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def write_shard(corpus_dir, document, info):
+    """
+    Persist one ingested document as a corpus shard.
+
+    The shard holds the document in the ingestion cache layout plus a saved
+    VectorDB and a ChunkStore per modality, the BM25 statistics of its text
+    chunks, and finally `SHARD_FILE` with
+    `info` and the embedding dimensions. Returns the shard summary.
+    """
+    doc_hash = document['hash']
+    shards = IngestionCache(os.path.join(corpus_dir, SHARDS_DIR), max_entries=0,
+                            assets=corpus_assets(corpus_dir))
+    if not shards.put(doc_hash, document):
+        raise IOError(f"Could not write shard {doc_hash}")
+
+    path = shard_path(corpus_dir, doc_hash)
+    info = dict(info, hash=doc_hash, chunks=len(document['text_data']),
+                images=len(document['image_data']))
+    for name, index_dir in (('text_embeddings', TEXT_INDEX_DIR), ('image_embeddings', IMAGE_INDEX_DIR)):
+        embeddings = np.asarray(document[name], dtype=np.float32)
+        dim_key = name.replace('embeddings', 'dim')
+        info[dim_key] = int(embeddings.shape[1]) if embeddings.ndim == 2 and len(embeddings) else None
+        if info[dim_key] is not None:
+            db = VectorDB(info[dim_key])
+            # Unreadable images have no vector, so image ids skip them
+            db.add(embeddings, document['image_ids'] if name == 'image_embeddings' else None)
+            db.save(os.path.join(path, index_dir))
+    ChunkStore.from_records(document['text_data']).save(os.path.join(path, TEXT_CHUNKS_FILE))
+    ChunkStore.from_records(document['image_data'], 'image').save(os.path.join(path, IMAGE_CHUNKS_FILE))
+    bm25 = BM25Index()
+    bm25.add([chunk['text'] for chunk in document['text_data']])
+    bm25.save(os.path.join(path, BM25_FILE))
+    write_json(os.path.join(path, SHARD_FILE), info)
+    return info
+
+
+def read_manifest(corpus_dir):
+    """
+    Return the corpus manifest: `documents` maps hash to shard summary,
+    `files` maps source path to its hash, size and mtime, and `failed` maps
+    source path to the last error and the size and mtime it was raised for.
+    """
+    try:
+        with open(os.path.join(corpus_dir, CORPUS_MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'documents': {}, 'files': {}, 'failed': {}}
+
+
+class CorpusShard:
+    """
+    One pre-indexed document of a corpus.
+
+    Exposes the same attributes as an ingestion job (`hash`, `name`, `date`,
+    `page_count`, `text_data`, `image_data`, `text_chunks`, `image_chunks`,
+    `text_db`, `image_db`, `bm25`, `done`); everything is read from disk on
+    first access, with the indexes memory-mapped.
+    """
+
+    done = True
+    error = None
+
+    def __init__(self, corpus_dir, info):
+        self.info = info
+        self.hash = info['hash']
+        self.path = shard_path(corpus_dir, self.hash)
+        self.assets = corpus_assets(corpus_dir)
+        self.name = os.path.basename(info.get('path') or self.hash)
+        self.page_count = info.get('pages', 0)
+        # Shards without a creation date in their metadata fall back to the
+        # time they were ingested
+        self.date = info.get('date') or info.get('ingested_at')
+
+    @cached_property
+    def _document(self):
+        with open(os.path.join(self.path, 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    @cached_property
+    def text_data(self):
+        return self._document['text_data']
+
+    @cached_property
+    def image_data(self):
+        # Records point at their files; the bytes are read (and decoded
+        # images cached) only when an image is used
+        return [dict(img, path=self.assets.path(img['hash'])) for img in self._document['image_data']]
+
+    def _load_chunks(self, filename, records, default_type):
+        path = os.path.join(self.path, filename)
+        if os.path.exists(path):
+            return ChunkStore.load(path)
+        return ChunkStore.from_records(records(), default_type)
+
+    @cached_property
+    def text_chunks(self):
+        return self._load_chunks(TEXT_CHUNKS_FILE, lambda: self.text_data, 'text')
+
+    @cached_property
+    def image_chunks(self):
+        return self._load_chunks(IMAGE_CHUNKS_FILE, lambda: self._document['image_data'], 'image')
+
+    def _load_index(self, index_dir):
+        path = os.path.join(self.path, index_dir)
+        return VectorDB.load(path, mmap=True) if os.path.exists(path) else None
+
+    @cached_property
+    def text_db(self):
+        return self._load_index(TEXT_INDEX_DIR)
+
+    @cached_property
+    def image_db(self):
+        return self._load_index(IMAGE_INDEX_DIR)
+
+    @cached_property
+    def bm25(self):
+        path = os.path.join(self.path, BM25_FILE)
+        if os.path.exists(path):
+            return BM25Index.load(path)
+        # Shards written before the statistics were saved
+        bm25 = BM25Index()
+        bm25.add([chunk['text'] for chunk in self.text_data])
+        return bm25
+
+
+class Corpus:
+    """The shards of a corpus directory, in ingestion order, keyed by document hash."""
+
+    def __init__(self, corpus_dir=CORPUS_DIR):
+        self.corpus_dir = corpus_dir
+        self.manifest = read_manifest(corpus_dir)
+        self.shards = OrderedDict(
+            (doc_hash, CorpusShard(corpus_dir, info))
+            for doc_hash, info in self.manifest['documents'].items())
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __contains__(self, doc_hash):
+        return doc_hash in self.shards
+
+    def __getitem__(self, doc_hash):
+        return self.shards[doc_hash]
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Return the corpus in `corpus_dir`, or None if nothing has been ingested there."""
+    if not os.path.exists(os.path.join(corpus_dir, CORPUS_MANIFEST)):
+        return None
+    return Corpus(corpus_dir)
@@ -0,0 +1,267 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from modules.models import get_model
+
+# "torch" runs the original PyTorch models; "onnx" runs exported ONNX
+# Runtime graphs (see `python -m modules.embedding_backends export`)
+EMBEDDING_BACKEND = os.getenv('OMNIQUERY_EMBEDDING_BACKEND', 'torch')
+ONNX_DIR = os.getenv('OMNIQUERY_ONNX_DIR', os.path.join('.cache', 'onnx'))
+ONNX_QUANTIZED = os.getenv('OMNIQUERY_ONNX_QUANTIZED', '1') == '1'
+ONNX_THREADS = int(os.getenv('OMNIQUERY_ONNX_THREADS', '0'))
+# Minimum cosine similarity to the PyTorch embeddings for an export to pass
+VALIDATION_THRESHOLD = float(os.getenv('OMNIQUERY_ONNX_MIN_COSINE', '0.98'))
+
+TEXT_MAX_LENGTH = 256
+TEXT_BATCH_SIZE = 32
+
+ONNX_MODELS = ('text_model', 'clip_vision', 'clip_text')
+
+class TorchBackend:
+    """Embeds with the PyTorch SentenceTransformer and CLIP models."""
+
+    name = 'torch'
+    # Tensor type requested from the CLIP processor
+    tensor_type = 'pt'
+
+    def text_embeddings(self, texts):
+        return get_model('text_model').encode(texts)
+
+    def clip_image_embeddings(self, inputs):
+        import torch
+
+        with torch.inference_mode():
+            emb = get_model('clip_model').get_image_features(**inputs)
+        return emb.cpu().numpy()
+
+    def clip_text_embeddings(self, texts):
+        import torch
+
+        inputs = get_model('clip_processor')(text=texts, return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            emb = get_model('clip_model').get_text_features(**inputs)
+        return emb.cpu().numpy()
+
+class OnnxBackend:
+    """
+    Embeds with ONNX Runtime graphs exported by `export_onnx`.
+
+    By default the int8 dynamically quantized graphs are used. torch is not
+    imported by this backend.
+    """
+
+    name = 'onnx'
+    tensor_type = 'np'
+
+    def __init__(self, model_dir=ONNX_DIR, quantized=ONNX_QUANTIZED, threads=ONNX_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self._options = ort.SessionOptions()
+        self._options.intra_op_num_threads = threads
+        self._sessions = {}
+        self._tokenizer = AutoTokenizer.from_pretrained(os.path.join(model_dir, 'text_tokenizer'))
+
+    def _session(self, name):
+        # Sessions are created on first use so text-only documents never load CLIP
+        if name not in self._sessions:
+            import onnxruntime as ort
+
+            path = _onnx_path(self.model_dir, name, self.quantized)
+            self._sessions[name] = ort.InferenceSession(
+                path, self._options, providers=['CPUExecutionProvider'])
+        return self._sessions[name]
+
+    def text_embeddings(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        embeddings = []
+        for start in range(0, len(texts), TEXT_BATCH_SIZE):
+            inputs = self._tokenizer(texts[start:start + TEXT_BATCH_SIZE], padding=True, truncation=True,
+                                     max_length=TEXT_MAX_LENGTH, return_tensors='np')
+            hidden, = self._session('text_model').run(None, {
+                'input_ids': inputs['input_ids'].astype(np.int64),
+                'attention_mask': inputs['attention_mask'].astype(np.int64),
+            })
+            # Mean pooling over real tokens, then L2 normalisation, as in
+            # the SentenceTransformer pipeline
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            embeddings.append(pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12))
+        return np.vstack(embeddings)
+
+    def clip_image_embeddings(self, inputs):
+        emb, = self._session('clip_vision').run(None, {
+            'pixel_values': np.asarray(inputs['pixel_values'], dtype=np.float32),
+        })
+        return emb
+
+    def clip_text_embeddings(self, texts):
+        inputs = get_model('clip_processor')(text=texts, return_tensors="np", padding=True)
+        emb, = self._session('clip_text').run(None, {
+            'input_ids': inputs['input_ids'].astype(np.int64),
+            'attention_mask': inputs['attention_mask'].astype(np.int64),
+        })
+        return emb
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'onnx': OnnxBackend,
+}
+
+def load_backend(name=EMBEDDING_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {name!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
+
+def _onnx_path(model_dir, name, quantized):
+    return os.path.join(model_dir, f"{name}.int8.onnx" if quantized else f"{name}.onnx")
+
+def export_onnx(output_dir=ONNX_DIR, quantize=True):
+    """
+    Export MiniLM and both CLIP towers to ONNX, optionally with int8 dynamic
+    quantization of the weights, and save the text tokenizer next to them.
+    """
+    import torch
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    class ClipVision(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+    class ClipText(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    os.makedirs(output_dir, exist_ok=True)
+    text_model = get_model('text_model')
+    clip_model = get_model('clip_model')
+    clip_processor = get_model('clip_processor')
+
+    tokenizer = text_model.tokenizer
+    tokenizer.save_pretrained(os.path.join(output_dir, 'text_tokenizer'))
+    text_inputs = tokenizer(['export sample'], return_tensors='pt', padding=True)
+    clip_text_inputs = clip_processor(text=['export sample'], return_tensors='pt', padding=True)
+    pixel_values = torch.zeros(1, 3, 224, 224)
+    token_axes = {0: 'batch', 1: 'sequence'}
+
+    exports = {
+        'text_model': (TextEncoder(text_model[0].auto_model),
+                       (text_inputs['input_ids'], text_inputs['attention_mask']),
+                       ['input_ids', 'attention_mask'], ['last_hidden_state'],
+                       {'input_ids': token_axes, 'attention_mask': token_axes, 'last_hidden_state': token_axes}),
+        'clip_vision': (ClipVision(clip_model), (pixel_values,),
+                        ['pixel_values'], ['image_embeds'],
+                        {'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}}),
+        'clip_text': (ClipText(clip_model),
+                      (clip_text_inputs['input_ids'], clip_text_inputs['attention_mask']),
+                      ['input_ids', 'attention_mask'], ['text_embeds'],
+                      {'input_ids': token_axes, 'attention_mask': token_axes, 'text_embeds': {0: 'batch'}}),
+    }
+    for name, (module, args, input_names, output_names, dynamic_axes) in exports.items():
+        path = _onnx_path(output_dir, name, quantized=False)
+        with torch.inference_mode():
+            torch.onnx.export(module.eval(), args, path, input_names=input_names,
+                              output_names=output_names, dynamic_axes=dynamic_axes, opset_version=17)
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(path, _onnx_path(output_dir, name, quantized=True), weight_type=QuantType.QInt8)
+
+def _sample_images():
+    """A few synthetic images that exercise colour, texture and flat regions."""
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    gradient = np.tile(np.linspace(0, 255, 224, dtype=np.uint8), (224, 1))
+    return [
+        Image.fromarray(np.stack([gradient, gradient.T, 255 - gradient], axis=-1)),
+        Image.fromarray(rng.integers(0, 256, (224, 224, 3), dtype=np.uint8)),
+        Image.new('RGB', (320, 200), (30, 90, 160)),
+    ]
+
+SAMPLE_TEXTS = [
+    'What is the maximum operating pressure of the pump?',
+    'Error code E-1042 indicates a sensor failure.',
+    'The quarterly report shows revenue growth in all regions.',
+    'A diagram of the system architecture with three services.',
+]
+
+def _cosine(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return (a * b).sum(axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+def validate_backend(backend, reference=None, texts=SAMPLE_TEXTS, images=None,
+                     threshold=VALIDATION_THRESHOLD):
+    """
+    Compare a backend's embeddings with the reference (PyTorch) backend.
+
+    Returns a dict with the minimum and mean cosine similarity per embedding
+    type and whether every minimum reaches `threshold`.
+    """
+    reference = reference or TorchBackend()
+    images = images if images is not None else _sample_images()
+    processor = get_model('clip_processor')
+
+    pairs = {
+        'text': (reference.text_embeddings(texts), backend.text_embeddings(texts)),
+        'clip_text': (reference.clip_text_embeddings(texts), backend.clip_text_embeddings(texts)),
+        'clip_image': (
+            reference.clip_image_embeddings(processor(images=images, return_tensors=reference.tensor_type)),
+            backend.clip_image_embeddings(processor(images=images, return_tensors=backend.tensor_type)),
+        ),
+    }
+    report = {}
+    for name, (expected, actual) in pairs.items():
+        cosine = _cosine(expected, actual)
+        report[name] = {'min_cosine': float(cosine.min()), 'mean_cosine': float(cosine.mean())}
+    report['passed'] = all(result['min_cosine'] >= threshold for result in report.values())
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export and validate ONNX embedding models.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='export, quantize and validate the models')
+    export_parser.add_argument('--output-dir', default=ONNX_DIR)
+    export_parser.add_argument('--no-quantize', action='store_true')
+    export_parser.add_argument('--threshold', type=float, default=VALIDATION_THRESHOLD)
+    validate_parser = subparsers.add_parser('validate', help='validate previously exported models')
+    validate_parser.add_argument('--output-dir', default=ONNX_DIR)
+    validate_parser.add_argument('--no-quantize', action='store_true')
+    validate_parser.add_argument('--threshold', type=float, default=VALIDATION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        export_onnx(args.output_dir, quantize=not args.no_quantize)
+    report = validate_backend(OnnxBackend(args.output_dir, quantized=not args.no_quantize),
+                              threshold=args.threshold)
+    for name, result in report.items():
+        if name != 'passed':
+            print(f"{name}: min cosine {result['min_cosine']:.4f}, mean {result['mean_cosine']:.4f}")
+    print('PASSED' if report['passed'] else f"FAILED (threshold {args.threshold})")
+    return 0 if report['passed'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
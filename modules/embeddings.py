@@ -1,34 +1,137 @@
-from sentence_transformers import SentenceTransformer
-from transformers import CLIPProcessor, CLIPModel
-import torch
-from PIL import Image
 import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from modules.models import get_model, is_loaded
+from modules.tracing import bind, traced
+from modules.asset_store import load_image
+from modules.utils import open_image
 
-# Load models
-text_model = SentenceTransformer("all-MiniLM-L6-v2")
-clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+# Number of images sent through CLIP in one forward pass
+IMAGE_BATCH_SIZE = int(os.getenv('OMNIQUERY_IMAGE_BATCH_SIZE', '32'))
+# Number of batches decoded and preprocessed ahead of the model
+IMAGE_PREFETCH_BATCHES = int(os.getenv('OMNIQUERY_IMAGE_PREFETCH', '2'))
+# Batch concurrent query embeddings from all sessions (see modules.batching)
+QUERY_BATCHING = os.getenv('OMNIQUERY_QUERY_BATCHING', '1') == '1'
 
+# Models are loaded lazily through the shared registry in modules.models;
+# these names stay importable from here for existing callers
+_LAZY_MODELS = ('text_model', 'clip_processor', 'clip_model')
+
+def __getattr__(name):
+    if name in _LAZY_MODELS:
+        return get_model(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@traced('embed.text', items=0)
 def get_text_embeddings(texts):
     """
     Generate embeddings for a list of text strings.
     """
-    return text_model.encode(texts)
+    return get_model('embedding_backend').text_embeddings(texts)
 
-def get_image_embeddings(image_paths):
+@traced('embed.clip_text', items=0)
+def get_clip_text_embeddings(texts):
     """
-    Generate embeddings for a list of image file paths.
-    Skips invalid paths and returns an empty array if no valid images are found.
+    Generate CLIP text embeddings, used to search the image index with a query.
     """
-    embeddings = []
-    for path in image_paths:
+    return get_model('embedding_backend').clip_text_embeddings(texts)
+
+def submit_text_query(query):
+    """
+    Return a Future of the text embedding of one query.
+
+    With QUERY_BATCHING the query joins a micro-batch shared with the
+    queries of every other session; otherwise it is encoded on its own in
+    the query encoder pool, so the caller never blocks on the model.
+    """
+    if QUERY_BATCHING:
+        return get_model('text_query_batcher').submit(query)
+    return get_model('query_encoder_pool').submit(bind(lambda: get_text_embeddings([query])[0]))
+
+def submit_clip_query(query):
+    """Like `submit_text_query`, for the CLIP text embedding used to search images."""
+    if QUERY_BATCHING:
+        return get_model('clip_query_batcher').submit(query)
+    return get_model('query_encoder_pool').submit(bind(lambda: get_clip_text_embeddings([query])[0]))
+
+def warm_up_query_encoders():
+    """
+    Load the text and CLIP encoders by embedding a dummy query, so the first
+    real query's encode stages do not spend their timeout loading models.
+    """
+    get_text_embeddings(['warm up'])
+    get_clip_text_embeddings(['warm up'])
+
+def query_batching_stats():
+    """Batch size and queue wait metrics of the query batchers that have been used."""
+    return {name: get_model(name).stats() for name in ('text_query_batcher', 'clip_query_batcher')
+            if is_loaded(name)}
+
+def _prepare_image_batch(sources, start):
+    """
+    Decode and preprocess one batch, skipping images that cannot be read.
+    Returns the model inputs and the positions (counted from `start`) of the
+    images they hold.
+    """
+    images = []
+    positions = []
+    for position, source in enumerate(sources, start):
         try:
-            # Attempt to open the image file
-            image = Image.open(path)
-            inputs = clip_processor(images=image, return_tensors="pt")
-            emb = clip_model.get_image_features(**inputs).detach().numpy()
-            embeddings.append(emb)
+            # Image records come decoded from the asset store
+            image = load_image(source) if isinstance(source, dict) else open_image(source)
+            if image is None:
+                raise FileNotFoundError('asset is no longer stored')
+            images.append(image.convert("RGB"))
+            positions.append(position)
         except Exception as e:
-            # Skip invalid paths or non-image files
-            print(f"Skipping invalid image path: {path}. Error: {e}")
-    return np.vstack(embeddings) if embeddings else np.array([])
\ No newline at end of file
+            label = source if isinstance(source, str) else source.get('hash') if isinstance(source, dict) \
+                else type(source).__name__
+            print(f"Skipping invalid image: {label}. Error: {e}")
+    if not images:
+        return None, positions
+    tensor_type = get_model('embedding_backend').tensor_type
+    return get_model('clip_processor')(images=images, return_tensors=tensor_type), positions
+
+@traced('embed.image', items=0)
+def get_image_embeddings(images, batch_size=IMAGE_BATCH_SIZE, prefetch=IMAGE_PREFETCH_BATCHES):
+    """
+    Generate CLIP embeddings for a list of images.
+
+    Each item may be a file path, raw image bytes, a PIL image or an image
+    record (served from the asset store). Images are
+    decoded and preprocessed on a thread pool while the previous batch runs
+    through the model.
+
+    Returns `(embeddings, indices)`: invalid or no longer stored images are
+    skipped, so row i of the embeddings belongs to `images[indices[i]]`.
+    """
+    images = list(images)
+    if not images:
+        return np.array([]), np.array([], dtype=np.int64)
+    backend = get_model('embedding_backend')
+    batches = iter([(images[i:i + batch_size], i) for i in range(0, len(images), batch_size)])
+    embeddings = []
+    indices = []
+
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as pool:
+        pending = deque()
+        for _ in range(max(1, prefetch)):
+            batch = next(batches, None)
+            if batch is None:
+                break
+            pending.append(pool.submit(_prepare_image_batch, *batch))
+
+        while pending:
+            inputs, positions = pending.popleft().result()
+            # Keep the prefetcher busy while this batch is in the model
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(pool.submit(_prepare_image_batch, *batch))
+            if inputs is None:
+                continue
+            embeddings.append(backend.clip_image_embeddings(inputs))
+            indices.extend(positions)
+
+    return (np.vstack(embeddings) if embeddings else np.array([]),
+            np.array(indices, dtype=np.int64))
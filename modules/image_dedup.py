@@ -0,0 +1,145 @@
+import os
+from modules.utils import open_image
+
+# Maximum Hamming distance between perceptual hashes for two images to be
+# treated as the same picture (0 only merges visually identical images)
+PHASH_MAX_DISTANCE = int(os.getenv('OMNIQUERY_PHASH_MAX_DISTANCE', '0'))
+# Images with close perceptual hashes are only merged if their aspect ratios
+# differ by at most this fraction and their colour thumbnails by at most this
+# mean difference per channel (0-255)
+ASPECT_TOLERANCE = float(os.getenv('OMNIQUERY_DEDUP_ASPECT_TOLERANCE', '0.05'))
+THUMB_MAX_DIFFERENCE = float(os.getenv('OMNIQUERY_DEDUP_THUMB_MAX_DIFFERENCE', '8'))
+THUMB_SIZE = 8
+
+def perceptual_hash(image, hash_size=8):
+    """
+    Compute a 64-bit difference hash (dHash) of an image.
+
+    The image is reduced to a (hash_size + 1) x hash_size grayscale thumbnail
+    and each bit records whether a pixel is brighter than its right neighbour,
+    so re-encoded or re-scaled copies of the same picture hash identically.
+    """
+    with open_image(image) as img:
+        return _dhash(img, hash_size)
+
+def image_fingerprint(image):
+    """
+    Return the `phash` of an image together with its `size` and a small
+    colour `thumb` (hex), which tell apart images the dHash alone cannot:
+    every flat or horizontally constant image hashes to 0, whatever its
+    colour.
+    """
+    with open_image(image) as img:
+        thumb = img.convert('RGB').resize((THUMB_SIZE, THUMB_SIZE)).tobytes()
+        return {'phash': _dhash(img, 8), 'size': list(img.size), 'thumb': thumb.hex()}
+
+def _dhash(img, hash_size):
+    pixels = list(img.convert('L').resize((hash_size + 1, hash_size)).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | int(left > right)
+    return value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+def same_picture(a, b):
+    """
+    Whether two image records with close perceptual hashes show the same
+    picture: their aspect ratios and colour thumbnails must match too.
+    Records without a fingerprint are never taken for the same picture.
+    """
+    if not (a.get('size') and b.get('size') and a.get('thumb') and b.get('thumb')):
+        return False
+    (width_a, height_a), (width_b, height_b) = a['size'], b['size']
+    aspect_a, aspect_b = width_a / max(height_a, 1), width_b / max(height_b, 1)
+    if abs(aspect_a - aspect_b) > ASPECT_TOLERANCE * max(aspect_a, aspect_b):
+        return False
+    thumb_a, thumb_b = bytes.fromhex(a['thumb']), bytes.fromhex(b['thumb'])
+    if len(thumb_a) != len(thumb_b):
+        return False
+    return sum(abs(x - y) for x, y in zip(thumb_a, thumb_b)) / len(thumb_a) <= THUMB_MAX_DIFFERENCE
+
+class ImageDeduplicator:
+    """
+    Collapse repeated image occurrences into unique images.
+
+    Occurrences are matched first by PDF xref, then by exact content hash and
+    finally by perceptual hash, confirmed by `same_picture`. Each unique image keeps the first occurrence's
+    record and accumulates every (page, bbox) it appears at under
+    `occurrences`.
+    """
+
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.images = []
+        self._by_xref = {}
+        self._by_hash = {}
+        self._by_phash = {}
+
+    def add(self, image):
+        """
+        Register one image occurrence.
+
+        Returns the new unique image record, or None if the occurrence was
+        merged into an image seen before.
+        """
+        occurrences = image.get('occurrences') or [{'page': image['page'], 'bbox': image['bbox']}]
+        existing = self._find_exact(image)
+        if existing is None:
+            if image.get('phash') is None:
+                image = dict(image, **self._fingerprint(image))
+            existing = self._find_similar(image)
+
+        if existing is not None:
+            existing['occurrences'].extend(occurrences)
+            self._index(existing, image)
+            return None
+
+        record = dict(image, occurrences=list(occurrences))
+        self.images.append(record)
+        self._index(record, record)
+        return record
+
+    def extend(self, images):
+        """Register several occurrences and return the ones that were new."""
+        return [record for record in map(self.add, images) if record is not None]
+
+    def _fingerprint(self, image):
+        try:
+            return image_fingerprint(image['data'])
+        except Exception as e:
+            print(f"Could not hash image on page {image['page']}: {e}")
+            return {'phash': None}
+
+    def _find_exact(self, image):
+        if image.get('xref') in self._by_xref:
+            return self._by_xref[image['xref']]
+        return self._by_hash.get(image.get('hash'))
+
+    def _find_similar(self, image):
+        phash = image['phash']
+        if phash is None:
+            return None
+        for record in self._by_phash.get(phash, ()):
+            if same_picture(image, record):
+                return record
+        if self.max_distance > 0:
+            for candidate, records in self._by_phash.items():
+                if candidate != phash and hamming_distance(phash, candidate) <= self.max_distance:
+                    for record in records:
+                        if same_picture(image, record):
+                            return record
+        return None
+
+    def _index(self, record, image):
+        if image.get('xref') is not None:
+            self._by_xref.setdefault(image['xref'], record)
+        if image.get('hash') is not None:
+            self._by_hash.setdefault(image['hash'], record)
+        # Only unique images are candidates; a merged occurrence matches them already
+        if image is record and image.get('phash') is not None:
+            self._by_phash.setdefault(image['phash'], []).append(record)
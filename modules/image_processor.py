@@ -1,45 +1,49 @@
-import os
-from PIL import Image
-import pytesseract
-from typing import List, Dict
+from typing import Any, Dict, List
+from modules.ocr import extract_text_from_image
+from modules.asset_store import load_image
 
-def process_images(image_paths: List[str]) -> List[Dict[str, str]]:
+def process_images(images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
-    Process a list of image paths and return their descriptions and paths.
-    
+    Process a list of extracted images and return their descriptions and pages.
+
+    OCR text is taken from the record (filled in at ingestion time) or from
+    the OCR cache, so no Tesseract work happens here for ingested images.
+
     Args:
-        image_paths (List[str]): List of paths to image files
-        
+        images (List[Dict[str, Any]]): Image records from the PDF extractor,
+            holding the content hash under "hash" and the page number under "page"
+
     Returns:
-        List[Dict[str, str]]: List of dictionaries containing image descriptions and paths
+        List[Dict[str, Any]]: List of dictionaries containing image descriptions and pages
     """
     processed_images = []
-    
-    for path in image_paths:
-        if not os.path.exists(path):
-            continue
-            
+
+    for image in images:
         try:
-            # Open and analyze the image
-            with Image.open(path) as img:
-                # Extract text from image using OCR (if any)
-                text = pytesseract.image_to_string(img).strip()
-                
-                # Get basic image information
-                width, height = img.size
-                format_type = img.format
-                
-                # Create image description
-                description = f"Image ({format_type}, {width}x{height}px)"
-                if text:
-                    description += f" - Contains text: {text[:100]}..."
-                
-                processed_images.append({
-                    "path": path,
-                    "description": description
-                })
+            # Look up the text found in the image by OCR (if any)
+            text = image.get("ocr_text")
+            if text is None:
+                text = extract_text_from_image(image).strip()
+
+            # Decoded once and shared through the asset store; not closed here
+            img = load_image(image)
+            if img is None:
+                raise FileNotFoundError(f"image {image['hash']} is no longer stored")
+            # Get basic image information
+            width, height = img.size
+            format_type = img.format
+
+            # Create image description
+            description = f"Image ({format_type}, {width}x{height}px)"
+            if text:
+                description += f" - Contains text: {text[:100]}..."
+
+            processed_images.append({
+                "page": image["page"],
+                "description": description
+            })
         except Exception as e:
-            print(f"Error processing image {path}: {str(e)}")
+            print(f"Error processing image on page {image.get('page')}: {str(e)}")
             continue
-    
+
     return processed_images
@@ -0,0 +1,473 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from modules.pdf_processor import (PDF_WORKERS, clean_text, count_pages, document_date,
+                                   extract_text_and_images, iter_pages)
+from modules.image_dedup import ImageDeduplicator
+from modules.chunker import chunk_page
+from modules.ocr import OCR_WORKERS, ocr_images
+from modules.embeddings import get_text_embeddings, get_image_embeddings
+from modules.vector_db import VectorDB
+from modules.bm25 import BM25Index
+from modules.chunk_store import ChunkStore
+from modules.asset_store import get_asset_store, image_bytes, store_images
+from modules.models import get_model
+from modules.tracing import record, record_cache, span
+
+CACHE_DIR = os.getenv('OMNIQUERY_CACHE_DIR', os.path.join('.cache', 'ingestion'))
+MAX_MEMORY_ENTRIES = int(os.getenv('OMNIQUERY_CACHE_ENTRIES', '4'))
+MANIFEST_FILE = 'manifest.json'
+# Add the text found in images by OCR to the text index as extra chunks
+INDEX_OCR_TEXT = os.getenv('OMNIQUERY_INDEX_OCR_TEXT', '1') == '1'
+# Pages per batch flowing through the progressive ingestion pipeline
+INGEST_BATCH_PAGES = int(os.getenv('OMNIQUERY_INGEST_BATCH_PAGES', '8'))
+# Batches each pipeline stage may run ahead of the next one
+INGEST_QUEUE_SIZE = int(os.getenv('OMNIQUERY_INGEST_QUEUE_SIZE', '4'))
+# Finished ingestion jobs the app keeps in memory; running ones are never dropped
+MAX_INGESTION_JOBS = int(os.getenv('OMNIQUERY_INGESTION_JOBS', '8'))
+
+
+def compute_document_hash(data):
+    """Return the SHA-256 hex digest of the raw document bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class IngestionCache:
+    """
+    Two-level cache of ingested documents keyed by content hash.
+
+    Recently used documents are held in memory (LRU); every document is also
+    written to disk as `.npy` embedding matrices and a JSON manifest, with
+    its images in `assets` (the shared AssetStore by default), so a process
+    restart does not re-parse or re-embed it. An entry whose images were
+    evicted from the asset store is a miss.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=MAX_MEMORY_ENTRIES, assets=None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._assets = assets
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_hash):
+        with self._lock:
+            if doc_hash in self._entries:
+                self._entries.move_to_end(doc_hash)
+                record_cache('ingestion', 'memory')
+                return self._entries[doc_hash]
+
+        document = self._load(doc_hash)
+        record_cache('ingestion', 'miss' if document is None else 'disk')
+        if document is not None:
+            self._remember(doc_hash, document)
+        return document
+
+    def put(self, doc_hash, document):
+        """Store a document; returns whether it was written to disk."""
+        saved = self._save(doc_hash, document)
+        if saved:
+            # Swap the in-memory matrices for memory-mapped views of the files
+            path = self._path(doc_hash)
+            for name in ('text_embeddings', 'image_embeddings'):
+                document[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        self._remember(doc_hash, document)
+        return saved
+
+    @property
+    def assets(self):
+        return self._assets or get_asset_store()
+
+    def __contains__(self, doc_hash):
+        with self._lock:
+            if doc_hash in self._entries:
+                return True
+        return os.path.exists(os.path.join(self._path(doc_hash), MANIFEST_FILE))
+
+    def _path(self, doc_hash):
+        return os.path.join(self.cache_dir, doc_hash)
+
+    def _remember(self, doc_hash, document):
+        with self._lock:
+            self._entries[doc_hash] = document
+            self._entries.move_to_end(doc_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _save(self, doc_hash, document):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write into a scratch directory and rename it into place so readers
+        # never see a half-written entry.
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix=f'.{doc_hash}-')
+        try:
+            np.save(os.path.join(staging, 'text_embeddings.npy'), document['text_embeddings'])
+            np.save(os.path.join(staging, 'image_embeddings.npy'), document['image_embeddings'])
+            np.save(os.path.join(staging, 'image_ids.npy'), document['image_ids'])
+            # Images are stored once per content hash in the asset store
+            image_data = []
+            for img in document['image_data']:
+                if img['hash'] not in self.assets:
+                    data = image_bytes(img)
+                    if data is None:
+                        raise FileNotFoundError(f"image {img['hash']} is no longer stored")
+                    self.assets.put(data)
+                image_data.append({key: value for key, value in img.items() if key not in ('data', 'path')})
+
+            manifest = {
+                'hash': doc_hash,
+                'text_data': document['text_data'],
+                'image_data': image_data,
+            }
+            with open(os.path.join(staging, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+
+            target = self._path(doc_hash)
+            if os.path.exists(target):
+                shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+            return True
+        except Exception as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            print(f"Failed to write ingestion cache for {doc_hash}: {e}")
+            return False
+
+    def _load(self, doc_hash):
+        path = self._path(doc_hash)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if any(img['hash'] not in self.assets for img in manifest['image_data']):
+                return None
+            return {
+                'hash': doc_hash,
+                'text_data': manifest['text_data'],
+                'image_data': manifest['image_data'],
+                # Memory-mapped so cached documents do not hold full-precision
+                # matrices in RAM once their vectors are indexed
+                'text_embeddings': np.load(os.path.join(path, 'text_embeddings.npy'), mmap_mode='r'),
+                'image_embeddings': np.load(os.path.join(path, 'image_embeddings.npy'), mmap_mode='r'),
+                'image_ids': np.load(os.path.join(path, 'image_ids.npy')),
+            }
+        except Exception as e:
+            print(f"Ignoring unreadable ingestion cache entry {doc_hash}: {e}")
+            return None
+
+
+def ocr_chunks(image_data):
+    """Turn the OCR text of images into text chunks so figure text is searchable."""
+    chunks = []
+    for img in image_data:
+        text = clean_text(img.get('ocr_text', ''))
+        if text:
+            # Text-heavy images (scanned pages, tables) are split like page text
+            for chunk in chunk_page([{'text': text, 'bbox': tuple(img['bbox'])}], img['page']):
+                chunks.append(dict(chunk, source='image'))
+    return chunks
+
+
+def _write_temp_pdf(pdf_bytes):
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
+        temp_pdf.write(pdf_bytes)
+        return temp_pdf.name
+
+
+def ingest_path(pdf_path, doc_hash, pdf_workers=PDF_WORKERS, ocr_workers=OCR_WORKERS):
+    """
+    Parse, OCR and embed the PDF at `pdf_path`.
+
+    Returns a dict with the document hash, text chunks, image metadata,
+    both embedding matrices and `image_ids`, the positions in `image_data`
+    of the image embeddings (unreadable images have none).
+    """
+    text_data, image_data = extract_text_and_images(pdf_path, workers=pdf_workers)
+
+    # OCR every unique image once, now, instead of on each question
+    ocr_texts = ocr_images(image_data, workers=ocr_workers)
+    for img in image_data:
+        img['ocr_text'] = ocr_texts.get(img['hash'], '')
+    if INDEX_OCR_TEXT:
+        text_data = text_data + ocr_chunks(image_data)
+
+    image_embeddings, image_ids = get_image_embeddings(image_data)
+    return {
+        'hash': doc_hash,
+        'text_data': text_data,
+        'image_data': image_data,
+        'text_embeddings': get_text_embeddings([chunk["text"] for chunk in text_data]),
+        'image_embeddings': image_embeddings,
+        'image_ids': image_ids,
+    }
+
+
+def _stack(matrices):
+    matrices = [m for m in matrices if len(m)]
+    return np.vstack(matrices) if matrices else np.array([])
+
+
+class ProgressiveIngestion:
+    """
+    Ingest a PDF in the background, indexing it page batch by page batch.
+
+    Extraction, text embedding, image OCR and embedding, and index insertion
+    run as separate threads connected by bounded queues. Each batch is
+    appended to `text_db`, `image_db` and `bm25` as soon as it is embedded,
+    so the document can be searched while later pages are still being
+    processed. `text_data` and `image_data` grow together with the indexes:
+    every id returned by a search is already a valid position in them.
+
+    When the whole document is indexed the result is written to `cache`. A
+    document that is already cached is loaded and indexed at once.
+    """
+
+    def __init__(self, pdf_bytes, cache=None, name=None, batch_pages=INGEST_BATCH_PAGES,
+                 queue_size=INGEST_QUEUE_SIZE):
+        self.hash = compute_document_hash(pdf_bytes)
+        self.name = name or self.hash[:12]
+        # Like corpus shards, documents without a creation date fall back
+        # to the time they were ingested
+        self.date = document_date(pdf_bytes) or time.time()
+        self.cache = cache
+        self.batch_pages = batch_pages
+        self.text_data = []
+        self.image_data = []
+        self._text_chunks = ChunkStore.from_records([])
+        self._image_chunks = ChunkStore.from_records([], 'image')
+        self.text_db = None
+        self.image_db = None
+        self.bm25 = BM25Index()
+        self.page_count = 0
+        self.pages_done = 0
+        self.error = None
+        self._text_embeddings = []
+        self._image_embeddings = []
+        self._image_ids = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(3)]
+        self._threads = []
+
+        document = cache.get(self.hash) if cache is not None else None
+        if document is not None:
+            self._from_document(document)
+            return
+
+        self._pdf_path = _write_temp_pdf(pdf_bytes)
+        try:
+            self.page_count = count_pages(self._pdf_path)
+        except Exception:
+            os.remove(self._pdf_path)
+            raise
+        extract, embed_text, embed_images = self._queues
+        self._start(self._extract, None, extract)
+        self._start(self._stage, self._embed_text, extract, embed_text)
+        self._start(self._stage, self._embed_images, embed_text, embed_images)
+        self._start(self._index, embed_images)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def progress(self):
+        """Fraction of pages that are searchable, between 0 and 1."""
+        if self.done:
+            return 1.0
+        return self.pages_done / self.page_count if self.page_count else 0.0
+
+    @property
+    def text_chunks(self):
+        """ChunkStore of the chunks indexed so far, extended batch by batch."""
+        return self._text_chunks
+
+    @property
+    def image_chunks(self):
+        return self._image_chunks
+
+    def wait(self, timeout=None):
+        """Block until ingestion has finished; returns whether it did."""
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        """Stop ingesting; the job then counts as failed and can be started again."""
+        if not self.done:
+            self._fail(RuntimeError('ingestion was cancelled'))
+
+    def document(self):
+        """Return the ingested document in the format of `ingest_path`."""
+        with self._lock:
+            return {
+                'hash': self.hash,
+                'text_data': list(self.text_data),
+                'image_data': list(self.image_data),
+                'text_embeddings': _stack(self._text_embeddings),
+                'image_embeddings': _stack(self._image_embeddings),
+                'image_ids': np.concatenate(self._image_ids) if self._image_ids else np.array([], dtype=np.int64),
+            }
+
+    def _from_document(self, document):
+        self.page_count = self.pages_done = max(
+            [chunk['page'] for chunk in document['text_data']] +
+            [img['page'] for img in document['image_data']], default=0)
+        self._add({
+            'pages': 0,
+            'text_data': document['text_data'],
+            'images': document['image_data'],
+            'text_embeddings': document['text_embeddings'],
+            'image_embeddings': document['image_embeddings'],
+            'image_ids': document['image_ids'],
+        })
+        self._done.set()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True,
+                                  name=f'ingest-{target.__name__.strip("_")}')
+        thread.start()
+        self._threads.append(thread)
+
+    def _put(self, outbox, item):
+        # Time out regularly so a failed or cancelled pipeline never deadlocks
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, inbox):
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+            print(f"Ingestion of {self.hash} failed: {error}")
+        self._stop.set()
+
+    def _extract(self, inbox, outbox):
+        """Source stage: group extracted pages into batches of new chunks and images."""
+        images = ImageDeduplicator()
+        batch = None
+        start = time.perf_counter()
+        try:
+            for page in iter_pages(self._pdf_path):
+                if self._stop.is_set():
+                    break
+                if batch is None:
+                    batch = {'pages': 0, 'text_data': [], 'images': []}
+                batch['pages'] += 1
+                batch['text_data'].extend(page['text_data'])
+                # Repeats of earlier images only add occurrences to them; new
+                # ones keep just their hash, with the bytes in the asset store
+                batch['images'].extend(store_images(images.extend(page['image_data'])))
+                if batch['pages'] == self.batch_pages:
+                    record('pdf.extract', start, items=batch['pages'])
+                    self._put(outbox, batch)
+                    batch = None
+                    start = time.perf_counter()
+            if batch is not None:
+                record('pdf.extract', start, items=batch['pages'])
+                self._put(outbox, batch)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(outbox, None)
+            if os.path.exists(self._pdf_path):
+                os.remove(self._pdf_path)
+
+    def _stage(self, work, inbox, outbox):
+        try:
+            while True:
+                batch = self._get(inbox)
+                if batch is None:
+                    break
+                work(batch)
+                self._put(outbox, batch)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(outbox, None)
+
+    def _embed_text(self, batch):
+        texts = [chunk['text'] for chunk in batch['text_data']]
+        batch['text_embeddings'] = get_text_embeddings(texts) if texts else np.array([])
+
+    def _embed_images(self, batch):
+        images = batch['images']
+        if not images:
+            batch['image_embeddings'], batch['image_ids'] = np.array([]), np.array([], dtype=np.int64)
+            return
+        # One long-lived pool serves every batch of every job
+        ocr_texts = ocr_images(images, pool=get_model('ocr_pool'))
+        for img in images:
+            img['ocr_text'] = ocr_texts.get(img['hash'], '')
+        if INDEX_OCR_TEXT:
+            chunks = ocr_chunks(images)
+            if chunks:
+                batch['text_data'] = batch['text_data'] + chunks
+                batch['text_embeddings'] = _stack([
+                    np.asarray(batch['text_embeddings'], dtype=np.float32),
+                    np.asarray(get_text_embeddings([chunk['text'] for chunk in chunks]), dtype=np.float32),
+                ])
+        # Images that could not be read (or were evicted meanwhile) get no vector
+        batch['image_embeddings'], batch['image_ids'] = get_image_embeddings(images)
+
+    def _index(self, inbox):
+        try:
+            while True:
+                batch = self._get(inbox)
+                if batch is None:
+                    break
+                with span('ingest.index', items=len(batch['text_data']) + len(batch['images'])):
+                    self._add(batch)
+        except Exception as e:
+            self._fail(e)
+        if self._stop.is_set():
+            return
+        if self.cache is not None:
+            self.cache.put(self.hash, self.document())
+        self._done.set()
+
+    def _add(self, batch):
+        """Append one embedded batch to the metadata lists and the indexes."""
+        text_embeddings = np.asarray(batch['text_embeddings'], dtype=np.float32)
+        image_embeddings = np.asarray(batch['image_embeddings'], dtype=np.float32)
+        with self._lock:
+            # Extend the metadata first so searches never return unknown ids
+            start = len(self.text_data)
+            self.text_data.extend(batch['text_data'])
+            image_start = len(self.image_data)
+            self.image_data.extend(batch['images'])
+            self._text_chunks = self._text_chunks.extend(batch['text_data'])
+            self._image_chunks = self._image_chunks.extend(batch['images'], 'image')
+            if len(text_embeddings):
+                if self.text_db is None:
+                    self.text_db = VectorDB(text_embeddings.shape[1])
+                self.text_db.add(text_embeddings, np.arange(start, start + len(text_embeddings)))
+                self._text_embeddings.append(text_embeddings)
+            if len(image_embeddings):
+                if self.image_db is None:
+                    self.image_db = VectorDB(image_embeddings.shape[1])
+                image_ids = image_start + np.asarray(batch['image_ids'], dtype=np.int64)
+                self.image_db.add(image_embeddings, image_ids)
+                self._image_embeddings.append(image_embeddings)
+                self._image_ids.append(image_ids)
+            self.pages_done += batch['pages']
+        self.bm25.add([chunk['text'] for chunk in batch['text_data']],
+                      range(start, start + len(batch['text_data'])))
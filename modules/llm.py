@@ -1,10 +1,24 @@
-from openai import OpenAI
 import os
-from dotenv import load_dotenv
+import time
+from modules.models import get_model
+from modules.context import CONTEXT_TOKENS
+from modules.tokens import count_tokens
+from modules.tracing import METRICS, record, record_usage, span
 
-# Load API key from .env
-load_dotenv()
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+MODEL = 'gpt-4'
+TEMPERATURE = 0.7
+# Context window of MODEL, and the part of it reserved for the answer
+MAX_PROMPT_TOKENS = int(os.getenv('OMNIQUERY_MAX_PROMPT_TOKENS', '8192'))
+RESPONSE_TOKENS = int(os.getenv('OMNIQUERY_RESPONSE_TOKENS', '1024'))
+# Chat formatting overhead per message and per request
+MESSAGE_OVERHEAD_TOKENS = 4
+REQUEST_OVERHEAD_TOKENS = 3
+
+def __getattr__(name):
+    # The OpenAI client is created on first use by the model registry
+    if name == 'client':
+        return get_model('openai')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def enhance_query(prompt):
     """Enhance generic queries with more specific instructions."""
@@ -13,18 +27,7 @@ def enhance_query(prompt):
         return enhanced_prompt
     return prompt
 
-def generate_response(prompt, context, images=None):
-    # Enhance the query if it's too generic
-    enhanced_prompt = enhance_query(prompt)
-    
-    # Prepare image context if provided
-    image_context = ''
-    if images:
-        image_context = '\nAvailable Images:\n'
-        for idx, img in enumerate(images):
-            image_context += f'[Image {idx + 1}]: {img["description"]} (Path: {img["path"]})\n'
-    
-    system_prompt = '''
+SYSTEM_PROMPT = '''
     You are an expert document analyst with deep subject matter expertise. When responding to queries about the uploaded document:
 
     **Core Principles:**
@@ -100,13 +103,86 @@ def generate_response(prompt, context, images=None):
     - Varied sentence structure
     - Strategic emphasis (bold key terms)
     '''
+
+def build_messages(prompt, context, images=None):
+    """Build the chat messages sent to the LLM for a question and its retrieved context."""
+    # Enhance the query if it's too generic
+    enhanced_prompt = enhance_query(prompt)
     
-    response = client.chat.completions.create(
-        model='gpt-4',
-        messages=[
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': f'Question: {enhanced_prompt}\n\nAvailable Content:\n{context}{image_context}'},
-        ],
-        temperature=0.7
+    # Prepare image context if provided
+    image_context = ''
+    if images:
+        image_context = '\nAvailable Images:\n'
+        for idx, img in enumerate(images):
+            image_context += f'[Image {idx + 1}]: {img["description"]} (Page {img["page"]})\n'
+
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': f'Question: {enhanced_prompt}\n\nAvailable Content:\n{context}{image_context}'},
+    ]
+
+def count_message_tokens(messages):
+    """Tokens a list of chat messages takes up in the model's context window."""
+    return REQUEST_OVERHEAD_TOKENS + sum(
+        MESSAGE_OVERHEAD_TOKENS + count_tokens(message['content']) for message in messages)
+
+def context_budget(prompt, images=None, limit=CONTEXT_TOKENS):
+    """
+    Tokens available for retrieved text once the system prompt, question,
+    image list and the reserved answer tokens are accounted for, capped at
+    `limit`.
+    """
+    fixed = count_message_tokens(build_messages(prompt, '', images))
+    return max(0, min(limit, MAX_PROMPT_TOKENS - RESPONSE_TOKENS - fixed))
+
+def generate_response(prompt, context, images=None):
+    """Answer a question from its retrieved context in one blocking request."""
+    METRICS.increment('llm_requests_total', mode='complete')
+    with span('llm.generate'):
+        response = get_model('openai').chat.completions.create(
+            model=MODEL,
+            messages=build_messages(prompt, context, images),
+            temperature=TEMPERATURE,
+            max_tokens=RESPONSE_TOKENS
+        )
+    record_usage(getattr(response, 'usage', None))
+    return response.choices[0].message.content
+
+async def astream_response(prompt, context, images=None, stats=None):
+    """
+    Generate a response like `generate_response`, streamed through the
+    shared AsyncOpenAI client and yielding text as it arrives.
+
+    If a `stats` dict is given, it is filled with `time_to_first_token` and
+    `total_time` (seconds) once the stream is consumed.
+    """
+    METRICS.increment('llm_requests_total', mode='stream')
+    start = time.perf_counter()
+    stream = await get_model('openai_async').chat.completions.create(
+        model=MODEL,
+        messages=build_messages(prompt, context, images),
+        temperature=TEMPERATURE,
+        max_tokens=RESPONSE_TOKENS,
+        stream=True,
+        stream_options={'include_usage': True}
     )
-    return response.choices[0].message.content
\ No newline at end of file
+    first_token = None
+    try:
+        async for chunk in stream:
+            record_usage(getattr(chunk, 'usage', None))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter()
+                record('llm.first_token', start)
+            yield delta
+    finally:
+        await stream.close()
+        end = time.perf_counter()
+        record('llm.generate', start, end)
+        if stats is not None:
+            stats['time_to_first_token'] = (first_token or end) - start
+            stats['total_time'] = end - start
@@ -0,0 +1,144 @@
+import gc
+import os
+import threading
+
+TEXT_MODEL_NAME = os.getenv('OMNIQUERY_TEXT_MODEL', 'all-MiniLM-L6-v2')
+CLIP_MODEL_NAME = os.getenv('OMNIQUERY_CLIP_MODEL', 'openai/clip-vit-base-patch32')
+
+# Models are created on first use and then shared by every Streamlit session
+# and thread of the process
+_loaders = {}
+_models = {}
+_locks = {}
+# Shared non-model entries (clients, pools, batchers), left out of the
+# defaults of `warm_up` and `unload`
+_resources = set()
+_registry_lock = threading.Lock()
+
+def register(name, loader, resource=None):
+    """
+    Register (or replace) the function that builds model `name`. With
+    `resource=True` it is a shared client, pool or batcher rather than a
+    model; by default a replaced entry keeps its kind.
+    """
+    with _registry_lock:
+        _loaders[name] = loader
+        _locks.setdefault(name, threading.Lock())
+        if resource is not None:
+            (_resources.add if resource else _resources.discard)(name)
+        dropped = _models.pop(name, None)
+    _close(dropped)
+
+def _close(instance):
+    # Executors and batchers own threads or processes that outlive the last reference
+    shutdown = getattr(instance, 'shutdown', None)
+    if shutdown is not None:
+        shutdown(wait=False)
+
+def get_model(name):
+    """Return the shared instance of model `name`, loading it on first use."""
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _registry_lock:
+        if name not in _loaders:
+            raise KeyError(f"Unknown model {name!r}")
+        lock = _locks[name]
+    # One lock per model so a slow CLIP load does not block the text model
+    with lock:
+        if name not in _models:
+            _models[name] = _loaders[name]()
+        return _models[name]
+
+def is_loaded(name):
+    return name in _models
+
+def warm_up(*names):
+    """Load the given models (all registered models by default) ahead of the first request."""
+    for name in names or [name for name in list(_loaders) if name not in _resources]:
+        get_model(name)
+
+def unload(*names):
+    """
+    Drop the given entries (all loaded models by default) so their memory
+    can be reclaimed; pools and batchers are shut down.
+    """
+    with _registry_lock:
+        dropped = [_models.pop(name, None) for name in names or
+                   [name for name in list(_models) if name not in _resources]]
+    for instance in dropped:
+        _close(instance)
+    gc.collect()
+
+def _load_text_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(TEXT_MODEL_NAME)
+
+def _load_clip_processor():
+    from transformers import CLIPProcessor
+    return CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+
+def _load_clip_model():
+    from transformers import CLIPModel
+    return CLIPModel.from_pretrained(CLIP_MODEL_NAME).eval()
+
+def _load_openai_client():
+    from openai import OpenAI
+    from dotenv import load_dotenv
+    # Load API key from .env
+    load_dotenv()
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+def _load_async_openai_client():
+    from openai import AsyncOpenAI
+    from dotenv import load_dotenv
+    load_dotenv()
+    return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+def _load_embedding_backend():
+    from modules.embedding_backends import load_backend
+    return load_backend()
+
+def _load_text_query_batcher():
+    from modules.batching import MicroBatcher
+    from modules.embeddings import get_text_embeddings
+    return MicroBatcher(get_text_embeddings, name='text-query-batcher')
+
+def _load_clip_query_batcher():
+    from modules.batching import MicroBatcher
+    from modules.embeddings import get_clip_text_embeddings
+    return MicroBatcher(get_clip_text_embeddings, name='clip-query-batcher')
+
+def _load_query_encoder_pool():
+    # Encodes single queries when query batching is turned off
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=int(os.getenv('OMNIQUERY_QUERY_WORKERS', '8')),
+                              thread_name_prefix='query-encoder')
+
+def _load_ocr_pool():
+    # Shared by the ingestion jobs so each page batch does not start its own
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from modules.ocr import OCR_WORKERS
+    return ProcessPoolExecutor(max_workers=max(1, OCR_WORKERS), mp_context=multiprocessing.get_context('spawn'))
+
+def _load_asset_store():
+    from modules.asset_store import AssetStore
+    return AssetStore()
+
+def _load_tokenizer():
+    from modules.tokens import load_tokenizer
+    return load_tokenizer()
+
+register('text_model', _load_text_model)
+register('clip_processor', _load_clip_processor)
+register('clip_model', _load_clip_model)
+register('openai', _load_openai_client, resource=True)
+register('openai_async', _load_async_openai_client, resource=True)
+register('embedding_backend', _load_embedding_backend)
+register('tokenizer', _load_tokenizer)
+register('asset_store', _load_asset_store, resource=True)
+register('text_query_batcher', _load_text_query_batcher, resource=True)
+register('clip_query_batcher', _load_clip_query_batcher, resource=True)
+register('query_encoder_pool', _load_query_encoder_pool, resource=True)
+register('ocr_pool', _load_ocr_pool, resource=True)
@@ -1,5 +1,121 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import pytesseract
-from PIL import Image
+from modules.tracing import record_cache, span
+from modules.asset_store import image_bytes
+from modules.utils import open_image
 
-def extract_text_from_image(image_path):
-    return pytesseract.image_to_string(Image.open(image_path))
\ No newline at end of file
+OCR_CACHE_DIR = os.getenv('OMNIQUERY_OCR_CACHE_DIR', os.path.join('.cache', 'ocr'))
+# Number of worker processes running Tesseract at ingestion time
+OCR_WORKERS = int(os.getenv('OMNIQUERY_OCR_WORKERS', str(os.cpu_count() or 1)))
+
+def _image_hash(image):
+    """Return the content hash of an image record, raw bytes or file path."""
+    if isinstance(image, dict):
+        if image.get('hash'):
+            return image['hash']
+        image = image_bytes(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    return None
+
+def _cache_path(image_hash):
+    return os.path.join(OCR_CACHE_DIR, image_hash[:2], f"{image_hash}.txt")
+
+def get_cached_text(image_hash):
+    """Return the cached OCR text for an image hash, or None if it was never OCR'd."""
+    try:
+        with open(_cache_path(image_hash), encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _store_text(image_hash, text):
+    path = _cache_path(image_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def _run_ocr(image):
+    """Run Tesseract on one image, returning None if it fails."""
+    try:
+        with open_image(image) as img:
+            return pytesseract.image_to_string(img).strip()
+    except Exception as e:
+        print(f"OCR failed: {e}")
+        return None
+
+def ocr_images(images, workers=OCR_WORKERS, pool=None):
+    """
+    OCR a list of image records ahead of time.
+
+    Images whose content hash is already cached are not OCR'd again; the rest
+    run through Tesseract in a process pool and are written to the cache.
+    Callers OCR-ing batch after batch pass a long-lived `pool` to reuse;
+    otherwise one of `workers` processes is created for this call. Returns a
+    dict mapping image hash to its text.
+    """
+    texts = {}
+    missing = {}
+    for image in images:
+        image_hash = _image_hash(image)
+        cached = get_cached_text(image_hash)
+        if cached is not None:
+            texts[image_hash] = cached
+        else:
+            data = image_bytes(image)
+            if data is not None:
+                missing.setdefault(image_hash, data)
+    record_cache('ocr', 'hit', len(texts))
+    record_cache('ocr', 'miss', len(missing))
+
+    if not missing:
+        return texts
+
+    with span('ocr', items=len(missing)):
+        if pool is not None and len(missing) > 1:
+            results = list(pool.map(_run_ocr, missing.values()))
+        elif workers <= 1 or len(missing) == 1:
+            results = [_run_ocr(data) for data in missing.values()]
+        else:
+            # Spawned, not forked, like the shared OCR pool
+            with ProcessPoolExecutor(max_workers=min(workers, len(missing)),
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(_run_ocr, missing.values()))
+
+    for image_hash, text in zip(missing, results):
+        if text is None:
+            continue
+        _store_text(image_hash, text)
+        texts[image_hash] = text
+    return texts
+
+def extract_text_from_image(image):
+    """
+    Return the OCR text of an image, served from the cache when possible.
+
+    Accepts an image record, raw bytes or a file path. Only a cache miss
+    runs Tesseract.
+    """
+    image_hash = _image_hash(image)
+    text = get_cached_text(image_hash) if image_hash else None
+    record_cache('ocr', 'miss' if text is None else 'hit')
+    if text is None:
+        source = image_bytes(image) if isinstance(image, dict) else image
+        if source is None:
+            return ''
+        with span('ocr', items=1):
+            text = _run_ocr(source)
+        if text is None:
+            return ''
+        if image_hash:
+            _store_text(image_hash, text)
+    return text
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from modules.embeddings import submit_clip_query, submit_text_query
+from modules.image_processor import process_images
+from modules.llm import astream_response
+from modules.retriever import CorpusRetriever
+from modules.tracing import bind, bind_coroutine, record
+
+# Seconds each query stage may take before the answer goes ahead without it
+STAGE_TIMEOUTS = {
+    'text_encode': float(os.getenv('OMNIQUERY_TIMEOUT_TEXT_ENCODE', '3')),
+    'clip_encode': float(os.getenv('OMNIQUERY_TIMEOUT_CLIP_ENCODE', '2')),
+    'dense_search': float(os.getenv('OMNIQUERY_TIMEOUT_DENSE_SEARCH', '3')),
+    'lexical_search': float(os.getenv('OMNIQUERY_TIMEOUT_LEXICAL_SEARCH', '3')),
+    'image_search': float(os.getenv('OMNIQUERY_TIMEOUT_IMAGE_SEARCH', '2')),
+    'image_prep': float(os.getenv('OMNIQUERY_TIMEOUT_IMAGE_PREP', '2')),
+    'first_token': float(os.getenv('OMNIQUERY_TIMEOUT_FIRST_TOKEN', '30')),
+    'answer': float(os.getenv('OMNIQUERY_TIMEOUT_ANSWER', '180')),
+}
+# What the answer loses when a stage times out or fails
+DEGRADED = {
+    'text_encode': 'keyword search only',
+    'dense_search': 'keyword search only',
+    'lexical_search': 'semantic search only',
+    'clip_encode': 'no images',
+    'image_search': 'no images',
+    'image_prep': 'no images',
+}
+
+# Threads running the blocking stages (encoders, searches, image prep)
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('OMNIQUERY_QUERY_WORKERS', '8')),
+                               thread_name_prefix='query-stage')
+
+# One event loop for the whole process, so the async OpenAI client and its
+# connection pool are shared by every session
+_loop = None
+_loop_lock = threading.Lock()
+
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name='query-loop').start()
+        return _loop
+
+def run(coroutine):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(bind_coroutine(coroutine), _event_loop()).result()
+
+class QueryOrchestrator:
+    """
+    Runs the stages of a question concurrently, each under its own timeout.
+
+    The MiniLM and CLIP encoders and the BM25 search start together; the
+    dense text search starts as soon as its embedding is ready, the image
+    search as soon as CLIP's is, and image descriptions are prepared in
+    parallel per image. A stage that times out or fails is dropped and the
+    answer goes ahead without it, e.g. without images if CLIP is slow. The
+    stages that were dropped are listed in `degraded`, and `timings` holds
+    the seconds each stage took.
+    """
+
+    def __init__(self, documents, timeouts=None, **retriever_options):
+        self.retriever = CorpusRetriever(documents, **retriever_options)
+        self.timeouts = dict(STAGE_TIMEOUTS, **(timeouts or {}))
+        self.degraded = {}
+        self.timings = {}
+
+    async def _stage(self, name, func, *args):
+        """Run a blocking stage in the thread pool; returns None if it times out or fails."""
+        return await self._await(name, lambda: asyncio.get_running_loop().run_in_executor(
+            _executor, bind(func), *args))
+
+    async def _await(self, name, start_stage):
+        """
+        Await the future returned by `start_stage()` under the timeout of
+        stage `name`; returns None if it times out or fails.
+        """
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(start_stage(), self.timeouts[name])
+        except asyncio.TimeoutError:
+            self.degraded[name] = f"timed out after {self.timeouts[name]:g}s"
+        except Exception as e:
+            print(f"Query stage {name} failed: {e}")
+            self.degraded[name] = f"failed: {e}"
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = end - start
+            record(f'query.{name}', start, end, error=self.degraded.get(name))
+        return None
+
+    async def _text(self, plan, query, k):
+        lexical = asyncio.ensure_future(self._stage('lexical_search', self.retriever.search_lexical, plan, query))
+        # Encoders are shared through micro-batches with the other sessions
+        query_emb = await self._await('text_encode', lambda: asyncio.wrap_future(submit_text_query(query)))
+        dense = None
+        if query_emb is not None:
+            dense = await self._stage('dense_search', self.retriever.search_dense, plan, query_emb)
+        lexical = await lexical
+        empty = np.array([], dtype=np.int64)
+        text_ids, text_scores = self.retriever.fuse(dense[0] if dense is not None else empty,
+                                                    lexical[0] if lexical is not None else empty, k)
+        return text_ids, text_scores, query_emb
+
+    async def _images(self, plan, query, k_images):
+        """Find and describe the images; runs alongside the text stages."""
+        # Shards load their image index from disk on first use
+        has_images = await asyncio.get_running_loop().run_in_executor(
+            _executor, bind(self.retriever.has_images), plan)
+        if not has_images:
+            return []
+        clip_emb = await self._await('clip_encode', lambda: asyncio.wrap_future(submit_clip_query(query)))
+        if clip_emb is None:
+            return []
+        hits = await self._stage('image_search', self.retriever.search_images, plan, clip_emb, k_images)
+        if hits is None:
+            return []
+        images = plan['images']
+        return await self._describe([
+            (idx, self.retriever.documents[images.doc[idx]].image_data[images.local[idx]]) for idx in hits[0]])
+
+    async def _describe(self, hits):
+        """
+        Prepare the descriptions of `(id, image)` hits in parallel, under one
+        shared timeout; returns `(id, image, description)` triples.
+        """
+        if not hits:
+            return []
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        tasks = [loop.run_in_executor(_executor, bind(process_images), [image]) for _, image in hits]
+        _, pending = await asyncio.wait(tasks, timeout=self.timeouts['image_prep'])
+        end = time.perf_counter()
+        self.timings['image_prep'] = end - start
+        if pending:
+            self.degraded['image_prep'] = f"timed out after {self.timeouts['image_prep']:g}s"
+        record('query.image_prep', start, end, items=len(hits), error=self.degraded.get('image_prep'))
+        if pending:
+            return []
+        # process_images skips images it cannot open
+        return [(idx, image, task.result()[0]) for (idx, image), task in zip(hits, tasks) if task.result()]
+
+    async def retrieve(self, query, k=5, k_images=5, doc_hashes=None, pages=None, dates=None):
+        """
+        Retrieve text chunks and images for a question.
+
+        Returns a dict with `text_ids`, `text_scores`, `query_embedding`
+        (None if the encoder was dropped), `chunks` (the ChunkStore the ids
+        index into), and the `image_ids`, `images` (image records) and
+        `image_descriptions` of the images that could be described.
+        """
+        start = time.perf_counter()
+        plan = await asyncio.get_running_loop().run_in_executor(
+            _executor, self.retriever.plan, doc_hashes, pages, dates)
+        text, images = await asyncio.gather(self._text(plan, query, k), self._images(plan, query, k_images))
+        text_ids, text_scores, query_emb = text
+        end = time.perf_counter()
+        self.timings['retrieval'] = end - start
+        record('query.retrieval', start, end)
+        return {
+            'text_ids': text_ids,
+            'text_scores': text_scores,
+            'query_embedding': query_emb,
+            'chunks': plan['chunks'],
+            'image_ids': np.array([idx for idx, _, _ in images], dtype=np.int64),
+            'images': [image for _, image, _ in images],
+            'image_descriptions': [description for _, _, description in images],
+        }
+
+    def notices(self):
+        """One line per dropped stage, saying what the answer had to do without."""
+        return [f"{name.replace('_', ' ').capitalize()} {reason}"
+                + (f" ({DEGRADED[name]})" if name in DEGRADED else '')
+                for name, reason in self.degraded.items()]
+
+    def retrieve_sync(self, *args, **kwargs):
+        return run(self.retrieve(*args, **kwargs))
+
+    def stream_answer(self, prompt, context, images=None, stats=None):
+        """
+        Stream the LLM answer through the async OpenAI client as a plain
+        generator (e.g. for `st.write_stream`).
+
+        If no token arrives within the `first_token` timeout, or the
+        answer is not complete within `answer`, the stream ends with a
+        short notice instead of hanging.
+        """
+        deltas = queue.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async for delta in astream_response(prompt, context, images, stats):
+                    deltas.put(delta)
+            except Exception as e:
+                deltas.put(e)
+            finally:
+                deltas.put(done)
+
+        future = asyncio.run_coroutine_threadsafe(bind_coroutine(produce()), _event_loop())
+        start = time.perf_counter()
+        received = False
+        while True:
+            timeout = self.timeouts['answer'] - (time.perf_counter() - start)
+            if not received:
+                timeout = min(timeout, self.timeouts['first_token'])
+            try:
+                item = deltas.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                future.cancel()
+                stage = 'answer' if received else 'first_token'
+                self.degraded[stage] = f"timed out after {self.timeouts[stage]:g}s"
+                yield "\n\n⚠️ The answer was cut short because the model took too long." if received \
+                    else "⚠️ The model did not respond in time. Please try again."
+                return
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                self.degraded['answer'] = f"failed: {item}"
+                yield f"⚠️ The model request failed: {item}"
+                return
+            received = True
+            yield item
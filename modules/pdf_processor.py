@@ -1,46 +1,170 @@
 import fitz  # PyMuPDF
+import calendar
+import hashlib
+import multiprocessing
 import os
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from modules.image_dedup import ImageDeduplicator, image_fingerprint
+from modules.chunker import chunk_page
+from modules.tracing import span
 
-def clean_text(text):
+# Number of worker processes used to extract page ranges in parallel
+PDF_WORKERS = int(os.getenv('OMNIQUERY_PDF_WORKERS', str(os.cpu_count() or 1)))
+# Number of consecutive pages handled by one worker task
+PAGES_PER_TASK = int(os.getenv('OMNIQUERY_PAGES_PER_TASK', '16'))
+# Page ranges submitted ahead of the consumer, per worker
+RANGES_AHEAD_PER_WORKER = 2
+
+def clean_text(text, min_words=3):
     """Clean extracted text by removing noise and formatting issues."""
     # Remove multiple spaces
     text = re.sub(r'\s+', ' ', text)
     # Remove isolated single characters (often noise from PDF extraction)
     text = re.sub(r'\s+[a-zA-Z]\s+', ' ', text)
     # Remove very short lines (likely noise or headers/footers)
-    if len(text.split()) < 3:
+    if len(text.split()) < min_words:
         return ''
     return text.strip()
 
-def extract_text_and_images(pdf_path):
-    doc = fitz.open(pdf_path)
-    text_data = []
+def _pixmap_to_png(doc, xref):
+    """Render an embedded image to PNG bytes without touching the filesystem."""
+    pix = fitz.Pixmap(doc, xref)
+    # PNG cannot hold CMYK and similar colorspaces
+    if pix.n - pix.alpha >= 4:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix.tobytes('png')
+
+def _render_image(doc, xref):
+    """Render an image once and return its PNG bytes with content hash and perceptual fingerprint."""
+    data = _pixmap_to_png(doc, xref)
+    return dict(image_fingerprint(data), data=data, hash=hashlib.sha256(data).hexdigest())
+
+def _extract_page(doc, page_num, rendered):
+    page = doc[page_num]
     image_data = []
-    os.makedirs('assets', exist_ok=True)
-    
-    # Process each page
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # Get text blocks with more structure
-        blocks = page.get_text('blocks')
-        
-        for block in blocks:
-            # block[4] contains the text content
-            text = clean_text(block[4])
-            if text:  # Only add non-empty blocks
-                text_data.append({
-                    'text': text,
-                    'page': page_num + 1,  # Make pages 1-based for better UX
-                    'bbox': block[:4]  # First 4 elements are coordinates
-                })
-
-        # Extract images
-        images = page.get_images()
-        for img in images:
-            pix = fitz.Pixmap(doc, img[0])
-            image_path = f"assets/page_{page_num}_image_{img[0]}.png"
-            pix.save(image_path)
-            image_data.append({"path": image_path, "page": page_num, "bbox": img[1:5]})
-    return text_data, image_data
\ No newline at end of file
+
+    # Get text blocks with more structure
+    blocks = []
+    for block in page.get_text('blocks'):
+        # block[6] is 1 for image blocks; block[4] contains the text content.
+        # Short blocks are kept here because the chunker merges them.
+        text = clean_text(block[4], min_words=1) if block[6] == 0 else ''
+        if text:
+            blocks.append({'text': text, 'bbox': tuple(block[:4])})
+
+    # Merge and split the blocks into token-sized chunks along the layout;
+    # chunks that are still tiny after merging are noise
+    text_data = [chunk for chunk in chunk_page(blocks, page_num + 1)  # Make pages 1-based for better UX
+                 if clean_text(chunk['text'])]
+
+    # Extract images as in-memory PNG buffers. An xref that repeats (logos,
+    # headers) is rendered only once per worker; the occurrences are merged
+    # into one image later by the deduplicator.
+    for xref in dict.fromkeys(img[0] for img in page.get_images()):
+        if xref not in rendered:
+            try:
+                rendered[xref] = _render_image(doc, xref)
+            except Exception as e:
+                print(f"Skipping unreadable image {xref} on page {page_num + 1}: {e}")
+                rendered[xref] = None
+        if rendered[xref] is None:
+            continue
+
+        rects = page.get_image_rects(xref) or [page.rect]
+        image_data.append(dict(
+            rendered[xref],
+            xref=xref,
+            page=page_num + 1,
+            bbox=tuple(rects[0]),
+            occurrences=[{'page': page_num + 1, 'bbox': tuple(rect)} for rect in rects]
+        ))
+
+    return {'page': page_num + 1, 'text_data': text_data, 'image_data': image_data}
+
+def _extract_page_range(pdf_path, start, stop):
+    """Worker entry point: open a private document handle and extract pages [start, stop)."""
+    rendered = {}
+    with fitz.open(pdf_path) as doc:
+        return [_extract_page(doc, page_num, rendered) for page_num in range(start, stop)]
+
+def count_pages(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+def document_date(pdf):
+    """
+    Return the creation date in a PDF's metadata as a Unix timestamp, or
+    None if it has none. `pdf` is a path or the raw bytes.
+    """
+    try:
+        with (fitz.open(stream=pdf, filetype='pdf') if isinstance(pdf, bytes) else fitz.open(pdf)) as doc:
+            value = (doc.metadata or {}).get('creationDate') or ''
+        # PDF dates look like "D:20230115103000+01'00'"; the time zone is ignored
+        digits = re.sub(r'\D', '', value[2:] if value.startswith('D:') else value)[:14]
+        if len(digits) < 4:
+            return None
+        defaults = ('0000', '01', '01', '00', '00', '00')
+        fields, position = [], 0
+        for default in defaults:
+            fields.append(int(digits[position:position + len(default)] or default))
+            position += len(default)
+        return float(calendar.timegm(tuple(fields)))
+    except Exception:
+        return None
+
+def iter_pages(pdf_path, workers=PDF_WORKERS, pages_per_task=PAGES_PER_TASK):
+    """
+    Yield extracted pages in page order.
+
+    The document is split into ranges of `pages_per_task` pages that are
+    processed by a pool of `workers` processes, each opening its own handle.
+    Only `RANGES_AHEAD_PER_WORKER * workers` ranges are in flight at a time,
+    so a slow consumer holds back extraction instead of letting extracted
+    pages pile up. Each yielded item is a dict with `page`, `text_data` and
+    `image_data`.
+    """
+    page_count = count_pages(pdf_path)
+    starts = list(range(0, page_count, pages_per_task))
+    stops = [min(start + pages_per_task, page_count) for start in starts]
+
+    if workers <= 1 or len(starts) <= 1:
+        for start, stop in zip(starts, stops):
+            yield from _extract_page_range(pdf_path, start, stop)
+        return
+
+    workers = min(workers, len(starts))
+    ranges = iter(zip(starts, stops))
+    # Spawned, not forked: a fork of the multithreaded app could inherit a
+    # lock held by another thread, e.g. of the model registry
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = deque()
+        for start, stop in ranges:
+            pending.append(pool.submit(_extract_page_range, pdf_path, start, stop))
+            if len(pending) >= RANGES_AHEAD_PER_WORKER * workers:
+                break
+        # Results are taken in submission order, i.e. page order
+        while pending:
+            pages = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(pool.submit(_extract_page_range, pdf_path, *next_range))
+            yield from pages
+
+def extract_text_and_images(pdf_path, workers=PDF_WORKERS, pages_per_task=PAGES_PER_TASK):
+    """
+    Extract text chunks and unique images from a PDF.
+
+    Repeated images are collapsed by xref and perceptual hash, so each entry
+    in the returned image list lists every (page, bbox) it occurs at under
+    `occurrences`.
+    """
+    text_data = []
+    images = ImageDeduplicator()
+    with span('pdf.extract', items=0) as fields:
+        for page in iter_pages(pdf_path, workers, pages_per_task):
+            text_data.extend(page['text_data'])
+            images.extend(page['image_data'])
+            fields['items'] += 1
+    return text_data, images.images
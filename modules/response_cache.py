@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from modules.tracing import record_cache
+
+RESPONSE_CACHE_PATH = os.getenv('OMNIQUERY_RESPONSE_CACHE', os.path.join('.cache', 'responses.sqlite3'))
+RESPONSE_CACHE_TTL = float(os.getenv('OMNIQUERY_RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('OMNIQUERY_RESPONSE_CACHE_ENTRIES', '10000'))
+# Minimum cosine similarity between two queries on the same document for the
+# semantic tier to reuse an answer; unset disables the semantic tier
+_threshold = os.getenv('OMNIQUERY_SEMANTIC_CACHE_THRESHOLD')
+SEMANTIC_CACHE_THRESHOLD = float(_threshold) if _threshold else None
+
+
+def make_cache_key(doc_hash, chunk_ids, prompt, model, temperature, image_ids=()):
+    """Build the exact-match key for an answer from everything that shapes it."""
+    payload = json.dumps(
+        [doc_hash, [int(i) for i in chunk_ids], [int(i) for i in image_ids], prompt, model, temperature],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def make_scope(doc_hash, model, temperature, doc_hashes=None, pages=None, dates=None):
+    """
+    Build the key of what a question searched and how it was answered: the
+    document set, the document, page and date filters, and the model and
+    temperature. The semantic tier only reuses answers within one scope.
+    """
+    payload = json.dumps([doc_hash, model, temperature,
+                          sorted(doc_hashes) if doc_hashes is not None else None,
+                          list(pages) if pages is not None else None,
+                          list(dates) if dates is not None else None])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM answers.
+
+    The exact tier matches on `make_cache_key`. The optional semantic tier
+    reuses an answer for the same scope (see `make_scope`), stored in the
+    `doc_hash` column, when the new query's text embedding is within `semantic_threshold` cosine similarity of a cached
+    query. Entries expire after `ttl` seconds, and the least recently used
+    ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES, semantic_threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic_threshold = semantic_threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    doc_hash TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    query_embedding BLOB,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_doc ON responses (doc_hash)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+
+    def get(self, key):
+        """Return the cached answer for an exact key, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response FROM responses WHERE key = ? AND created >= ?',
+                (key, now - self.ttl)).fetchone()
+            if row is not None:
+                with self._conn:
+                    self._conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+        return row[0] if row else None
+
+    def get_similar(self, doc_hash, query_embedding):
+        """Return the answer of the most similar cached query in the same scope, or None."""
+        if self.semantic_threshold is None or query_embedding is None:
+            return None
+        now = time.time()
+        with self._lock:
+            query = np.asarray(query_embedding, dtype=np.float32).ravel()
+            # Embeddings of another size come from a different text model
+            rows = self._conn.execute(
+                'SELECT key, response, query_embedding FROM responses '
+                'WHERE doc_hash = ? AND created >= ? AND length(query_embedding) = ?',
+                (doc_hash, now - self.ttl, query.nbytes)).fetchall()
+            if not rows:
+                return None
+
+            cached = np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            norms = np.linalg.norm(cached, axis=1) * np.linalg.norm(query)
+            similarities = cached @ query / np.maximum(norms, 1e-12)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.semantic_threshold:
+                return None
+            with self._conn:
+                self._conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, rows[best][0]))
+        return rows[best][1]
+
+    def lookup(self, key, doc_hash, query_embedding=None):
+        """Try the exact tier, then the semantic tier, and count the hit or miss."""
+        response = self.get(key)
+        result = 'exact'
+        if response is None:
+            response = self.get_similar(doc_hash, query_embedding)
+            result = 'semantic'
+        if response is None:
+            self.misses += 1
+            result = 'miss'
+        else:
+            self.hits += 1
+        record_cache('response', result)
+        return response
+
+    def put(self, key, doc_hash, response, query_embedding=None):
+        now = time.time()
+        embedding = None
+        if query_embedding is not None:
+            embedding = np.asarray(query_embedding, dtype=np.float32).ravel().tobytes()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, doc_hash, response, embedding, now, now))
+            self._conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+            self._conn.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM responses')
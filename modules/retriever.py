@@ -0,0 +1,188 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from modules.chunk_store import ChunkStore
+from modules.tracing import bind
+from modules.utils import reciprocal_rank_fusion
+
+# Number of candidates each source contributes before fusion
+RETRIEVAL_CANDIDATES = int(os.getenv('OMNIQUERY_RETRIEVAL_CANDIDATES', '20'))
+RRF_K = int(os.getenv('OMNIQUERY_RRF_K', '60'))
+# Squared L2 distances past which dense text and image hits are dropped
+# (unset keeps every neighbour); MiniLM and CLIP embeddings differ in scale
+MAX_DISTANCE = float(os.getenv('OMNIQUERY_MAX_DISTANCE') or 'inf')
+MAX_IMAGE_DISTANCE = float(os.getenv('OMNIQUERY_MAX_IMAGE_DISTANCE') or 'inf')
+# Threads searching the shards of a multi-document corpus
+CORPUS_SEARCH_WORKERS = int(os.getenv('OMNIQUERY_CORPUS_SEARCH_WORKERS', '8'))
+
+# Shared by all retrievers; searches are I/O-free but release the GIL in
+# FAISS, numpy and torch
+_shard_executor = ThreadPoolExecutor(max_workers=CORPUS_SEARCH_WORKERS, thread_name_prefix='corpus-search')
+
+_EMPTY_IDS = np.array([], dtype=np.int64)
+_EMPTY_SCORES = np.array([], dtype=np.float32)
+_EMPTY_STORE = ChunkStore.from_records([])
+
+def _filtered_search(db, query_emb, k, size, allowed=None, max_distance=None):
+    """
+    k-NN search of one shard restricted to its first `size` ids (the rows
+    of the metadata snapshot), if given to those where `allowed` is True,
+    and to hits within `max_distance`.
+
+    Enough neighbours are fetched that k allowed ones are expected among
+    them, up to the whole shard. Returns `(ids, distances)`.
+    """
+    if db is None or not len(db):
+        return _EMPTY_IDS, _EMPTY_SCORES
+    n_allowed = int(allowed.sum()) if allowed is not None else size
+    if n_allowed == 0:
+        return _EMPTY_IDS, _EMPTY_SCORES
+    fetch = min(len(db), math.ceil(k * max(len(db), n_allowed) / n_allowed))
+    ids, distances = db.search_batch(query_emb, fetch, max_distance)
+    ids, distances = ids[0], distances[0]
+    # Vectors indexed after the snapshot was taken (ingestion still running)
+    # have no metadata in it and are skipped
+    keep = (ids >= 0) & (ids < size)
+    if allowed is not None:
+        keep[keep] = allowed[ids[keep]]
+    return ids[keep][:k], distances[keep][:k]
+
+def _shard_size(store, position):
+    return int(store.offsets[position + 1] - store.offsets[position])
+
+def _in_range(value, bounds):
+    first, last = bounds
+    return value is not None and (first is None or value >= first) and (last is None or value <= last)
+
+class CorpusRetriever:
+    """
+    Hybrid search over many documents, each with its own index shard.
+
+    `documents` are ingestion jobs or corpus shards. Filters on document
+    hash, page range and date prune whole shards before any vectors are
+    scanned; the remaining shards are searched in parallel and their dense,
+    lexical and image hits are merged into global rankings. Returned ids
+    are rows of the `chunks` and `images` ChunkStores built from all the
+    documents, in order.
+    """
+
+    def __init__(self, documents, candidates=RETRIEVAL_CANDIDATES, rrf_k=RRF_K, weights=(1.0, 1.0),
+                 max_distance=MAX_DISTANCE, max_image_distance=MAX_IMAGE_DISTANCE):
+        self.documents = list(documents)
+        self.candidates = candidates
+        self.max_distance = max_distance
+        self.max_image_distance = max_image_distance
+        self.rrf_k = rrf_k
+        self.weights = weights
+
+    def _prune(self, doc_hashes=None, pages=None, dates=None):
+        """Positions of the documents that can match the filters."""
+        keep = []
+        for position, document in enumerate(self.documents):
+            if doc_hashes is not None and document.hash not in doc_hashes:
+                continue
+            # Documents shorter than the first requested page cannot match
+            if pages is not None and pages[0] is not None and document.done and \
+                    document.page_count < pages[0]:
+                continue
+            if dates is not None and not _in_range(document.date, dates):
+                continue
+            keep.append(position)
+        return keep
+
+    def plan(self, doc_hashes=None, pages=None, dates=None):
+        """
+        Resolve the filters into the shards to search and their allowed rows.
+
+        `doc_hashes` is a collection of document hashes, `pages` a
+        `(first, last)` page range and `dates` a `(start, end)` range of Unix
+        timestamps; None leaves a bound open. The returned dict is passed to
+        the `search_*` methods.
+        """
+        positions = self._prune(doc_hashes, pages, dates)
+        # Pruned documents keep their position, with no rows, so shards
+        # that cannot match are never read
+        kept = set(positions)
+        chunks = ChunkStore.concat(document.text_chunks if position in kept else _EMPTY_STORE
+                                   for position, document in enumerate(self.documents))
+        images = ChunkStore.concat(document.image_chunks if position in kept else _EMPTY_STORE
+                                   for position, document in enumerate(self.documents))
+        text_allowed = chunks.page_mask(*pages) if pages is not None else None
+        image_allowed = images.page_mask(*pages) if pages is not None else None
+        return {
+            'positions': positions,
+            'chunks': chunks,
+            'images': images,
+            'text_allowed': {position: text_allowed[chunks.rows(position)] if text_allowed is not None else None
+                             for position in positions},
+            'image_allowed': {position: image_allowed[images.rows(position)] if image_allowed is not None else None
+                              for position in positions},
+        }
+
+    def has_images(self, plan):
+        # Decided from the metadata, so no image index is loaded for it
+        return len(plan['images']) > 0
+
+    def _fan_out(self, plan, store, search):
+        """
+        Run `search(position)` in parallel on every planned shard that has
+        rows in `store`; the indexes of the others are never loaded.
+        """
+        futures = {position: _shard_executor.submit(bind(search), position) for position in plan['positions']
+                   if _shard_size(store, position)}
+        return [(position, future.result()) for position, future in futures.items()]
+
+    def _lexical_shard(self, document, query, size, allowed):
+        if document.bm25 is None or not len(document.bm25):
+            return _EMPTY_IDS, _EMPTY_SCORES
+        # BM25 scores every document anyway, so filtering afterwards is exact
+        exhaustive = allowed is not None or len(document.bm25) > size
+        ids, scores = document.bm25.search(query, len(document.bm25) if exhaustive else self.candidates)
+        keep = ids < size
+        if allowed is not None:
+            keep[keep] = allowed[ids[keep]]
+        return ids[keep][:self.candidates], scores[keep][:self.candidates]
+
+    @staticmethod
+    def _merge(hits, offsets, limit, descending=False):
+        """Merge per-shard `(ids, scores)` into one global ranking of at most `limit` ids."""
+        ids = [local.astype(np.int64) + offsets[position] for position, (local, _) in hits]
+        scores = [score for _, (_, score) in hits]
+        if not ids:
+            return _EMPTY_IDS, _EMPTY_SCORES
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        order = np.argsort(-scores if descending else scores, kind='stable')[:limit]
+        return ids[order], scores[order]
+
+    def search_dense(self, plan, query_emb):
+        """Global dense text ranking `(ids, distances)` for a MiniLM query embedding."""
+        # Every shard embeds with the same model, so distances compare directly
+        hits = self._fan_out(plan, plan['chunks'], lambda position: _filtered_search(
+            self.documents[position].text_db, query_emb, self.candidates,
+            _shard_size(plan['chunks'], position), plan['text_allowed'][position], self.max_distance))
+        return self._merge(hits, plan['chunks'].offsets, self.candidates)
+
+    def search_lexical(self, plan, query):
+        """Global BM25 ranking `(ids, scores)`."""
+        # BM25 scores use per-shard statistics, which is close enough to
+        # order the lexical candidates before fusion
+        hits = self._fan_out(plan, plan['chunks'], lambda position: self._lexical_shard(
+            self.documents[position], query, _shard_size(plan['chunks'], position),
+            plan['text_allowed'][position]))
+        return self._merge(hits, plan['chunks'].offsets, self.candidates, descending=True)
+
+    def search_images(self, plan, clip_emb, k_images=5):
+        """Global CLIP image ranking `(ids, distances)` for a CLIP text embedding."""
+        hits = self._fan_out(plan, plan['images'], lambda position: _filtered_search(
+            self.documents[position].image_db, clip_emb, k_images,
+            _shard_size(plan['images'], position), plan['image_allowed'][position],
+            self.max_image_distance))
+        return self._merge(hits, plan['images'].offsets, k_images)
+
+    def fuse(self, dense_ids, lexical_ids, k=5):
+        """Reciprocal rank fusion of the dense and lexical rankings; returns `(ids, scores)`."""
+        ids, scores = reciprocal_rank_fusion(dense_ids, lexical_ids, k=self.rrf_k, weights=self.weights)
+        return ids[:k], scores[:k]
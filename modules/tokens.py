@@ -0,0 +1,59 @@
+import os
+import re
+
+from modules.models import get_model
+
+# tiktoken encoding used for all token accounting; cl100k_base is GPT-4's
+TOKENIZER_ENCODING = os.getenv('OMNIQUERY_TOKENIZER', 'cl100k_base')
+
+class TiktokenTokenizer:
+    """Exact GPT token counts through tiktoken."""
+
+    exact = True
+
+    def __init__(self, encoding=TOKENIZER_ENCODING):
+        import tiktoken
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def encode(self, text):
+        return self._encoding.encode(text, disallowed_special=())
+
+    def decode(self, tokens):
+        # Tokens can split a multibyte UTF-8 character; drop the partial
+        # bytes at the edges rather than emit U+FFFD
+        return self._encoding.decode(tokens, errors='ignore')
+
+    def count(self, text):
+        return len(self.encode(text))
+
+class RegexTokenizer:
+    """
+    Approximate tokens (words and punctuation marks, each with its leading
+    whitespace) for when tiktoken is not available. Tokens are strings, so
+    `decode` is an exact inverse of `encode`.
+    """
+
+    exact = False
+    _token_re = re.compile(r'\s*(?:\w+|[^\w\s])')
+
+    def encode(self, text):
+        return self._token_re.findall(text)
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+    def count(self, text):
+        return len(self._token_re.findall(text))
+
+def load_tokenizer(encoding=TOKENIZER_ENCODING):
+    try:
+        return TiktokenTokenizer(encoding)
+    except Exception as e:
+        print(f"tiktoken unavailable ({e}); token counts are estimated")
+        return RegexTokenizer()
+
+def get_tokenizer():
+    return get_model('tokenizer')
+
+def count_tokens(text):
+    return get_tokenizer().count(text)
@@ -0,0 +1,305 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the span duration histogram buckets
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Serve /metrics (Prometheus text) and /metrics.json on this port when set
+_port = os.getenv('OMNIQUERY_METRICS_PORT')
+METRICS_PORT = int(_port) if _port else None
+# Show the timing breakdown of the last question in the app
+DEBUG_PANEL = os.getenv('OMNIQUERY_DEBUG_PANEL', '0') == '1'
+
+COUNTER_HELP = {
+    'llm_tokens_total': 'Tokens reported by the OpenAI API',
+    'llm_requests_total': 'Requests sent to the OpenAI API',
+    'cache_requests_total': 'Cache lookups by cache and result',
+}
+
+# The trace of the question being answered, if any
+_current = contextvars.ContextVar('omniquery_trace', default=None)
+
+
+class Metrics:
+    """Process-wide span histograms and counters."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._spans = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, items=None, error=False):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = {'count': 0, 'sum': 0.0, 'items': 0, 'errors': 0,
+                                            'buckets': [0] * len(self.buckets)}
+            span['count'] += 1
+            span['sum'] += seconds
+            span['items'] += items or 0
+            span['errors'] += bool(error)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    span['buckets'][i] += 1
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return ({name: dict(span, buckets=list(span['buckets'])) for name, span in self._spans.items()},
+                    dict(self._counters))
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+            self.started = time.time()
+
+
+METRICS = Metrics()
+
+
+class Trace:
+    """The spans recorded while answering one question, from any thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.usage = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """Spans in start order, with start offsets and durations in milliseconds."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return {
+            'name': self.name,
+            'duration_ms': (self.duration if self.duration is not None
+                            else time.perf_counter() - self.start) * 1000,
+            'usage': self.usage,
+            'spans': [dict(span, start=(span['start'] - self.start) * 1000,
+                           duration=span['duration'] * 1000) for span in spans],
+        }
+
+
+def record(name, start, end=None, items=None, error=None, **attributes):
+    """Record a finished span that started at `start` (a `time.perf_counter()` value)."""
+    end = time.perf_counter() if end is None else end
+    METRICS.observe(name, end - start, items, error is not None)
+    current = _current.get()
+    if current is not None:
+        current.add({'name': name, 'start': start, 'duration': end - start, 'items': items,
+                     'error': error, 'thread': threading.current_thread().name, **attributes})
+
+
+@contextmanager
+def span(name, items=None, **attributes):
+    """
+    Time the body as span `name`. The yielded dict can be updated with
+    `items` and other attributes known only inside the body.
+    """
+    fields = dict(attributes, items=items)
+    start = time.perf_counter()
+    try:
+        yield fields
+    except Exception as e:
+        fields['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record(name, start, **fields)
+
+
+def traced(name, items=None):
+    """
+    Decorator recording each call as span `name`. If `items` is the
+    position of an argument, its length is recorded as the item count.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            count = None
+            if items is not None and len(args) > items:
+                try:
+                    count = len(args[items])
+                except TypeError:
+                    pass
+            with span(name, count):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def trace(name='query'):
+    """Collect the spans of everything done inside the body, in this context, into a Trace."""
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current.reset(token)
+
+
+def current_trace():
+    return _current.get()
+
+
+def bind(func):
+    """Wrap `func` to run in a copy of the current context, so spans reach the trace from a pool thread."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+async def _in_trace(coroutine, current):
+    _current.set(current)
+    return await coroutine
+
+
+def bind_coroutine(coroutine):
+    """Carry the current trace into a coroutine scheduled on another thread's event loop."""
+    return _in_trace(coroutine, _current.get())
+
+
+def record_usage(usage):
+    """Count the prompt and completion tokens of an OpenAI `usage` object."""
+    if usage is None:
+        return
+    tokens = {'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+              'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0}
+    METRICS.increment('llm_tokens_total', tokens['prompt_tokens'], kind='prompt')
+    METRICS.increment('llm_tokens_total', tokens['completion_tokens'], kind='completion')
+    current = _current.get()
+    if current is not None:
+        current.usage = tokens
+
+
+def record_cache(cache, result, count=1):
+    """Count lookups in `cache`; `result` is 'miss' or the kind of hit (e.g. 'hit', 'semantic')."""
+    if count:
+        METRICS.increment('cache_requests_total', count, cache=cache, result=result)
+
+
+def cache_hit_rates():
+    """Fraction of lookups that hit, per cache."""
+    _, counters = METRICS.snapshot()
+    totals = {}
+    for (name, labels), value in counters.items():
+        if name != 'cache_requests_total':
+            continue
+        labels = dict(labels)
+        total = totals.setdefault(labels['cache'], [0, 0])
+        total[0] += value if labels['result'] != 'miss' else 0
+        total[1] += value
+    return {cache: hits / count for cache, (hits, count) in totals.items() if count}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def prometheus_text(metrics=METRICS):
+    """The metrics in the Prometheus text exposition format."""
+    spans, counters = metrics.snapshot()
+    lines = ['# HELP omniquery_span_seconds Duration of instrumented pipeline operations',
+             '# TYPE omniquery_span_seconds histogram']
+    for name, data in sorted(spans.items()):
+        for bound, count in zip(metrics.buckets, data['buckets']):
+            lines.append(f"omniquery_span_seconds_bucket{_labels((('span', name), ('le', f'{bound:g}')))} {count}")
+        lines.append(f"omniquery_span_seconds_bucket{_labels((('span', name), ('le', '+Inf')))} {data['count']}")
+        lines.append(f"omniquery_span_seconds_sum{_labels((('span', name),))} {data['sum']}")
+        lines.append(f"omniquery_span_seconds_count{_labels((('span', name),))} {data['count']}")
+    for metric, field, help_text in (('span_items_total', 'items', 'Items processed by instrumented operations'),
+                                     ('span_errors_total', 'errors', 'Instrumented operations that raised')):
+        lines += [f'# HELP omniquery_{metric} {help_text}', f'# TYPE omniquery_{metric} counter']
+        lines += [f"omniquery_{metric}{_labels((('span', name),))} {data[field]}"
+                  for name, data in sorted(spans.items())]
+    for name in sorted({name for name, _ in counters}):
+        lines += [f'# HELP omniquery_{name} {COUNTER_HELP.get(name, name)}', f'# TYPE omniquery_{name} counter']
+        lines += [f"omniquery_{name}{_labels(labels)} {value}"
+                  for (counter, labels), value in sorted(counters.items()) if counter == name]
+    return '\n'.join(lines) + '\n'
+
+
+def _attributes(labels):
+    return [{'key': key, 'value': {'stringValue': str(value)}} for key, value in labels]
+
+
+def otel_json(metrics=METRICS):
+    """The metrics as an OpenTelemetry (OTLP/JSON) `resourceMetrics` document."""
+    spans, counters = metrics.snapshot()
+    start, now = str(int(metrics.started * 1e9)), str(int(time.time() * 1e9))
+    cumulative = 2  # AGGREGATION_TEMPORALITY_CUMULATIVE
+    histogram = {
+        'name': 'omniquery.span.duration', 'unit': 's',
+        'description': 'Duration of instrumented pipeline operations',
+        'histogram': {'aggregationTemporality': cumulative, 'dataPoints': [{
+            'attributes': _attributes([('span', name)]),
+            'startTimeUnixNano': start, 'timeUnixNano': now,
+            'count': str(data['count']), 'sum': data['sum'],
+            # OTLP buckets are per interval, Prometheus ones cumulative
+            'bucketCounts': [str(count - previous) for count, previous
+                             in zip(data['buckets'] + [data['count']], [0] + data['buckets'])],
+            'explicitBounds': list(metrics.buckets),
+        } for name, data in sorted(spans.items())]},
+    }
+    sums = [{'name': f'omniquery.span.{field}', 'sum': {
+                'aggregationTemporality': cumulative, 'isMonotonic': True, 'dataPoints': [{
+                    'attributes': _attributes([('span', name)]), 'startTimeUnixNano': start,
+                    'timeUnixNano': now, 'asInt': str(data[field])} for name, data in sorted(spans.items())]}}
+            for field in ('items', 'errors')]
+    for name in sorted({name for name, _ in counters}):
+        sums.append({'name': f"omniquery.{name.replace('_total', '')}", 'description': COUNTER_HELP.get(name, ''),
+                     'sum': {'aggregationTemporality': cumulative, 'isMonotonic': True, 'dataPoints': [{
+                         'attributes': _attributes(labels), 'startTimeUnixNano': start, 'timeUnixNano': now,
+                         'asInt': str(value)} for (counter, labels), value in sorted(counters.items())
+                         if counter == name]}})
+    return {'resourceMetrics': [{
+        'resource': {'attributes': _attributes([('service.name', 'omniquery')])},
+        'scopeMetrics': [{'scope': {'name': 'modules.tracing'}, 'metrics': [histogram] + sums}],
+    }]}
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(otel_json()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    """Serve /metrics and /metrics.json from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+    return server
@@ -1,8 +1,40 @@
-def reciprocal_rank_fusion(text_results, image_results, k=60):
-    scores = {}
-    for i, (text_res, image_res) in enumerate(zip(text_results, image_results)):
-        for rank, doc_id in enumerate(text_res):
-            scores[doc_id] = scores.get(doc_id, 0) + 1 / (rank + k)
-        for rank, doc_id in enumerate(image_res):
-            scores[doc_id] = scores.get(doc_id, 0) + 1 / (rank + k)
-    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
\ No newline at end of file
+import io
+import numpy as np
+from PIL import Image
+
+def open_image(source):
+    """Open an image given as a file path, raw bytes or an already open PIL image."""
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+def reciprocal_rank_fusion(*rankings, k=60, weights=None):
+    """
+    Fuse ranked id lists with Reciprocal Rank Fusion.
+
+    Each ranking is a sequence of integer ids, best first; negative ids
+    (FAISS padding) are ignored. Every ranking contributes
+    weight / (rank + k) to each id it contains, so ids that are missing from
+    some rankings are still kept. Returns `(ids, scores)`, best first.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    ids = []
+    contributions = []
+    for ranking, weight in zip(rankings, weights):
+        ranking = np.asarray(ranking, dtype=np.int64).ravel()
+        ranks = np.arange(len(ranking))
+        valid = ranking >= 0
+        ids.append(ranking[valid])
+        contributions.append(weight / (ranks[valid] + k))
+    if not ids:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    ids = np.concatenate(ids)
+    contributions = np.concatenate(contributions)
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions, minlength=len(unique_ids))
+    order = np.argsort(-scores, kind='stable')
+    return unique_ids[order], scores[order]
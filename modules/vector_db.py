@@ -1,22 +1,608 @@
 import faiss
 import numpy as np
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+
+from modules.tracing import traced
+
+# Index kinds accepted by VectorDB; "auto" starts flat and switches to
+# AUTO_ANN_INDEX once the index holds FLAT_THRESHOLD vectors
+INDEX_TYPES = ('auto', 'flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+DEFAULT_INDEX_TYPE = os.getenv('OMNIQUERY_INDEX_TYPE', 'auto')
+AUTO_ANN_INDEX = os.getenv('OMNIQUERY_AUTO_ANN_INDEX', 'ivf_flat')
+FLAT_THRESHOLD = int(os.getenv('OMNIQUERY_FLAT_THRESHOLD', '50000'))
+
+# How each vector is stored inside the index: full float32, float16, scalar
+# int8, product quantization or PQ after an OPQ rotation
+STORAGE_MODES = ('float32', 'float16', 'int8', 'pq', 'opq')
+DEFAULT_STORAGE = os.getenv('OMNIQUERY_VECTOR_STORAGE', 'float32')
+# Keep float32 copies in a memory-mapped file and re-rank compressed hits exactly
+DEFAULT_RERANK = os.getenv('OMNIQUERY_VECTOR_RERANK', '0') == '1'
+RERANK_FACTOR = int(os.getenv('OMNIQUERY_RERANK_FACTOR', '4'))
+# Indexes that must be trained (compressed storage, IVF) hold their vectors
+# in a flat float32 index until this many can train them together
+TRAIN_SIZE = int(os.getenv('OMNIQUERY_TRAIN_SIZE', '1024'))
+# 8-bit PQ codebooks, the only kind HNSW and OPQ take, need 256 points
+PQ_MIN_TRAIN_SIZE = 256
+
+INDEX_FILE = 'index.faiss'
+META_FILE = 'vector_db.json'
+RAW_FILE = 'vectors.f32'
+RAW_IDS_FILE = 'vector_ids.npy'
+
+class RawVectorStore:
+    """
+    Append-only float32 copies of the indexed vectors, kept on disk and read
+    back through a memory map for exact re-ranking.
+
+    Rows are found through an int64 array indexed by vector id (-1 where an
+    id has no row), as ids are small consecutive integers. Without a `path`
+    the vectors go to a temporary file, deleted on `close`, on `clear` and
+    when the store is garbage collected. A given `path` is created if it
+    does not exist and never truncated: rows already in it are kept and new
+    ones are appended after them.
+    """
+
+    def __init__(self, dim, path=None):
+        self.dim = dim
+        self._cleanup = None
+        if path is None:
+            path = self._temporary_file()
+        else:
+            open(path, 'ab').close()
+        self.path = path
+        self._rows = np.full(0, -1, dtype=np.int64)
+        self._count = os.path.getsize(path) // (4 * dim)
+        self._map = None
+
+    def _temporary_file(self):
+        fd, path = tempfile.mkstemp(prefix='omniquery-vectors-', suffix='.f32')
+        os.close(fd)
+        self._cleanup = weakref.finalize(self, _remove_file, path)
+        return path
+
+    def append(self, vectors, ids):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+        with open(self.path, 'ab') as f:
+            f.write(vectors.tobytes())
+        if len(ids) and ids.max() >= len(self._rows):
+            # Grow geometrically so appending batches stays amortized O(1)
+            rows = np.full(max(int(ids.max()) + 1, 2 * len(self._rows)), -1, dtype=np.int64)
+            rows[:len(self._rows)] = self._rows
+            self._rows = rows
+        self._rows[ids] = np.arange(self._count, self._count + len(vectors), dtype=np.int64)
+        self._count += len(vectors)
+        self._map = None
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        self._rows[ids[(ids >= 0) & (ids < len(self._rows))]] = -1
+
+    def get(self, ids):
+        """Return the vectors for `ids` and a mask of which ids were found."""
+        ids = np.ravel(np.asarray(ids, dtype=np.int64))
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        known = (ids >= 0) & (ids < len(self._rows))
+        rows[known] = self._rows[ids[known]]
+        found = rows >= 0
+        vectors = np.zeros((len(rows), self.dim), dtype=np.float32)
+        if found.any():
+            vectors_map = self._map
+            if vectors_map is None:
+                vectors_map = self._map = np.memmap(self.path, dtype=np.float32, mode='r',
+                                                    shape=(self._count, self.dim))
+            vectors[found] = vectors_map[rows[found]]
+        return vectors, found
+
+    def clear(self):
+        """Forget every id; a temporary file is replaced, a given one is left as it is."""
+        self._map = None
+        if self._cleanup is not None:
+            self._cleanup()
+            self.path = self._temporary_file()
+            self._count = 0
+        self._rows = np.full(0, -1, dtype=np.int64)
+
+    def close(self):
+        """Delete the temporary file, if the store made one."""
+        self._map = None
+        if self._cleanup is not None:
+            self._cleanup()
+
+    def save(self, path):
+        target = os.path.join(path, RAW_FILE)
+        if not (os.path.exists(target) and os.path.samefile(self.path, target)):
+            shutil.copyfile(self.path, target)
+        ids = np.flatnonzero(self._rows >= 0)
+        np.save(os.path.join(path, RAW_IDS_FILE), np.stack([ids, self._rows[ids]]))
+
+    @classmethod
+    def load(cls, dim, path, copy=True):
+        """
+        Load the vectors saved in directory `path`. With `copy` they are
+        copied to a private temporary file, so appending never changes the
+        saved files; read-only stores can use them in place.
+        """
+        if copy:
+            store = cls(dim)
+            shutil.copyfile(os.path.join(path, RAW_FILE), store.path)
+            store._count = os.path.getsize(store.path) // (4 * dim)
+        else:
+            store = cls(dim, os.path.join(path, RAW_FILE))
+        ids, rows = np.load(os.path.join(path, RAW_IDS_FILE))
+        store._rows = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+        store._rows[ids] = rows
+        return store
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class _ReadWriteLock:
+    """
+    Lets any number of searches run together while mutations run alone.
+    Waiting mutations hold back new searches so they are not starved.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+class _NoLock:
+    """Stands in for the lock of read-only (memory-mapped) indexes, which never change."""
+
+    def read(self):
+        return nullcontext()
+
+    write = read
 
 class VectorDB:
-    def __init__(self, dim):
+    """
+    FAISS index whose vectors carry stable integer ids.
+
+    Ids default to consecutive integers in insertion order, so they double
+    as positions into the list of chunks that was embedded. Vectors can be
+    removed or replaced by id (except in HNSW indexes, which FAISS cannot
+    delete from), and the whole index can be saved to and loaded from disk.
+
+    `storage` selects how vectors are held in memory (see STORAGE_MODES).
+    Indexes that need training stage their first vectors in a flat float32
+    index and are trained on all of them once `train_size` have been added,
+    so adding in small batches does not fit the codecs to the first one.
+    With `rerank=True`, compressed indexes fetch `rerank_factor * k`
+    candidates and re-rank them exactly against float32 copies kept in a
+    memory-mapped file.
+    """
+
+    def __init__(self, dim, index_type=DEFAULT_INDEX_TYPE, flat_threshold=FLAT_THRESHOLD,
+                 nlist=None, pq_m=8, hnsw_m=32, nprobe=16, ef_search=64,
+                 storage=DEFAULT_STORAGE, rerank=DEFAULT_RERANK, rerank_factor=RERANK_FACTOR,
+                 raw_path=None, train_size=TRAIN_SIZE):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode {storage!r}, expected one of {STORAGE_MODES}")
         self.dim = dim
-        self.index = faiss.IndexFlatL2(dim)
+        self.index_type = index_type
+        self.flat_threshold = flat_threshold
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.storage = storage
+        self.rerank_factor = rerank_factor
+        self.train_size = train_size
+        self._raw = RawVectorStore(dim, raw_path) if rerank else None
+        # FAISS indexes may not be searched while they are being modified
+        self._lock = _ReadWriteLock()
+        self.reset()
 
-    def add(self, embeddings):
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def add(self, embeddings, ids=None):
+        """
+        Add vectors, optionally under explicit ids, and return the ids used.
+        """
+        with self._lock.write():
+            return self._add(embeddings, ids)
+
+    def _add(self, embeddings, ids=None):
         # Convert to numpy array if not already
-        embeddings_np = np.asarray(embeddings, dtype=np.float32)
-        self.index.add(embeddings_np)
-
-    def search(self, query_embedding, k=5):
-        # Convert to numpy array and ensure correct shape
-        query_np = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
-        distances, indices = self.index.search(query_np, k)
-        return indices[0]
-    
+        embeddings_np = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if len(embeddings_np) == 0:
+            return np.array([], dtype=np.int64)
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + len(embeddings_np), dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+        new_ids = ids
+        if self._raw is not None:
+            self._raw.append(embeddings_np, ids)
+
+        upgrade = self._upgrade_kind(self.index.ntotal + len(embeddings_np))
+        if upgrade is not None:
+            # Large enough for approximate search to pay off, or to train the codecs
+            old_vectors, old_ids = self._flat_contents()
+            self._build(upgrade, self.index.ntotal + len(embeddings_np))
+            embeddings_np = np.vstack([old_vectors, embeddings_np])
+            ids = np.concatenate([old_ids, ids])
+
+        if not self.index.is_trained:
+            # Size the lists for the data actually available for training
+            self._build(self.kind, len(embeddings_np))
+            self.index.train(embeddings_np)
+        self.index.add_with_ids(embeddings_np, ids)
+        self._next_id = max(self._next_id, int(ids.max()) + 1)
+        return new_ids
+
+    def remove(self, ids):
+        """Delete the vectors with the given ids; returns how many were removed."""
+        with self._lock.write():
+            return self._remove(ids)
+
+    def _remove(self, ids):
+        if self._raw is not None:
+            self._raw.remove(ids)
+        return self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def update(self, ids, embeddings):
+        """Replace the vectors stored under the given ids."""
+        with self._lock.write():
+            self._remove(ids)
+            self._add(embeddings, ids)
+
+    def search(self, query_embedding, k=5, max_distance=None):
+        """
+        Return the ids of the k nearest vectors to a single query.
+
+        Hits farther than `max_distance` (squared L2) are dropped, so fewer
+        than k ids may come back.
+        """
+        ids, distances = self.search_batch(query_embedding, k, max_distance)
+        # FAISS pads with -1 when fewer than k vectors are stored
+        return ids[0][ids[0] >= 0]
+
+    @traced('vector_db.search')
+    def search_batch(self, query_embeddings, k=5, max_distance=None):
+        """
+        Search many queries in one FAISS call.
+
+        Returns `(ids, distances)` arrays of shape (n_queries, k) holding
+        squared L2 distances. Missing hits, including those beyond
+        `max_distance`, have id -1 and distance inf.
+        """
+        with self._lock.read():
+            return self._search(query_embeddings, k, max_distance)
+
+    def _search(self, query_embeddings, k, max_distance=None):
+        queries_np = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if self.index.ntotal == 0:
+            return (np.full((len(queries_np), k), -1, dtype=np.int64),
+                    np.full((len(queries_np), k), np.inf, dtype=np.float32))
+        if self._raw is not None and self.storage != 'float32':
+            distances, ids = self.index.search(queries_np, k * self.rerank_factor)
+            distances, ids = self._rerank(queries_np, ids, k)
+        else:
+            distances, ids = self.index.search(queries_np, k)
+        missing = ids < 0
+        if max_distance is not None:
+            missing |= distances > max_distance
+        ids[missing] = -1
+        distances[missing] = np.inf
+        return ids, distances
+
+    def range_search(self, query_embeddings, max_distance, max_results=None):
+        """
+        Return every vector within `max_distance` (squared L2) of each query.
+
+        The result is a list with one `(ids, distances)` pair per query,
+        sorted by distance and optionally capped at `max_results`. Index
+        types without native range search (HNSW) fall back to a k-NN search
+        of `max_results` (default 100) that is then filtered. Distances come
+        from the index's own (possibly compressed) codes.
+        """
+        with self._lock.read():
+            queries_np = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+            if self.index.ntotal == 0:
+                empty = (np.array([], dtype=np.int64), np.array([], dtype=np.float32))
+                return [empty for _ in range(len(queries_np))]
+
+            try:
+                lims, distances, ids = self.index.range_search(queries_np, max_distance)
+            except RuntimeError:
+                ids, distances = self._search(queries_np, max_results or 100, max_distance)
+                return [(row_ids[row_ids >= 0], row_dist[row_ids >= 0])
+                        for row_ids, row_dist in zip(ids, distances)]
+
+            results = []
+            for i in range(len(queries_np)):
+                row_ids = ids[lims[i]:lims[i + 1]]
+                row_dist = distances[lims[i]:lims[i + 1]]
+                order = np.argsort(row_dist)[:max_results]
+                results.append((row_ids[order].astype(np.int64), row_dist[order]))
+            return results
+
     def reset(self):
         """Reset the index, clearing all stored vectors"""
-        self.index = faiss.IndexFlatL2(self.dim)
\ No newline at end of file
+        with self._lock.write():
+            self._next_id = 0
+            if self._raw is not None:
+                self._raw.clear()
+            self._build(self._target_kind(0), 0)
+
+    def close(self):
+        """Delete the temporary float32 copies kept for re-ranking, if any."""
+        with self._lock.write():
+            if self._raw is not None:
+                self._raw.close()
+
+    def memory_bytes(self):
+        """Size of the serialized index, i.e. roughly its in-memory footprint."""
+        with self._lock.read():
+            return int(faiss.serialize_index(self.index).nbytes)
+
+    def save(self, path):
+        """Write the index and its settings to the directory `path`."""
+        with self._lock.read():
+            os.makedirs(path, exist_ok=True)
+            faiss.write_index(self.index, os.path.join(path, INDEX_FILE))
+            if self._raw is not None:
+                self._raw.save(path)
+            meta = {
+                'dim': self.dim,
+                'index_type': self.index_type,
+                'kind': self.kind,
+                'next_id': self._next_id,
+                'flat_threshold': self.flat_threshold,
+                'nlist': self.nlist,
+                'pq_m': self.pq_m,
+                'hnsw_m': self.hnsw_m,
+                'nprobe': self.nprobe,
+                'ef_search': self.ef_search,
+                'storage': self.storage,
+                'rerank': self._raw is not None,
+                'rerank_factor': self.rerank_factor,
+                'train_size': self.train_size,
+                'staging': self._staging,
+            }
+            with open(os.path.join(path, META_FILE), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Load an index written by `save`.
+
+        With `mmap=True` the vectors are memory-mapped read-only instead of
+        read into RAM, where FAISS supports it for the index type; such an
+        index can be searched but not modified.
+        """
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        db = cls.__new__(cls)
+        db.dim = meta['dim']
+        db.index_type = meta['index_type']
+        db.flat_threshold = meta['flat_threshold']
+        db.nlist = meta['nlist']
+        db.pq_m = meta['pq_m']
+        db.hnsw_m = meta['hnsw_m']
+        db.nprobe = meta['nprobe']
+        db.ef_search = meta['ef_search']
+        db.storage = meta.get('storage', 'float32')
+        db.rerank_factor = meta.get('rerank_factor', RERANK_FACTOR)
+        db.train_size = meta.get('train_size', TRAIN_SIZE)
+        db._staging = meta.get('staging', False)
+        db._raw = RawVectorStore.load(db.dim, path, copy=not mmap) if meta.get('rerank') else None
+        # Read-only indexes are safe to search from any number of threads
+        db._lock = _NoLock() if mmap else _ReadWriteLock()
+        db.kind = meta['kind']
+        db._next_id = meta['next_id']
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        db.index = faiss.read_index(os.path.join(path, INDEX_FILE), flags)
+        db._apply_search_params()
+        return db
+
+    def _target_kind(self, size):
+        """Kind of index wanted for `size` vectors."""
+        if self.index_type == 'auto':
+            return AUTO_ANN_INDEX if size >= self.flat_threshold else 'flat'
+        return self.index_type
+
+    def _needs_training(self, kind):
+        return kind in ('ivf_flat', 'ivf_pq') or self.storage in ('int8', 'pq', 'opq')
+
+    def _min_train_size(self):
+        if self.storage in ('pq', 'opq'):
+            return max(self.train_size, PQ_MIN_TRAIN_SIZE)
+        return self.train_size
+
+    def _upgrade_kind(self, size):
+        """Kind a flat index should become once it holds `size` vectors, or None."""
+        if self._staging:
+            return self._target_kind(size) if size >= self._min_train_size() else None
+        if self.kind == 'flat' and self.index_type == 'auto' and size >= self.flat_threshold:
+            return AUTO_ANN_INDEX
+        return None
+
+    def _codec(self, expected_size, hnsw=False):
+        """FAISS factory fragment encoding each vector in the chosen storage mode."""
+        if self.storage == 'float32':
+            return 'Flat'
+        if self.storage == 'float16':
+            return 'SQfp16'
+        if self.storage == 'int8':
+            return 'SQ8'
+        # HNSW's fused storage syntax only takes 8-bit PQ
+        if hnsw:
+            return f'PQ{self.pq_m}'
+        return f'PQ{self.pq_m}x{_pq_bits(expected_size)}'
+
+    def _build(self, kind, expected_size):
+        """Create an empty index of the given kind."""
+        rotation = f'OPQ{self.pq_m},' if self.storage == 'opq' else ''
+        self._staging = self._needs_training(kind) and expected_size < self._min_train_size()
+        if self._staging:
+            # Too few vectors to train on; hold them uncompressed until there are
+            kind = 'flat'
+            factory = 'IDMap2,Flat'
+        elif kind == 'flat':
+            factory = f'IDMap2,{rotation}{self._codec(expected_size)}'
+        elif kind == 'hnsw':
+            codec = self._codec(expected_size, hnsw=True)
+            suffix = '' if codec == 'Flat' else f'_{codec}'
+            factory = f'IDMap2,{rotation}HNSW{self.hnsw_m}{suffix}'
+        elif kind in ('ivf_flat', 'ivf_pq'):
+            # Rule of thumb: ~4 * sqrt(n) lists, with enough points per list to train
+            nlist = self.nlist or int(4 * math.sqrt(max(expected_size, 1)))
+            nlist = max(1, min(nlist, expected_size // 39 or 1))
+            if kind == 'ivf_flat':
+                factory = f'{rotation}IVF{nlist},{self._codec(expected_size)}'
+            else:
+                factory = f'{rotation}IVF{nlist},PQ{self.pq_m}x{_pq_bits(expected_size)}'
+        else:
+            raise ValueError(f"Unknown index type {kind!r}")
+        self.kind = kind
+        self.index = faiss.index_factory(self.dim, factory, faiss.METRIC_L2)
+        self._apply_search_params()
+
+    def _apply_search_params(self):
+        params = faiss.ParameterSpace()
+        if self.kind in ('ivf_flat', 'ivf_pq'):
+            params.set_index_parameter(self.index, 'nprobe', self.nprobe)
+        elif self.kind == 'hnsw':
+            params.set_index_parameter(self.index, 'efSearch', self.ef_search)
+
+    def _flat_contents(self):
+        """Return all (vectors, ids) of a flat index, used when upgrading it."""
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        if self._raw is not None:
+            vectors, found = self._raw.get(ids)
+            if found.all():
+                return vectors, ids
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        return vectors, ids
+
+    def _rerank(self, queries, candidate_ids, k):
+        """Re-score candidates with exact float32 distances and keep the best k."""
+        vectors, found = self._raw.get(candidate_ids)
+        vectors = vectors.reshape(len(queries), -1, self.dim)
+        found = found.reshape(candidate_ids.shape) & (candidate_ids >= 0)
+        distances = ((vectors - queries[:, None, :]) ** 2).sum(axis=-1)
+        distances[~found] = np.inf
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        ids = np.take_along_axis(candidate_ids, order, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1).astype(np.float32)
+        ids[np.isinf(distances)] = -1
+        return distances, ids
+
+def _pq_bits(expected_size):
+    # PQ codebooks need 2**nbits training points each
+    return max(1, min(8, int(math.log2(max(expected_size, 2)))))
+
+def storage_report(vectors, queries=None, k=10, modes=STORAGE_MODES, index_type='flat',
+                   rerank=False, **options):
+    """
+    Measure recall, memory and latency of each storage mode on `vectors`.
+
+    Recall@k is measured against exact float32 search; `queries` default to
+    a sample of the vectors themselves. Returns one dict per mode.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    dim = vectors.shape[1]
+    if queries is None:
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(vectors), size=min(100, len(vectors)), replace=False)]
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, dim)
+
+    exact = VectorDB(dim, index_type='flat')
+    exact.add(vectors)
+    truth, _ = exact.search_batch(queries, k)
+
+    report = []
+    for mode in modes:
+        db = VectorDB(dim, index_type=index_type, storage=mode, rerank=rerank, **options)
+        start = time.perf_counter()
+        db.add(vectors)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ids, _ = db.search_batch(queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        hits = sum(len(np.intersect1d(found[found >= 0], expected[expected >= 0]))
+                   for found, expected in zip(ids, truth))
+        report.append({
+            'storage': mode,
+            'index_type': db.kind,
+            'rerank': rerank,
+            f'recall@{k}': hits / max(1, int((truth >= 0).sum())),
+            'bytes_per_vector': db.memory_bytes() / len(vectors),
+            'latency_ms': latency_ms,
+            'build_seconds': build_seconds,
+        })
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare VectorDB storage modes on a set of embeddings.')
+    parser.add_argument('embeddings', help='.npy file with one embedding per row')
+    parser.add_argument('--queries', help='.npy file with query embeddings (default: sample of the embeddings)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--index-type', default='flat', choices=[t for t in INDEX_TYPES if t != 'auto'])
+    parser.add_argument('--rerank', action='store_true')
+    args = parser.parse_args(argv)
+
+    queries = np.load(args.queries) if args.queries else None
+    report = storage_report(np.load(args.embeddings), queries, k=args.k,
+                            index_type=args.index_type, rerank=args.rerank)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
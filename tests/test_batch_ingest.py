@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+pytest.importorskip('fitz')
+pytest.importorskip('pytesseract')
+
+from modules import batch_ingest
+from modules.corpus import read_manifest
+
+
+@pytest.fixture
+def ingested(monkeypatch):
+    """Stand in for the worker processes: a PDF's hash is its content, and 'broken' ones fail."""
+    calls = []
+
+    def ingest_all(paths, corpus_dir, workers, threads):
+        calls.append(sorted(os.path.basename(path) for path in paths))
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                content = f.read()
+            if content.startswith('broken'):
+                yield {'path': path, 'error': 'RuntimeError: unreadable'}
+            else:
+                yield {'path': path, 'hash': content, 'pages': 1, 'chunks': 1, 'images': 0}
+
+    monkeypatch.setattr(batch_ingest, '_ingest_all', ingest_all)
+    return calls
+
+
+def _write(path, content, mtime):
+    path.write_text(content, encoding='utf-8')
+    os.utime(path, (mtime, mtime))
+
+
+def test_runs_resume_and_retry_only_what_changed(tmp_path, ingested):
+    pdfs, corpus = tmp_path / 'pdfs', str(tmp_path / 'corpus')
+    pdfs.mkdir()
+    _write(pdfs / 'a.pdf', 'doc-a', 1000)
+    _write(pdfs / 'b.pdf', 'broken', 1000)
+
+    assert batch_ingest.ingest_directory(str(pdfs), corpus) == {'ingested': 1, 'skipped': 0, 'failed': 1}
+    # Unchanged files are skipped, the finished and the failed one alike
+    assert batch_ingest.ingest_directory(str(pdfs), corpus) == {'ingested': 0, 'skipped': 2, 'failed': 0}
+    assert batch_ingest.ingest_directory(str(pdfs), corpus, retry_failed=True)['failed'] == 1
+
+    # Editing files retries the failed one and replaces the old document
+    _write(pdfs / 'a.pdf', 'doc-a2', 2000)
+    _write(pdfs / 'b.pdf', 'doc-b', 2000)
+    assert batch_ingest.ingest_directory(str(pdfs), corpus) == {'ingested': 2, 'skipped': 0, 'failed': 0}
+    assert ingested == [['a.pdf', 'b.pdf'], ['b.pdf'], ['a.pdf', 'b.pdf']]
+    manifest = read_manifest(corpus)
+    assert sorted(manifest['documents']) == ['doc-a2', 'doc-b']
+    assert manifest['failed'] == {}
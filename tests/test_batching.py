@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+
+from modules.batching import MicroBatcher
+
+
+def test_results_reach_the_caller_that_submitted_them():
+    batches = []
+    batcher = MicroBatcher(lambda items: batches.append(list(items)) or [item * 2 for item in items],
+                           max_batch=4, max_wait=0.05)
+    release = threading.Barrier(8)
+    results = {}
+
+    def submit(value):
+        release.wait()
+        results[value] = batcher(value, timeout=5)
+
+    threads = [threading.Thread(target=submit, args=(value,)) for value in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {value: value * 2 for value in range(8)}
+    assert all(len(batch) <= 4 for batch in batches) and sum(map(len, batches)) == 8
+    assert batcher.stats()['items'] == 8
+
+
+def test_a_failed_batch_fails_every_item():
+    def fail(items):
+        raise RuntimeError('model failed')
+
+    batcher = MicroBatcher(fail, max_wait=0.01)
+    with pytest.raises(RuntimeError, match='model failed'):
+        batcher('query', timeout=5)
+
+
+def test_shutdown_finishes_queued_items_then_stops_the_thread():
+    batcher = MicroBatcher(lambda items: [item + 1 for item in items], max_wait=0.01)
+    future = batcher.submit(1)
+    batcher.shutdown(wait=True)
+    assert future.result(5) == 2
+    assert not batcher._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batcher.submit(2)
@@ -0,0 +1,40 @@
+import numpy as np
+
+from modules.bm25 import BM25Index, tokenize
+
+
+def test_tokenize_keeps_compounds_and_their_parts():
+    assert tokenize('Error AB-1234') == ['error', 'ab-1234', 'ab', '1234']
+
+
+def test_search_ranks_rarer_and_more_frequent_terms_higher():
+    index = BM25Index()
+    index.add(['the pump failed', 'the valve leaked', 'the pump pump overheated'])
+    ids, scores = index.search('pump', k=5)
+    assert ids.tolist() == [2, 0]
+    assert scores[0] > scores[1] > 0
+    ids, _ = index.search('valve', k=5)
+    assert ids.tolist() == [1]
+
+
+def test_explicit_and_continued_ids():
+    index = BM25Index()
+    index.add(['alpha'], ids=[10])
+    index.add(['beta'])
+    assert len(index) == 2
+    assert index.search('beta')[0].tolist() == [11]
+    assert index.search('gamma')[0].tolist() == []
+
+
+def test_saved_index_scores_like_the_original(tmp_path):
+    index = BM25Index(k1=1.2, b=0.5)
+    index.add(['pump AB-1234 failed', 'the valve leaked', 'pump pump overheated'], ids=[5, 6, 7])
+    index.save(str(tmp_path / 'bm25.npz'))
+    loaded = BM25Index.load(str(tmp_path / 'bm25.npz'))
+    assert len(loaded) == 3 and (loaded.k1, loaded.b) == (1.2, 0.5)
+    for query in ('pump', '1234 valve', 'missing'):
+        expected, expected_scores = index.search(query)
+        ids, scores = loaded.search(query)
+        assert ids.tolist() == expected.tolist() and np.allclose(scores, expected_scores)
+    loaded.add(['valve'])
+    assert loaded.search('valve')[0].tolist() == [8, 6]
@@ -0,0 +1,51 @@
+import pytest
+
+from modules import models
+from modules.chunker import chunk_page
+from modules.tokens import RegexTokenizer, TiktokenTokenizer
+
+
+class ByteEncoding:
+    """tiktoken stand-in with one token per UTF-8 byte, so any window edge can split a character."""
+
+    def encode(self, text, disallowed_special=()):
+        return list(text.encode('utf-8'))
+
+    def decode(self, tokens, errors='strict'):
+        return bytes(tokens).decode('utf-8', errors=errors)
+
+
+def _byte_tokenizer():
+    tokenizer = TiktokenTokenizer.__new__(TiktokenTokenizer)
+    tokenizer._encoding = ByteEncoding()
+    return tokenizer
+
+
+@pytest.fixture
+def use_tokenizer():
+    def use(tokenizer):
+        models.register('tokenizer', lambda: tokenizer)
+
+    yield use
+    models.register('tokenizer', models._load_tokenizer)
+
+
+def _block(text, top=0):
+    return {'text': text, 'bbox': (0, top, 100, top + 10)}
+
+
+def test_windows_overlap_and_keep_words_whole(use_tokenizer):
+    use_tokenizer(RegexTokenizer())
+    words = [f'größe{i}' for i in range(10)]
+    chunks = chunk_page([_block(' '.join(words))], page=3, max_tokens=4, overlap=1, min_tokens=0)
+    assert [chunk['text'] for chunk in chunks] == [
+        ' '.join(words[0:4]), ' '.join(words[3:7]), ' '.join(words[6:10])]
+    assert all(chunk['page'] == 3 and chunk['tokens'] == 4 for chunk in chunks)
+
+
+def test_split_multibyte_characters_are_dropped_at_window_edges(use_tokenizer):
+    use_tokenizer(_byte_tokenizer())
+    chunks = chunk_page([_block('é' * 9)], page=1, max_tokens=5, overlap=0, min_tokens=0)
+    texts = [chunk['text'] for chunk in chunks]
+    assert texts and all('�' not in text for text in texts)
+    assert all(set(text) <= {'é'} for text in texts)
@@ -0,0 +1,34 @@
+import io
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+from modules.image_dedup import ImageDeduplicator
+
+
+def _png(color, size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _occurrence(page, data):
+    return {'page': page, 'bbox': (0, 0, 1, 1), 'data': data}
+
+
+def test_flat_images_merge_only_with_the_same_colour_and_shape():
+    dedup = ImageDeduplicator()
+    red = dedup.add(_occurrence(1, _png('red', (40, 20))))
+    # Every flat image has the same dHash; the colour and aspect ratio tell them apart
+    assert dedup.add(_occurrence(2, _png('red', (80, 40)))) is None
+    assert dedup.add(_occurrence(3, _png('blue', (40, 20)))) is not None
+    assert dedup.add(_occurrence(4, _png('red', (20, 40)))) is not None
+    assert [occurrence['page'] for occurrence in red['occurrences']] == [1, 2]
+    assert len(dedup.images) == 3
+
+
+def test_repeated_xrefs_are_merged_without_decoding():
+    dedup = ImageDeduplicator()
+    dedup.add(dict(_occurrence(1, _png('red', (8, 8))), xref=7))
+    assert dedup.add(dict(_occurrence(2, b'not an image'), xref=7)) is None
@@ -0,0 +1,42 @@
+import pytest
+
+from modules import models
+
+
+class Pool:
+    def __init__(self):
+        self.closed = False
+
+    def shutdown(self, wait=True):
+        self.closed = True
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(models, '_loaders', {})
+    monkeypatch.setattr(models, '_models', {})
+    monkeypatch.setattr(models, '_locks', {})
+    monkeypatch.setattr(models, '_resources', set())
+    return models
+
+
+def test_defaults_leave_resources_alone(registry):
+    loaded = []
+    registry.register('model', lambda: loaded.append('model') or object())
+    registry.register('client', lambda: loaded.append('client') or object(), resource=True)
+    registry.warm_up()
+    assert loaded == ['model']
+    registry.get_model('client')
+    registry.unload()
+    assert not registry.is_loaded('model') and registry.is_loaded('client')
+
+
+def test_dropped_pools_are_shut_down(registry):
+    registry.register('pool', Pool, resource=True)
+    pool = registry.get_model('pool')
+    registry.unload('pool')
+    assert pool.closed
+    pool = registry.get_model('pool')
+    # Replacing a loaded entry keeps its kind and shuts the old one down
+    registry.register('pool', Pool)
+    assert pool.closed and 'pool' in registry._resources
@@ -0,0 +1,42 @@
+import time
+
+import numpy as np
+
+from modules.response_cache import ResponseCache, make_cache_key, make_scope
+
+
+def _cache(tmp_path, **options):
+    return ResponseCache(str(tmp_path / 'responses.sqlite3'), **options)
+
+
+def test_exact_hits_expire_after_the_ttl(tmp_path, monkeypatch):
+    cache = _cache(tmp_path, ttl=60)
+    key = make_cache_key('doc', [1, 2], 'question', 'model', 0.0)
+    cache.put(key, 'doc', 'answer')
+    assert cache.lookup(key, 'doc') == 'answer'
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.lookup(key, 'doc') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = _cache(tmp_path, max_entries=2)
+    cache.put('a', 'doc', 'A')
+    cache.put('b', 'doc', 'B')
+    cache.get('a')
+    cache.put('c', 'doc', 'C')
+    assert cache.get('a') == 'A' and cache.get('c') == 'C'
+    assert cache.get('b') is None
+
+
+def test_semantic_hits_stay_within_their_filters_model_and_temperature(tmp_path):
+    cache = _cache(tmp_path, semantic_threshold=0.9)
+    filtered = make_scope('doc', 'model', 0.0, pages=(1, 5))
+    cache.put('a', filtered, 'pages 1-5', np.array([1.0, 0.0, 0.0]))
+    assert cache.lookup('b', filtered, np.array([1.0, 0.1, 0.0])) == 'pages 1-5'
+    for other in (make_scope('doc', 'model', 0.0), make_scope('doc', 'other model', 0.0, pages=(1, 5)),
+                  make_scope('doc', 'model', 0.7, pages=(1, 5))):
+        assert cache.lookup('b', other, np.array([1.0, 0.1, 0.0])) is None
+    # Embeddings of another text model are skipped instead of breaking the comparison
+    assert cache.lookup('b', filtered, np.array([1.0, 0.0])) is None
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('fitz')
+pytest.importorskip('pytesseract')
+
+from modules import models
+from modules.asset_store import AssetStore
+from modules.benchmark import make_pdf, make_vocabulary
+from modules.ingestion import ProgressiveIngestion
+from modules.retriever import CorpusRetriever
+
+
+class GatedBackend:
+    """Random embeddings; once `gate` is armed, the second image batch waits for `release`."""
+
+    tensor_type = 'np'
+
+    def __init__(self):
+        self.rng = np.random.default_rng(0)
+        self.armed = False
+        self.image_batches = 0
+        self.release = threading.Event()
+
+    def text_embeddings(self, texts):
+        return self.rng.random((len(texts), 8), dtype=np.float32)
+
+    def clip_text_embeddings(self, texts):
+        return self.rng.random((len(texts), 4), dtype=np.float32)
+
+    def clip_image_embeddings(self, inputs):
+        if self.armed:
+            self.image_batches += 1
+            if self.image_batches > 1:
+                self.release.wait(30)
+        return self.rng.random((inputs['n'], 4), dtype=np.float32)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    loaders = dict(models._loaders)
+    backend = GatedBackend()
+    models.register('embedding_backend', lambda: backend)
+    models.register('clip_processor', lambda: lambda images, return_tensors: {'n': len(images)})
+    models.register('asset_store', lambda: AssetStore(str(tmp_path / 'assets')))
+    yield backend
+    backend.release.set()
+    for name, loader in loaders.items():
+        models.register(name, loader)
+
+
+def _ingest(path, seed, vocabulary):
+    make_pdf(path, pages=6, words_per_page=300, images_per_page=1, seed=seed, vocabulary=vocabulary)
+    with open(path, 'rb') as f:
+        return ProgressiveIngestion(f.read(), batch_pages=1)
+
+
+def test_search_ignores_vectors_indexed_after_the_snapshot(backend, tmp_path):
+    vocabulary = make_vocabulary()
+    finished = _ingest(str(tmp_path / 'finished.pdf'), 1, vocabulary)
+    assert finished.wait(60) and finished.error is None
+
+    backend.armed = True
+    running = _ingest(str(tmp_path / 'running.pdf'), 2, vocabulary)
+    deadline = time.time() + 60
+    while running.pages_done < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    retriever = CorpusRetriever([running, finished], candidates=50)
+    plan = retriever.plan()
+    only_running = retriever.plan(doc_hashes={running.hash})
+    backend.release.set()
+    assert running.wait(60) and running.error is None
+
+    chunks, images = plan['chunks'], plan['images']
+    running_chunks = int(chunks.offsets[1])
+    running_images = int(images.offsets[1])
+    # The indexes grew past the snapshot, so a careless search would overflow it
+    assert len(running.text_db) > running_chunks and len(running.image_db) > running_images
+
+    query = ' '.join(vocabulary[:300])
+    for current in (plan, only_running):
+        dense, _ = retriever.search_dense(current, np.ones(8, dtype=np.float32))
+        lexical, _ = retriever.search_lexical(current, query)
+        found, _ = retriever.search_images(current, np.ones(4, dtype=np.float32), 10)
+        assert len(dense) and len(lexical) and len(found)
+        assert dense.max() < len(chunks) and lexical.max() < len(chunks) and found.max() < len(images)
+        for ids in (dense, lexical):
+            # Ids of the running document stay inside its own rows
+            assert (chunks.doc[ids] == 0).sum() == (ids < running_chunks).sum()
+
+    dense, _ = retriever.search_dense(only_running, np.ones(8, dtype=np.float32))
+    lexical, _ = retriever.search_lexical(only_running, query)
+    found, _ = retriever.search_images(only_running, np.ones(4, dtype=np.float32), 10)
+    assert dense.max() < running_chunks and lexical.max() < running_chunks
+    assert found.max() < running_images
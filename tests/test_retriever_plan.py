@@ -0,0 +1,58 @@
+import numpy as np
+
+from modules.chunk_store import ChunkStore
+from modules.retriever import CorpusRetriever
+from modules.vector_db import VectorDB
+
+
+class Shard:
+    """Document stand-in whose indexes must not be touched unless searched."""
+
+    done = True
+
+    def __init__(self, doc_hash, date, pages, images=0):
+        self.hash = doc_hash
+        self.date = date
+        self.page_count = pages
+        self.text_chunks = ChunkStore.from_records(
+            [{'page': page, 'bbox': (0, 0, 1, 1)} for page in range(1, pages + 1)])
+        self.image_chunks = ChunkStore.from_records(
+            [{'page': 1, 'bbox': (0, 0, 1, 1)}] * images, 'image')
+        self.loaded = []
+
+    def __getattr__(self, name):
+        if name in ('text_db', 'image_db', 'bm25'):
+            self.loaded.append(name)
+            return None
+        raise AttributeError(name)
+
+
+def test_pruned_shards_keep_their_position_but_no_rows():
+    old, new, short = Shard('a', 100.0, 3), Shard('b', 200.0, 4, images=2), Shard('c', 200.0, 1)
+    retriever = CorpusRetriever([old, new, short])
+    plan = retriever.plan(pages=(2, None), dates=(150.0, None))
+    assert plan['positions'] == [1]
+    chunks = plan['chunks']
+    assert chunks.offsets.tolist() == [0, 0, 4, 4]
+    assert (chunks.doc == 1).all()
+    assert plan['text_allowed'][1].tolist() == [False, True, True, True]
+    assert retriever.has_images(plan)
+    assert not retriever.has_images(retriever.plan(doc_hashes={'a'}))
+
+
+def test_only_shards_with_rows_are_searched():
+    with_images, without = Shard('a', 1.0, 2, images=1), Shard('b', 1.0, 2)
+    retriever = CorpusRetriever([with_images, without])
+    retriever.search_images(retriever.plan(), np.ones(4, dtype=np.float32))
+    assert with_images.loaded == ['image_db'] and without.loaded == []
+
+
+def test_image_hits_beyond_the_cutoff_are_dropped():
+    shard = Shard('a', 1.0, 1, images=3)
+    shard.image_db = VectorDB(2, index_type='flat')
+    shard.image_db.add(np.array([[0, 0], [1, 0], [3, 0]], dtype=np.float32))
+    query = np.zeros(2, dtype=np.float32)
+    retriever = CorpusRetriever([shard], max_image_distance=1.0)
+    ids, distances = retriever.search_images(retriever.plan(), query)
+    assert ids.tolist() == [0, 1] and distances.tolist() == [0.0, 1.0]
+    assert CorpusRetriever([shard]).search_images(retriever.plan(), query)[0].tolist() == [0, 1, 2]
@@ -0,0 +1,28 @@
+import numpy as np
+
+from modules.utils import reciprocal_rank_fusion
+
+
+def test_rrf_keeps_ids_past_the_shorter_ranking():
+    ids, scores = reciprocal_rank_fusion([1, 2, 3, 4, 5], [9], k=60)
+    # Zipping the rankings used to drop everything past the first entry of each
+    assert sorted(ids.tolist()) == [1, 2, 3, 4, 5, 9]
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_rrf_sums_contributions_of_every_ranking():
+    ids, scores = reciprocal_rank_fusion([1, 2], [2, 1], [2], k=10)
+    assert ids.tolist() == [2, 1]
+    assert np.isclose(scores[0], 1 / 11 + 1 / 10 + 1 / 10)
+    assert np.isclose(scores[1], 1 / 10 + 1 / 11)
+
+
+def test_rrf_ignores_padding_and_applies_weights():
+    ids, scores = reciprocal_rank_fusion([1, -1, -1], [2], k=1, weights=[1.0, 3.0])
+    assert ids.tolist() == [2, 1]
+    assert np.allclose(scores, [3.0, 1.0])
+
+
+def test_rrf_of_nothing_is_empty():
+    ids, scores = reciprocal_rank_fusion([], [])
+    assert len(ids) == 0 and len(scores) == 0
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+
+from modules.vector_db import PQ_MIN_TRAIN_SIZE, RawVectorStore, VectorDB
+
+
+def _vectors(n, dim=16, seed=0):
+    return np.random.default_rng(seed).random((n, dim), dtype=np.float32)
+
+
+def test_ids_default_to_insertion_order_and_can_be_explicit():
+    db = VectorDB(16, index_type='flat')
+    vectors = _vectors(5)
+    assert db.add(vectors[:3]).tolist() == [0, 1, 2]
+    assert db.add(vectors[3:], ids=[10, 11]).tolist() == [10, 11]
+    assert db.add(_vectors(1, seed=1)).tolist() == [12]
+    assert db.search(vectors[4], k=1).tolist() == [11]
+
+
+def test_remove_and_update_by_id():
+    db = VectorDB(16, index_type='flat')
+    vectors = _vectors(4)
+    db.add(vectors)
+    assert db.remove([1]) == 1
+    assert len(db) == 3
+    assert 1 not in db.search(vectors[1], k=4).tolist()
+    db.update([2], vectors[1:2])
+    assert db.search(vectors[1], k=1).tolist() == [2]
+
+
+def test_search_batch_pads_missing_hits():
+    db = VectorDB(16, index_type='flat')
+    db.add(_vectors(2))
+    ids, distances = db.search_batch(_vectors(3, seed=1), k=4)
+    assert ids.shape == (3, 4)
+    assert (ids[:, 2:] == -1).all() and np.isinf(distances[:, 2:]).all()
+    ids, _ = db.search_batch(_vectors(1), k=2, max_distance=0.0)
+    assert ids.tolist() == [[0, -1]]
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_save_and_load_keep_ids(tmp_path, mmap):
+    db = VectorDB(16, index_type='flat')
+    vectors = _vectors(6)
+    db.add(vectors, ids=np.arange(100, 106))
+    db.save(str(tmp_path))
+    loaded = VectorDB.load(str(tmp_path), mmap=mmap)
+    assert len(loaded) == 6
+    assert loaded.search(vectors[3], k=1).tolist() == [103]
+    if not mmap:
+        assert loaded.add(_vectors(1, seed=1)).tolist() == [106]
+
+
+def test_rerank_returns_exact_order_for_compressed_storage(tmp_path):
+    vectors = _vectors(300)
+    exact = VectorDB(16, index_type='flat')
+    exact.add(vectors)
+    db = VectorDB(16, index_type='flat', storage='int8', rerank=True, rerank_factor=50, train_size=100)
+    db.add(vectors)
+    queries = _vectors(5, seed=1)
+    expected, expected_distances = exact.search_batch(queries, k=3)
+    ids, distances = db.search_batch(queries, k=3)
+    assert (ids == expected).all()
+    assert np.allclose(distances, expected_distances, rtol=1e-4)
+
+    db.save(str(tmp_path))
+    loaded = VectorDB.load(str(tmp_path))
+    assert (loaded.search_batch(queries, k=3)[0] == expected).all()
+    db.close()
+
+
+def test_raw_store_creates_and_keeps_a_given_file(tmp_path):
+    path = str(tmp_path / 'vectors.f32')
+    db = VectorDB(16, index_type='flat', storage='int8', rerank=True, raw_path=path)
+    vectors = _vectors(3)
+    db.add(vectors)
+    db.reset()
+    store = RawVectorStore(16, path)
+    # Rows written earlier are kept; new ones go after them
+    store.append(vectors[:1], [0])
+    found, mask = store.get([0])
+    assert mask.all() and np.allclose(found, vectors[:1])
+    assert store._count == 4
+
+
+def test_hnsw_pq_trains_once_enough_vectors_are_staged():
+    db = VectorDB(16, index_type='hnsw', storage='pq', pq_m=2, train_size=PQ_MIN_TRAIN_SIZE)
+    vectors = _vectors(PQ_MIN_TRAIN_SIZE + 40)
+    db.add(vectors[:40])
+    assert db.kind == 'flat'
+    assert db.search(vectors[7], k=1).tolist() == [7]
+    db.add(vectors[40:])
+    assert db.kind == 'hnsw' and len(db) == len(vectors)
+    assert 7 in db.search(vectors[7], k=5).tolist()
+
+
+def test_small_batches_train_the_codec_on_everything_staged():
+    vectors = _vectors(200)
+    queries = _vectors(5, seed=1)
+    at_once = VectorDB(16, index_type='flat', storage='int8', train_size=200)
+    at_once.add(vectors)
+    batched = VectorDB(16, index_type='flat', storage='int8', train_size=200)
+    for start in range(0, len(vectors), 20):
+        batched.add(vectors[start:start + 20])
+        # Held uncompressed, and searchable, until the codec can be trained
+        assert batched._staging == (start + 20 < 200)
+        assert batched.search(vectors[start], k=1).tolist() == [start]
+    assert len(batched) == 200
+    assert (batched.search_batch(queries, k=10)[0] == at_once.search_batch(queries, k=10)[0]).all()
+    assert batched.memory_bytes() < 200 * 16 * 4
+
+
+def test_opq_accepts_a_small_first_batch():
+    db = VectorDB(16, index_type='flat', storage='opq', pq_m=4)
+    vectors = _vectors(20)
+    db.add(vectors)
+    assert db.search(vectors[3], k=1).tolist() == [3]
+
+
+def test_loaded_rerank_store_leaves_the_saved_files_alone(tmp_path):
+    vectors = _vectors(4)
+    db = VectorDB(16, index_type='flat', storage='int8', rerank=True)
+    db.add(vectors[:2])
+    db.save(str(tmp_path))
+    saved = (tmp_path / 'vectors.f32').read_bytes()
+
+    loaded = VectorDB.load(str(tmp_path))
+    loaded.add(vectors[2:])
+    assert (tmp_path / 'vectors.f32').read_bytes() == saved
+    assert loaded.search(vectors[3], k=1).tolist() == [3]
+    loaded.save(str(tmp_path))
+    assert len(VectorDB.load(str(tmp_path))) == 4
+
+    # A read-only store uses the saved file in place and can be saved over it
+    in_place = VectorDB.load(str(tmp_path), mmap=True)
+    in_place._raw.save(str(tmp_path))
+    assert (tmp_path / 'vectors.f32').stat().st_size == 4 * 16 * 4